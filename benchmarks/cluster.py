@@ -0,0 +1,175 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Run an aggregator and an agent in separate processes and check that the
+results of the agent arrive as one digest.
+
+The parent process starts a recording SMTP stand-in and an aggregator that
+listens on a unix socket. A child process generates the backup trees of
+the hosts, all assigned to the agent, and runs one reporting cycle of the
+agent ('dod_reporter --once'). The agent spools its results and pushes
+them to the aggregator. Once the aggregation window has passed, the
+aggregator mails the digest. The script checks that:
+
+    - the agent exits with no records left pending
+    - exactly one digest arrives, covering all hosts
+    - the aggregator holds no spooled results after sending it
+
+Results are printed as JSON. The exit code is 1 if any check failed.
+
+Usage: python benchmarks/cluster.py [--hosts N] [--window SECONDS] [--timeout SECONDS]"""
+
+import argparse
+import configparser
+import email
+import email.policy
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Import the package from the checkout, it does not need to be installed
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC)
+
+from smtp_delivery import SMTPRecorder
+from reporting_cycle import generate_host
+
+####################################################################################################
+
+def write_config(tmp, role, hosts, port, window):
+    """Write the configuration of a node, returns the path of the file."""
+    directory = os.path.join(tmp, role)
+    os.makedirs(os.path.join(directory, 'conf.d'))
+    cp = configparser.ConfigParser()
+    cp['General'] = {
+            'recipients'       : 'Admin <admin@example.com>',
+            'smtpfrom'         : 'DOD <dod@example.com>',
+            'smtphost'         : '127.0.0.1',
+            'smtpport'         : str(port),
+            'smtpno_tls'       : 'yes',
+            'spooldir'         : os.path.join(directory, 'spool'),
+            'statedir'         : os.path.join(directory, 'state'),
+            'role'             : role,
+            'nodename'         : role,
+            'nodes'            : 'aggregator, agent',
+            'aggregator'       : f"unix:{os.path.join(tmp, 'aggregator.sock')}",
+            'aggregatortoken'  : 's3cret',
+            'aggregatorwindow' : str(window),
+            }
+    for i in range(hosts):
+        cp[f"host{i}"] = {
+                'Directory'  : os.path.join(tmp, 'backup', f"host{i}"),
+                'Recipients' : 'Ops <ops@example.com>',
+                'Node'       : 'agent',
+                }
+    path = os.path.join(directory, 'main.conf')
+    with open(path, 'w') as outfile:
+        cp.write(outfile)
+    return path
+
+def load_reporter(path, once):
+    """Construct a DODReporter for a configuration written by write_config()."""
+    from dodreporter import DODReporter, config
+    return DODReporter(config.get_config(path, os.path.join(os.path.dirname(path), 'conf.d'), None), once = once)
+
+def digests(recorder):
+    """Return the subjects of the digests the recorder received."""
+    with recorder.lock:
+        messages = [ data for _, _, data in recorder.received ]
+    subjects = [ email.message_from_bytes(data, policy = email.policy.default)['Subject'] for data in messages ]
+    return [ subject for subject in subjects if 'Backup report for' in subject ]
+
+def run_child(args):
+    """Generate the trees and run one cycle of the agent."""
+    from dodreporter import log
+    log.configure(level = 'error')
+    for i in range(args.hosts):
+        generate_host(os.path.join(args.child, 'backup', f"host{i}"), 2, 5, 0.5, 1024)
+    reporter = load_reporter(os.path.join(args.child, 'agent', 'main.conf'), once = True)
+    code     = reporter.run_once()
+    print(json.dumps({ 'exit_code' : code, 'pending' : reporter.agent.pending }))
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--hosts', type = int, default = 20, help = 'hosts checked by the agent')
+    parser.add_argument('--window', type = int, default = 1, help = 'aggregation window in seconds')
+    parser.add_argument('--timeout', type = float, default = 60, help = 'seconds to wait for the digest')
+    parser.add_argument('--child', help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    from dodreporter import log
+    log.configure(level = 'error')
+    problems = []
+    with tempfile.TemporaryDirectory() as tmp:
+        recorder = SMTPRecorder()
+        port     = recorder.server_address[1]
+        write_config(tmp, 'agent', args.hosts, port, args.window)
+        aggregator = load_reporter(write_config(tmp, 'aggregator', args.hosts, port, args.window), once = False)
+
+        start = time.perf_counter()
+        proc  = subprocess.run([ sys.executable, __file__, '--child', tmp, '--hosts', str(args.hosts) ],
+                capture_output = True, text = True)
+        agent_s = time.perf_counter() - start
+        if proc.returncode not in (0, 1, 2):
+            problems.append(f"agent failed with exit code {proc.returncode}: {proc.stderr.strip()[-500:]}")
+            agent = {}
+        else:
+            agent = json.loads(proc.stdout.strip().splitlines()[-1])
+            if agent['pending']:
+                problems.append(f"agent exited with {agent['pending']} pending record(s)")
+
+        # The digest is due one window after the first result arrived
+        deadline = time.monotonic() + args.timeout
+        while not digests(recorder) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        digest_s = time.perf_counter() - start
+        # Give a duplicate digest the chance to show up
+        time.sleep(args.window + 0.5)
+        received = digests(recorder)
+        spooled  = os.listdir(os.path.join(tmp, 'aggregator', 'state', 'aggregator'))
+        aggregator.terminate()
+
+        if len(received) != 1:
+            problems.append(f"expected one digest, received {len(received)}: {received}")
+        elif f"Backup report for {args.hosts} host(s)" not in received[0]:
+            problems.append(f"digest does not cover all {args.hosts} hosts: {received[0]}")
+        if spooled:
+            problems.append(f"aggregator kept {len(spooled)} spooled result(s) after sending the digest")
+
+    print(json.dumps({
+            'hosts'     : args.hosts,
+            'agent_s'   : round(agent_s, 3),
+            'digest_s'  : round(digest_s, 3),
+            'exit_code' : agent.get('exit_code'),
+            'messages'  : len(recorder.received),
+            'digests'   : received,
+            'problems'  : problems,
+            }, indent = 2))
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
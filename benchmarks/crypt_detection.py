@@ -0,0 +1,97 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Compare the event-driven crypt volume detection of MountWatcher with the
+former 3 second polling loop.
+
+Both variants wait for a directory that is created after an idle period.
+The benchmark reports the number of wake-ups during the idle period and the
+latency between the creation of the directory and its detection.
+
+Usage: python benchmarks/crypt_detection.py [--idle SECONDS] [--rounds N]"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# Import the package from the checkout, it does not need to be installed
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC)
+
+from dodreporter.MountWatcher import MountWatcher
+
+####################################################################################################
+
+def poll_loop(path, stop):
+    """The detection loop as implemented before, returns (wakeups, detection time)."""
+    wakeups = 0
+    while not os.path.exists(path):
+        wakeups += 1
+        stop.wait(3)
+    return wakeups, time.monotonic()
+
+def watch_loop(path, stop):
+    """The event-driven detection loop, returns (wakeups, detection time)."""
+    watcher = MountWatcher([ path ])
+    wakeups = 0
+    try:
+        while not os.path.exists(path):
+            wakeups += 1
+            watcher.wait(300)
+    finally:
+        watcher.close()
+    return wakeups, time.monotonic()
+
+def measure(loop, idle):
+    """Run a detection loop against a directory created after 'idle' seconds."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path   = os.path.join(tmp, 'crypt', 'volume')
+        result = {}
+        thread = threading.Thread(target = lambda : result.update(zip(('wakeups', 'detected'), loop(path, threading.Event()))))
+        thread.start()
+        time.sleep(idle)
+        created = time.monotonic()
+        os.makedirs(path)
+        thread.join()
+        return { 'wakeups' : result['wakeups'], 'latency_ms' : (result['detected'] - created) * 1000 }
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--idle', type = float, default = 10, help = 'idle period before the volume appears')
+    parser.add_argument('--rounds', type = int, default = 3, help = 'number of measurements per variant')
+    args = parser.parse_args()
+
+    results = {}
+    for name, loop in (('poll', poll_loop), ('watch', watch_loop)):
+        runs = [ measure(loop, args.idle) for _ in range(args.rounds) ]
+        results[name] = {
+                'idle_s'          : args.idle,
+                'mean_wakeups'    : sum(r['wakeups'] for r in runs) / len(runs),
+                'mean_latency_ms' : sum(r['latency_ms'] for r in runs) / len(runs),
+                'max_latency_ms'  : max(r['latency_ms'] for r in runs),
+                }
+    print(json.dumps(results, indent = 2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""End-to-end benchmark of a reporting cycle over synthetic backup hosts.
+
+For every scale, a child process generates the backup trees of the given
+number of hosts. The trees use a snapshot layout with a configurable share
+of files hardlinked to the previous snapshot. The child then runs one
+reporting cycle ('dod_reporter --once') against an in-process SMTP sink.
+Results are printed as JSON, one record per scale:
+
+    wall_s             Duration of the cycle
+    inodes_per_s       Filesystem operations of the checks per second
+    check_mean_s       Mean duration of a host check
+    smtp_send_mean_ms  Mean render and transmit time of a message
+    mail_latency_ms    Mean time from queueing to delivery of a message
+    max_rss_mb         Memory high-water mark of the child process
+    peak_threads       Maximum number of live threads during the cycle
+
+Usage: python benchmarks/reporting_cycle.py [--scales 10,100,1000,10000]
+           [--snapshots N] [--files N] [--hardlink-ratio R] [--usage]"""
+
+import argparse
+import configparser
+import json
+import os
+import resource
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Import the package from the checkout, it does not need to be installed
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC)
+
+####################################################################################################
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP dialogue that accepts every message."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().upper()
+            if command == b'DATA':
+                self.reply('354 go ahead')
+                size = 0
+                for data in self.rfile:
+                    if data in (b'.\r\n', b'.\n'):
+                        break
+                    size += len(data)
+                with self.server.lock:
+                    self.server.messages += 1
+                    self.server.bytes    += size
+                self.reply('250 queued')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """In-process SMTP stand-in on a free local port, counts the messages
+    and bytes it receives."""
+
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), _SinkHandler)
+        self.lock     = threading.Lock()
+        self.messages = 0
+        self.bytes    = 0
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+
+####################################################################################################
+
+def generate_host(directory, snapshots, files, hardlink_ratio, file_size):
+    """Generate the snapshots of a host. The newest snapshot is one hour
+    old, older ones are one day apart. In every snapshot after the first,
+    the first 'hardlink_ratio' share of the files are hardlinks to the
+    previous snapshot."""
+    now     = time.time()
+    linked  = int(files * hardlink_ratio)
+    payload = os.urandom(file_size)
+    previous = None
+    for i in range(snapshots):
+        snapshot = os.path.join(directory, f"snapshot.{i:04d}")
+        os.makedirs(snapshot)
+        for j in range(files):
+            path = os.path.join(snapshot, f"file{j:05d}")
+            if previous and j < linked:
+                os.link(os.path.join(previous, f"file{j:05d}"), path)
+            else:
+                with open(path, 'wb') as outfile:
+                    outfile.write(payload)
+        mtime = now - 3600 - (snapshots - 1 - i) * 86400
+        os.utime(snapshot, (mtime, mtime))
+        previous = snapshot
+
+def make_settings(tmp, hosts, port, usage, workers):
+    """Return DODSettings for the synthetic hosts."""
+    from dodreporter import config
+    cp = configparser.ConfigParser()
+    cp['General'] = {
+            'recipients'  : 'Admin <admin@example.com>',
+            'smtpfrom'    : 'DOD <dod@example.com>',
+            'smtphost'    : '127.0.0.1',
+            'smtpport'    : str(port),
+            'smtpno_tls'  : 'yes',
+            'spooldir'    : os.path.join(tmp, 'spool'),
+            'statedir'    : os.path.join(tmp, 'state'),
+            'hostworkers' : str(workers),
+            'fsworkers'   : str(workers),
+            }
+    for i in range(hosts):
+        cp[f"host{i}"] = {
+                'Directory'  : os.path.join(tmp, 'backup', f"host{i}"),
+                'Recipients' : f"Host {i} <host{i}@example.com>",
+                'Usage'      : 'yes' if usage else 'no',
+                }
+    return config.DODSettings(
+            global_settings = config.DODGlobalSettings(cp),
+            host_settings   = [ config.DODHostSettings(cp, section) for section in cp.sections() if section != 'General' ])
+
+def run_child(args):
+    """Generate the trees, run one cycle and print the measurements."""
+    from dodreporter import DODReporter, log
+    from dodreporter.IOLimiter import FS_OPERATIONS
+    from dodreporter.SMTPClient import SEND_SECONDS
+    from dodreporter.runners.DODHostRunner import CHECK_SECONDS
+
+    log.configure(level = 'error')
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(args.child):
+            generate_host(os.path.join(tmp, 'backup', f"host{i}"), args.snapshots, args.files, args.hardlink_ratio, args.file_size)
+
+        sink     = SMTPSink()
+        settings = make_settings(tmp, args.child, sink.server_address[1], args.usage, args.workers)
+
+        peak_threads = threading.active_count()
+        done = threading.Event()
+        def sample_threads():
+            nonlocal peak_threads
+            while not done.wait(0.01):
+                peak_threads = max(peak_threads, threading.active_count())
+        threading.Thread(target = sample_threads, daemon = True).start()
+
+        start    = time.perf_counter()
+        reporter = DODReporter(settings, once = True)
+        reporter.run_once()
+        wall     = time.perf_counter() - start
+        done.set()
+
+        ops    = sum(FS_OPERATIONS.values().values())
+        checks = list(CHECK_SECONDS.values().values())
+        sends  = list(SEND_SECONDS.values().values())
+        queue  = reporter.mail_queue.stats()
+        print(json.dumps({
+                'hosts'             : args.child,
+                'snapshots'         : args.snapshots,
+                'files'             : args.files,
+                'hardlink_ratio'    : args.hardlink_ratio,
+                'usage'             : args.usage,
+                'wall_s'            : round(wall, 3),
+                'hosts_per_s'       : round(args.child / wall, 1),
+                'inodes_per_s'      : round(ops / wall, 1),
+                'check_mean_s'      : round(sum(c[-1] for c in checks) / sum(sum(c[:-1]) for c in checks), 4),
+                'smtp_send_mean_ms' : round(sum(s[-1] for s in sends) / max(1, sum(sum(s[:-1]) for s in sends)) * 1000, 2),
+                'mail_latency_ms'   : round((queue['mean_latency'] or 0) * 1000, 2),
+                'messages'          : sink.messages,
+                'message_bytes'     : sink.bytes,
+                'max_rss_mb'        : round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                'peak_threads'      : peak_threads,
+                }))
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--scales', default = '10,100,1000,10000', help = 'comma separated host counts')
+    parser.add_argument('--snapshots', type = int, default = 3, help = 'snapshots per host')
+    parser.add_argument('--files', type = int, default = 20, help = 'files per snapshot')
+    parser.add_argument('--hardlink-ratio', type = float, default = 0.9, help = 'share of files hardlinked to the previous snapshot')
+    parser.add_argument('--file-size', type = int, default = 4096, help = 'size of the generated files in bytes')
+    parser.add_argument('--usage', action = 'store_true', help = 'enable the disk usage accounting of the hosts')
+    parser.add_argument('--workers', type = int, default = 4, help = 'host check workers')
+    parser.add_argument('--child', type = int, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    results = []
+    for hosts in (int(scale) for scale in args.scales.split(',')):
+        cmd = [ sys.executable, __file__, '--child', str(hosts),
+                '--snapshots', str(args.snapshots), '--files', str(args.files),
+                '--hardlink-ratio', str(args.hardlink_ratio), '--file-size', str(args.file_size),
+                '--workers', str(args.workers) ] + ([ '--usage' ] if args.usage else [])
+        proc = subprocess.run(cmd, capture_output = True, text = True, check = True)
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    print(json.dumps(results, indent = 2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Deliver messages with SMTPClient to a recording SMTP stand-in and check
+what arrives.
+
+The client sends messages with a non-ASCII subject, body lines that need
+dot-stuffing, and attachments given as bytes and as a path, one of them
+gzip compressed. The stand-in parses every message and compares it with
+what was sent. The script also checks that:
+
+    - a refused recipient raises SMTPRecipientsRefused
+    - a session dropped by the relay is retried on a fresh connection
+    - the mail queue delivers a burst of messages exactly once
+
+Results are printed as JSON. The exit code is 1 if any check failed.
+
+Usage: python benchmarks/smtp_delivery.py [--messages N] [--attachment-size BYTES]"""
+
+import argparse
+import base64
+import email
+import email.policy
+import gzip
+import json
+import os
+import smtplib
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+# Import the package from the checkout, it does not need to be installed
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC)
+
+from dodreporter import log
+from dodreporter.MailQueue import MailQueue
+from dodreporter.SMTPClient import SMTPClient
+
+####################################################################################################
+
+USER, PASSWORD = 'dod', 's3cret'
+
+class _RecorderHandler(socketserver.StreamRequestHandler):
+    """SMTP dialogue with AUTH PLAIN, refused recipients and dropped
+    sessions, records every accepted message."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 recorder')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().decode('utf-8')
+            verb    = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.wfile.write(b'250-recorder\r\n250 AUTH PLAIN\r\n')
+            elif verb == 'AUTH':
+                token = base64.b64decode(command.split()[2]).split(b'\0')
+                self.reply('235 ok' if token[1:] == [ USER.encode(), PASSWORD.encode() ] else '535 denied')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:].strip('<>'), []
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                address = command[8:].strip('<>')
+                if address.startswith('refused'):
+                    self.reply('550 no such user')
+                else:
+                    recipients.append(address)
+                    self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                lines = []
+                for data in self.rfile:
+                    if data == b'.\r\n':
+                        break
+                    # Undo the dot-stuffing
+                    lines.append(data[1:] if data.startswith(b'.') else data)
+                with server.lock:
+                    server.received.append((sender, recipients, b''.join(lines)))
+                    drop = server.drop_after and len(server.received) % server.drop_after == 0
+                self.reply('250 queued')
+                if drop:
+                    # Like a relay closing idle sessions, the client finds out
+                    # on its next transaction
+                    return
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+class SMTPRecorder(socketserver.ThreadingTCPServer):
+    """In-process SMTP stand-in on a free local port. Every 'drop_after'
+    messages, the session is closed without notice."""
+
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    def __init__(self, drop_after = None):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), _RecorderHandler)
+        self.lock        = threading.Lock()
+        self.drop_after  = drop_after
+        self.received    = []
+        self.connections = 0
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+
+####################################################################################################
+
+def make_message(i, attachment_path):
+    """Return the sendMessage() arguments of the i-th test message."""
+    return {
+            'sender'       : ('DOD Reporter', 'dod@example.com'),
+            'recipients'   : [ ('Ops', 'ops@example.com'), ('Refused', 'refused@example.com') ],
+            'subject'      : f"[BACKUP] ⚠️ Test message {i} – ümlauts",
+            'message_text' : f"Message {i}\n.\n..leading dots\n.\nend\n",
+            'attachments'  : { 'small.txt' : f"small attachment {i}\n".encode(), 'large.bin' : attachment_path },
+            'compress'     : 'gzip',
+            'compress_threshold' : 1024,
+            }
+
+def check_message(kwargs, received, large):
+    """Compare a received message with the sendMessage() arguments, returns
+    a list of problems."""
+    sender, recipients, data = received
+    message  = email.message_from_bytes(data, policy = email.policy.default)
+    problems = []
+    if sender != kwargs['sender'][1] or recipients != [ 'ops@example.com' ]:
+        problems.append(f"envelope {sender} -> {recipients}")
+    if message['Subject'] != kwargs['subject']:
+        problems.append(f"subject {message['Subject']!r}")
+    parts = list(message.iter_parts())
+    if parts[0].get_content().replace('\r\n', '\n') != kwargs['message_text']:
+        problems.append(f"body {parts[0].get_content()!r}")
+    attachments = { part.get_filename() : part.get_content() for part in parts[1:] }
+    if attachments.get('small.txt') != kwargs['attachments']['small.txt']:
+        problems.append("small attachment")
+    if 'large.bin.gz' not in attachments or gzip.decompress(attachments['large.bin.gz']) != large:
+        problems.append("large attachment")
+    return problems
+
+def run(args, attachment_path, large):
+    """Send the test messages, returns the results."""
+    recorder = SMTPRecorder(drop_after = 3)
+    client   = SMTPClient(hostname = '127.0.0.1', port = recorder.server_address[1], user = USER, password = PASSWORD,
+                    pool_size = 2, max_idle = 3600)
+    send     = client.sendMessage
+    problems = []
+
+    # Direct sends, every third one finds its session dropped
+    sent  = [ make_message(i, attachment_path) for i in range(6) ]
+    start = time.perf_counter()
+    for kwargs in sent:
+        send(**kwargs)
+    direct_s = time.perf_counter() - start
+    for i, (kwargs, received) in enumerate(zip(sent, recorder.received)):
+        problems += [ f"message {i}: {problem}" for problem in check_message(kwargs, received, large) ]
+    if len(recorder.received) != len(sent):
+        problems.append(f"{len(recorder.received)} of {len(sent)} messages received")
+
+    try:
+        send(**dict(sent[0], recipients = [ ('Refused', 'refused@example.com') ]))
+        problems.append("refused recipient did not raise")
+    except smtplib.SMTPRecipientsRefused:
+        pass
+
+    # A burst through the mail queue
+    recorder.received.clear()
+    with tempfile.TemporaryDirectory() as spool:
+        queue = MailQueue(client, spool)
+        queue.start()
+        start = time.perf_counter()
+        for i in range(args.messages):
+            queue.put(**dict(make_message(i, attachment_path), subject = f"burst {i}"))
+        while queue.stats()['delivered'] + queue.stats()['failed'] < args.messages and time.perf_counter() - start < 60:
+            time.sleep(0.01)
+        burst_s = time.perf_counter() - start
+        queue.shutdown()
+        stats = queue.stats()
+    subjects = sorted(email.message_from_bytes(data, policy = email.policy.default)['Subject'] for _, _, data in recorder.received)
+    if subjects != sorted(f"burst {i}" for i in range(args.messages)):
+        problems.append(f"burst: {len(subjects)} of {args.messages} messages received, {len(set(subjects))} distinct")
+
+    client.close()
+    recorder.shutdown()
+    return {
+            'direct_send_ms'  : round(direct_s / len(sent) * 1000, 2),
+            'burst_messages'  : args.messages,
+            'burst_msgs_per_s': round(args.messages / burst_s, 1),
+            'delivered'       : stats['delivered'],
+            'failed'          : stats['failed'],
+            'connections'     : recorder.connections,
+            'problems'        : problems,
+            }
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--messages', type = int, default = 50, help = 'messages of the mail queue burst')
+    parser.add_argument('--attachment-size', type = int, default = 1 << 20, help = 'size of the path attachment in bytes')
+    args = parser.parse_args()
+
+    log.configure(level = 'error')
+    with tempfile.TemporaryDirectory() as tmp:
+        # Compressible, but not trivially
+        large = b''.join(f"{i:08d} {os.urandom(8).hex()}\n".encode() for i in range(args.attachment_size // 26 + 1))[:args.attachment_size]
+        attachment_path = os.path.join(tmp, 'large.bin')
+        with open(attachment_path, 'wb') as outfile:
+            outfile.write(large)
+        result = run(args, attachment_path, large)
+    print(json.dumps(result, indent = 2))
+    sys.exit(1 if result['problems'] else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Measure the startup cost of dod_reporter: the import time of the package
+as reported by 'python -X importtime', and the time to load a configuration
+with many host sections with and without the settings cache.
+
+The benchmark fails with exit code 1 if one of the heavy modules that are
+meant to be imported lazily is imported by 'import dodreporter'.
+
+Usage: python benchmarks/startup.py [--hosts N] [--rounds N]"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Import the package from the checkout, it does not need to be installed
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC)
+
+from dodreporter import config
+
+####################################################################################################
+
+# Modules that must not be imported by 'import dodreporter'
+LAZY_MODULES = [ 'email', 'smtplib', 'ssl', 'sqlite3', 'multiprocessing', 'configparser', 'concurrent.futures' ]
+
+def import_time():
+    """Import dodreporter in a fresh interpreter. Returns the cumulative
+    import time in microseconds and the set of imported modules."""
+    env  = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None, [ SRC, os.environ.get('PYTHONPATH') ])))
+    proc = subprocess.run([ sys.executable, '-X', 'importtime', '-c', 'import dodreporter' ],
+            capture_output = True, text = True, check = True, env = env)
+    modules, total = set(), None
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        if name.strip() == 'dodreporter':
+            total = int(cumulative)
+    return total, modules
+
+def write_config(directory, hosts):
+    """Write a configuration with 'hosts' host sections, split into files of
+    1000 sections in the configuration directory."""
+    config_file = os.path.join(directory, 'dod_reporter.conf')
+    config_dir  = os.path.join(directory, 'dod_reporter.conf.d')
+    os.makedirs(config_dir)
+    with open(config_file, 'w') as outfile:
+        outfile.write("[General]\nrecipients = Admin <admin@example.com>\nsmtpfrom = DOD <dod@example.com>\n")
+    for i in range(hosts):
+        with open(os.path.join(config_dir, f"{i // 1000:04d}.conf"), 'a') as outfile:
+            outfile.write(f"[host{i}]\nDirectory = /backup/host{i}\nRecipients = Host {i} <host{i}@example.com>\n")
+    return config_file, config_dir
+
+def load_time(config_file, config_dir, cache_file):
+    """Return the seconds taken by get_config()."""
+    start = time.perf_counter()
+    config.get_config(config_file, config_dir, cache_file)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--hosts', type = int, default = 5000, help = 'number of host sections')
+    parser.add_argument('--rounds', type = int, default = 5, help = 'number of measurements')
+    args = parser.parse_args()
+
+    imports = [ import_time() for _ in range(args.rounds) ]
+    eager   = sorted(m for m in LAZY_MODULES if m in imports[0][1])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file, config_dir = write_config(tmp, args.hosts)
+        cache_file = os.path.join(tmp, 'cache', 'config.cache')
+        uncached   = [ load_time(config_file, config_dir, None) for _ in range(args.rounds) ]
+        load_time(config_file, config_dir, cache_file)
+        cached     = [ load_time(config_file, config_dir, cache_file) for _ in range(args.rounds) ]
+
+    results = {
+            'import_ms'          : statistics.median(total for total, _ in imports) / 1000,
+            'eager_heavy_modules': eager,
+            'hosts'              : args.hosts,
+            'config_parse_ms'    : statistics.median(uncached) * 1000,
+            'config_cached_ms'   : statistics.median(cached) * 1000,
+            }
+    print(json.dumps(results, indent = 2))
+    sys.exit(1 if eager else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,715 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+import base64
+import gzip
+import hmac
+import http.client
+import io
+import itertools
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+
+####################################################################################################
+
+from dodreporter import log, fsutil, Metrics
+from dodreporter.error import DODReporterError
+from dodreporter.runners.DODHostRunner import DODHostResult
+
+####################################################################################################
+
+# Version of the wire format, the aggregator rejects batches of other versions
+PROTOCOL = 1
+
+# Path the agents post their batches to
+PATH = '/v1/records'
+
+# Records per request, records kept while the aggregator is unreachable and
+# record identifiers remembered for deduplication, for SEEN_TTL seconds
+MAX_BATCH   = 500
+MAX_PENDING = 10000
+MAX_SEEN    = 100000
+SEEN_TTL    = 7 * 86400
+
+# Replies to a batch that one of its records may have caused. The agent
+# bisects the batch to find the record, and drops it after MAX_REJECTS
+# attempts.
+REJECTED    = (413, 422, 500)
+MAX_REJECTS = 10
+
+# Fields of the records received from the agents. Messages are limited to
+# these arguments of DODReporter.smtp_send(), e.g. senders and blind copies
+# are up to the aggregator.
+RESULT_KEYS  = { 'host', 'recipients', 'status', 'summary', 'details', 'metrics', 'attachments' }
+MESSAGE_KEYS = { 'recipients', 'subject', 'message_text', 'compress', 'compress_threshold', 'attachment_compress' }
+
+# Request bodies up to this size are assembled in memory, larger ones on disk
+SPOOL_MAX_SIZE = 1 << 20
+
+# Attachments are base64 encoded in chunks of this many bytes, a multiple of 3
+ENCODE_CHUNK = 57 * 1024
+
+# Scopes of the pending record index of the agent and of the record
+# identifiers seen by the aggregator in the state store
+PENDING_SCOPE = 'agent.pending'
+SEEN_SCOPE    = 'aggregator.seen'
+
+AGENT_PUSHED          = Metrics.counter('dod_agent_records_pushed_total', 'Records acknowledged by the aggregator')
+AGENT_PUSH_FAILURES   = Metrics.counter('dod_agent_push_failures_total', 'Failed pushes to the aggregator')
+AGGREGATOR_RECORDS    = Metrics.counter('dod_aggregator_records_total', 'Records received from the agents', ('node', 'kind'))
+AGGREGATOR_DUPLICATES = Metrics.counter('dod_aggregator_duplicates_total', 'Records received more than once', ('node',))
+
+####################################################################################################
+
+def _decode_attachments(attachments):
+    return { fname : base64.b64decode(data) for fname, data in attachments.items() }
+
+def _check_record(record):
+    """Raise ValueError if a record received from an agent is malformed."""
+    if not isinstance(record, dict) or not all(isinstance(record.get(key), str) for key in ('id', 'node', 'kind')):
+        raise ValueError("record without id, node or kind")
+    if not isinstance(record.get('attachments', {}), dict):
+        raise ValueError(f"record '{record['id']}' has malformed attachments")
+    if record['kind'] == 'result':
+        if not RESULT_KEYS <= record.keys() or record['status'] not in DODHostResult.ICONS:
+            raise ValueError(f"result '{record['id']}' is incomplete")
+        recipients = record['recipients']
+        settings   = [ (record.get('compress'), record.get('compress_threshold')) ]
+    elif record['kind'] == 'message':
+        message = record.get('message')
+        if not isinstance(message, dict) or not { 'recipients', 'subject', 'message_text' } <= message.keys() <= MESSAGE_KEYS:
+            raise ValueError(f"message '{record['id']}' has missing or unexpected fields")
+        if not isinstance(message['subject'], str) or not isinstance(message['message_text'], str):
+            raise ValueError(f"message '{record['id']}' has a malformed subject or text")
+        recipients = message['recipients']
+        overrides  = message.get('attachment_compress') or {}
+        if not isinstance(overrides, dict) or not all(isinstance(s, list) and len(s) == 2 for s in overrides.values()):
+            raise ValueError(f"message '{record['id']}' has malformed compression settings")
+        settings   = [ (message.get('compress'), message.get('compress_threshold')) ] + list(overrides.values())
+    else:
+        return
+    for compress, threshold in settings:
+        if compress not in (None, 'none', 'gzip', 'xz') or not (threshold is None or type(threshold) is int):
+            raise ValueError(f"record '{record['id']}' has malformed compression settings")
+    if not isinstance(recipients, list) or not all(isinstance(r, list) and len(r) == 2 and isinstance(r[1], str) for r in recipients):
+        raise ValueError(f"record '{record['id']}' has malformed recipients")
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix domain socket."""
+
+    def __init__(self, path, timeout):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout = timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a unix domain socket."""
+
+    daemon_threads = True
+
+    def server_bind(self):
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+        socketserver.UnixStreamServer.server_bind(self)
+
+####################################################################################################
+
+class Agent(threading.Thread):
+    """Pushes the host results and messages of this node to the aggregator
+    instead of mailing them.
+
+    Records are spooled like the messages of the mail queue: every record
+    is a file in the spool directory, its attachments are files next to it
+    unless they were given by path, and the state store holds the index of
+    the records that the aggregator has not acknowledged yet. The spool thus
+    survives a restart and an unreachable aggregator at a constant cost per
+    record. Records are pushed as gzip compressed JSON batches when flush()
+    is called, i.e. once a batch of host checks completed, or right away for
+    messages. A batch is rendered into a spooled temporary file and the
+    attachments are base64 encoded into it in chunks, so memory use does not
+    depend on their size."""
+
+    def __init__(self, node, endpoint, store, spool_dir, token = None, timeout = 60, retry_min = 30, retry_max = 3600,
+            max_body = 64 << 20):
+        """Construct a new Agent object.
+
+        Parameters:
+        node:      Name of this node
+        endpoint:  Tuple ('tcp', (address, port)) or ('unix', path) of the aggregator
+        store:     StateStore holding the index of the pending records
+        spool_dir: Directory for the pending records and their attachments
+        token:     Shared secret sent to the aggregator, None for none
+        timeout:   Socket timeout in seconds
+        retry_min: Delay in seconds before the first retry
+        retry_max: Upper bound for the retry delay in seconds
+        max_body:  Largest request the aggregator accepts, batches are split
+                   to stay below"""
+
+        threading.Thread.__init__(self, name = 'agent')
+        self.node       = node
+        self.endpoint   = endpoint
+        self.store      = store
+        self.spool_dir  = spool_dir
+        self.token      = token
+        self.timeout    = timeout
+        self.retry_min  = retry_min
+        self.retry_max  = retry_max
+        self.max_body   = max_body
+        self.__cond     = threading.Condition()
+        self.__seq      = itertools.count()
+        self.__due      = False
+        self.__stopping = False
+        try:
+            os.makedirs(spool_dir, exist_ok = True)
+        except OSError as e:
+            raise DODReporterError(f"Cannot create agent spool directory '{spool_dir}': {e}")
+        self.__pending  = self.__recover()
+
+    def __path(self, ident):
+        return os.path.join(self.spool_dir, ident + '.rec')
+
+    def __recover(self):
+        """Return the identifiers of the records left pending by a previous
+        run. Spool files without an index entry belong to a record whose
+        spooling was interrupted and are removed."""
+        pending = []
+        for ident in self.store.keys(PENDING_SCOPE):
+            if os.path.exists(self.__path(ident)):
+                pending.append(ident)
+            else:
+                self.store.set(PENDING_SCOPE, ident, None)
+        self.store.flush()
+        indexed = set(pending)
+        for fname in os.listdir(self.spool_dir):
+            if fname.split('.', 1)[0] not in indexed:
+                os.unlink(os.path.join(self.spool_dir, fname))
+        if pending:
+            log.log(f"[agent] Recovered {len(pending)} pending record(s).")
+        return pending
+
+    def __remove(self, ident):
+        """Remove a record and the attachment files created for it."""
+        path = self.__path(ident)
+        try:
+            with open(path) as infile:
+                owned = json.load(infile).get('owned', [])
+        except (OSError, ValueError):
+            owned = []
+        for fpath in owned + [ path ]:
+            try:
+                os.unlink(fpath)
+            except FileNotFoundError:
+                pass
+
+    @property
+    def pending(self):
+        """Number of records not yet acknowledged by the aggregator."""
+        return len(self.__pending)
+
+    def __add(self, record, attachments, due):
+        """Spool a record, then add it to the index."""
+        ident = f"{time.time_ns():020d}-{next(self.__seq):06d}"
+        record.update(id = f"{self.node}:{ident}", node = self.node, ts = time.time())
+        record['attachments'], record['owned'] = fsutil.spool_attachments(attachments, self.spool_dir, ident)
+        fsutil.write_atomic(self.__path(ident), json.dumps(record))
+
+        dropped = None
+        with self.__cond:
+            self.__pending.append(ident)
+            self.store.set(PENDING_SCOPE, ident, record['ts'])
+            if len(self.__pending) > MAX_PENDING:
+                dropped = self.__pending.pop(0)
+                self.store.set(PENDING_SCOPE, dropped, None)
+            self.__due = self.__due or due or len(self.__pending) >= MAX_BATCH
+            self.__cond.notify()
+        self.store.flush()
+        if dropped:
+            log.log(f"[agent] Aggregator unreachable, dropping the oldest of {MAX_PENDING} pending records.", level = log.ERROR)
+            self.__remove(dropped)
+
+    def add_result(self, recipients, host, result, compress = None, compress_threshold = None):
+        """Queue the DODHostResult of a host check, the arguments are those
+        of Digest.add()."""
+        self.__add({
+            'kind'        : 'result',
+            'host'        : host,
+            'recipients'  : recipients,
+            'status'      : result.status,
+            'summary'     : result.summary,
+            'details'     : result.details,
+            'metrics'     : result.metrics,
+            'compress'    : compress,
+            'compress_threshold' : compress_threshold }, result.attachments, due = False)
+
+    def add_message(self, recipients, subject, message_text, attachments = {}, **kwargs):
+        """Queue a message, the arguments are those of DODReporter.smtp_send()."""
+        kwargs.update(
+                recipients   = recipients if isinstance(recipients, list) else [ recipients ],
+                subject      = subject,
+                message_text = message_text)
+        self.__add({ 'kind' : 'message', 'message' : kwargs }, attachments, due = True)
+
+    def flush(self, *_):
+        """Push the pending records. Accepts and ignores the batch time
+        passed by the Scheduler."""
+        with self.__cond:
+            self.__due = True
+            self.__cond.notify()
+
+    def __render(self, idents):
+        """Render the request body for the records 'idents' into a spooled
+        temporary file. Records are added until the next one would exceed
+        max_body, but at least one. Returns the file, its size, the size of
+        its decompressed content and the identifiers of the records it holds.
+        Records that cannot be read are dropped."""
+
+        out     = tempfile.SpooledTemporaryFile(max_size = SPOOL_MAX_SIZE)
+        batch   = []
+        written = 0
+        with gzip.GzipFile(fileobj = out, mode = 'wb', compresslevel = 6) as body:
+            def write(text):
+                nonlocal written
+                data = text.encode('utf-8') if isinstance(text, str) else text
+                body.write(data)
+                written += len(data)
+
+            write(f'{{"protocol": {PROTOCOL}, "node": {json.dumps(self.node)}, "records": [')
+            for ident in idents:
+                try:
+                    with open(self.__path(ident)) as infile:
+                        record = json.load(infile)
+                except (OSError, ValueError) as e:
+                    log.log(f"[agent] Dropping unreadable record '{ident}': {e}", level = log.ERROR)
+                    self.__ack([ ident ])
+                    continue
+                attachments = record.pop('attachments')
+                record.pop('owned', None)
+                head = json.dumps(record)[:-1]
+                sizes = {}
+                for fname, path in attachments.items():
+                    try:
+                        sizes[fname] = os.stat(path).st_size
+                    except FileNotFoundError:
+                        log.log(f"[agent] Attachment '{path}' of record '{ident}' vanished, pushing the record without it.", level = log.WARNING)
+                if batch and written + len(head) + sum(4 * (size + 2) // 3 for size in sizes.values()) > self.max_body:
+                    break
+
+                write((', ' if batch else '') + head + ', "attachments": {')
+                for i, fname in enumerate(sizes):
+                    write((', ' if i else '') + json.dumps(fname) + ': "')
+                    with open(attachments[fname], 'rb') as infile:
+                        while chunk := infile.read(ENCODE_CHUNK):
+                            write(base64.b64encode(chunk))
+                    write('"')
+                write('}}')
+                batch.append(ident)
+            write(']}')
+        size = out.tell()
+        out.seek(0)
+        return out, size, written, batch
+
+    def __post(self, body, size):
+        """Post a request body, returns the HTTP status and the reply."""
+        kind, address = self.endpoint
+        if kind == 'unix':
+            connection = _UnixHTTPConnection(address, self.timeout)
+        else:
+            connection = http.client.HTTPConnection(*address, timeout = self.timeout)
+        headers = { 'Content-Type' : 'application/json', 'Content-Encoding' : 'gzip', 'Content-Length' : str(size) }
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        error = None
+        try:
+            try:
+                connection.request('POST', PATH, body, headers)
+            except OSError as e:
+                # The aggregator may have rejected the request before reading
+                # it, its reply tells why
+                error = e
+            try:
+                response = connection.getresponse()
+            except (OSError, http.client.HTTPException):
+                if error:
+                    raise error from None
+                raise
+            return response.status, response.read()[:200].decode('utf-8', 'replace')
+        finally:
+            connection.close()
+
+    def __ack(self, idents):
+        """Remove records from the spool and the index."""
+        done = set(idents)
+        with self.__cond:
+            self.__pending = [ ident for ident in self.__pending if ident not in done ]
+            for ident in idents:
+                self.store.set(PENDING_SCOPE, ident, None)
+            self.__due = self.__due and len(self.__pending) > 0
+        self.store.flush()
+        for ident in idents:
+            self.__remove(ident)
+
+    def run(self):
+        """Overrides Thread.run(). Pushes the pending records whenever they
+        are due until shutdown() is called, with exponential backoff while
+        the aggregator is unreachable. Pending records get one last push at
+        shutdown."""
+
+        failures = 0
+        limit    = MAX_BATCH
+        rejects  = {}
+        while True:
+            with self.__cond:
+                while not (self.__due and self.__pending) and not self.__stopping:
+                    self.__cond.wait()
+                if not self.__pending:
+                    return
+                idents = self.__pending[:limit]
+            try:
+                body, size, length, batch = self.__render(idents)
+                if not batch:
+                    continue
+                with body:
+                    if len(batch) == 1 and max(size, length) > self.max_body:
+                        status, reply = 413, "record exceeds the request size limit"
+                    else:
+                        status, reply = self.__post(body, size)
+                if status in REJECTED and len(batch) > 1:
+                    # Retry with halves until the offending record is alone
+                    limit = len(batch) // 2
+                    log.log(f"[agent] Aggregator rejected a batch of {len(batch)} records ({status}), retrying with {limit}.", level = log.WARNING)
+                    continue
+                if status in REJECTED:
+                    rejects[batch[0]] = rejects.get(batch[0], 0) + 1
+                    # A failure of the aggregator may be temporary, a record
+                    # it cannot parse or accept is not
+                    if status != 500 or rejects[batch[0]] >= MAX_REJECTS:
+                        log.log(f"[agent] Dropping record '{batch[0]}', the aggregator rejected it ({status}): {reply}", level = log.ERROR)
+                        del rejects[batch[0]]
+                        self.__ack(batch)
+                        continue
+                if status != 200:
+                    raise DODReporterError(f"Aggregator replied {status}: {reply}")
+            except (OSError, http.client.HTTPException, DODReporterError) as e:
+                failures += 1
+                AGENT_PUSH_FAILURES.inc()
+                delay = min(self.retry_min * 2 ** (failures - 1), self.retry_max)
+                log.log(f"[agent] Push of {len(idents)} record(s) failed (attempt {failures}), retrying in {delay}s: {e}", level = log.WARNING)
+                with self.__cond:
+                    if self.__stopping:
+                        return
+                    self.__cond.wait(delay)
+                continue
+            failures = 0
+            limit    = min(limit * 2, MAX_BATCH)
+            for ident in batch:
+                rejects.pop(ident, None)
+            AGENT_PUSHED.inc(len(batch))
+            self.__ack(batch)
+            log.log(f"[agent] Pushed {len(batch)} record(s) to the aggregator.")
+
+    def shutdown(self):
+        """Push the pending records a last time and stop. Can be called
+        multiple times."""
+        with self.__cond:
+            self.__stopping = True
+            self.__due      = True
+            self.__cond.notify()
+        if self.is_alive():
+            self.join()
+
+####################################################################################################
+
+class Aggregator(threading.Thread):
+    """Receives the records of the agents on an HTTP listener. Records are
+    deduplicated by their identifier, since agents push again if an
+    acknowledgement got lost. Host results go to the digest of the managing
+    reporter, and thereby into one combined report per recipient across all
+    nodes. Results of the same host from several nodes replace each other.
+    Messages go to the mail queue, hence the aggregator holds the only SMTP
+    connection.
+
+    A batch is acknowledged only once its records are persisted: messages in
+    the mail spool, results in the spool directory of the aggregator, from
+    where they are removed once the digest holding them was handed to the
+    mail queue. Results received before a restart are sent with the next
+    digest.
+
+    The digest is sent 'window' seconds after the first result of a round
+    arrived, so that the results of nodes that finish later are included."""
+
+    def __init__(self, reporter, endpoint, spool_dir, token = None, window = 300, max_body = 64 << 20):
+        """Construct a new Aggregator object.
+
+        Parameters:
+        reporter:  The managing DODReporter instance, digest mode is required
+        endpoint:  Tuple ('tcp', (address, port)) or ('unix', path) to listen on
+        spool_dir: Directory for the received results
+        token:     Shared secret expected from the agents, required on TCP
+        window:    Seconds to wait for further results before the digest is sent
+        max_body:  Largest request accepted, compressed and decompressed"""
+
+        if endpoint[0] == 'tcp' and not token:
+            raise DODReporterError("The aggregator requires a token to listen on TCP, set 'aggregatortoken'")
+        threading.Thread.__init__(self, name = 'aggregator')
+        self.reporter   = reporter
+        self.spool_dir  = spool_dir
+        self.token      = token
+        self.window     = window
+        self.max_body   = max_body
+        self.__cond     = threading.Condition()
+        self.__deadline = None
+        self.__stopping = False
+        self.__spooled  = []
+        self.__seen     = OrderedDict(sorted(reporter.state.items(SEEN_SCOPE).items(), key = lambda item : item[1]))
+        try:
+            os.makedirs(spool_dir, exist_ok = True)
+        except OSError as e:
+            raise DODReporterError(f"Cannot create aggregator spool directory '{spool_dir}': {e}")
+        self.__recover()
+        self.__server   = self.__make_server(endpoint)
+        self.__serving  = None
+
+    def __recover(self):
+        """Add the results spooled by a previous run to the digest."""
+        recovered = 0
+        for fname in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, fname)
+            if fname.endswith('.tmp'):
+                os.unlink(path)
+                continue
+            try:
+                with open(path) as infile:
+                    self.__add_result(json.load(infile), path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                log.log(f"[aggregator] Dropping unreadable result '{fname}': {e}", level = log.ERROR)
+                os.unlink(path)
+                continue
+            recovered += 1
+        if recovered:
+            log.log(f"[aggregator] Recovered {recovered} result(s) received before the restart.")
+            self.schedule_flush()
+
+    def __make_server(self, endpoint):
+        """Create the HTTP server for the agents."""
+        aggregator = self
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                if self.path != PATH:
+                    return self.reply(404, { 'error' : 'not found' })
+                if aggregator.token and not hmac.compare_digest(self.headers.get('Authorization', ''), f"Bearer {aggregator.token}"):
+                    return self.reply(401, { 'error' : 'unauthorized' })
+                try:
+                    length = int(self.headers['Content-Length'])
+                except (TypeError, ValueError):
+                    self.close_connection = True
+                    return self.reply(411, { 'error' : 'length required' })
+                if length > aggregator.max_body:
+                    # The body is not read, the connection cannot be reused
+                    self.close_connection = True
+                    return self.reply(413, { 'error' : f"request exceeds {aggregator.max_body} bytes" })
+                try:
+                    body = self.rfile.read(length)
+                    if self.headers.get('Content-Encoding') == 'gzip':
+                        with gzip.GzipFile(fileobj = io.BytesIO(body)) as infile:
+                            body = infile.read(aggregator.max_body + 1)
+                    if len(body) > aggregator.max_body:
+                        return self.reply(413, { 'error' : f"request exceeds {aggregator.max_body} bytes" })
+                    batch = json.loads(body)
+                    if batch.get('protocol') != PROTOCOL:
+                        return self.reply(400, { 'error' : f"unsupported protocol {batch.get('protocol')}" })
+                    records = batch['records']
+                    if not isinstance(records, list):
+                        raise ValueError("records are not a list")
+                except (ValueError, KeyError, TypeError, AttributeError, OSError, EOFError) as e:
+                    return self.reply(400, { 'error' : str(e) })
+                try:
+                    for record in records:
+                        _check_record(record)
+                except ValueError as e:
+                    return self.reply(422, { 'error' : str(e) })
+                try:
+                    accepted, duplicates = aggregator.receive(records)
+                except Exception as e:
+                    log.log(f"[aggregator] Cannot accept records from node '{batch.get('node')}': {e!r}", level = log.ERROR)
+                    return self.reply(500, { 'error' : str(e) })
+                self.reply(200, { 'accepted' : accepted, 'duplicates' : duplicates })
+
+            def log_message(self, *args):
+                pass
+
+        kind, address = endpoint
+        try:
+            if kind == 'unix':
+                return _UnixHTTPServer(address, Handler)
+            server = ThreadingHTTPServer(address, Handler)
+        except OSError as e:
+            raise DODReporterError(f"Cannot listen on {address} for the agents: {e}")
+        server.daemon_threads = True
+        return server
+
+    def __add_result(self, record, path):
+        """Add a spooled result record to the digest."""
+        result = DODHostResult(record['status'], record['summary'], record['details'],
+                attachments = _decode_attachments(record['attachments']),
+                metrics     = record['metrics'])
+        # Together, so a flush takes the result and its spool file or neither
+        with self.__cond:
+            self.reporter.digest.add([ tuple(r) for r in record['recipients'] ], record['host'], result,
+                    record.get('compress'), record.get('compress_threshold'))
+            self.__spooled.append(path)
+
+    def __dispatch(self, record):
+        """Persist and dispatch a record, returns whether it was accepted."""
+        if record['kind'] == 'result':
+            path = os.path.join(self.spool_dir, quote(record['id'], safe = '') + '.json')
+            fsutil.write_atomic(path, json.dumps(record))
+            self.__add_result(record, path)
+            self.schedule_flush()
+        elif record['kind'] == 'message':
+            message = { key : value for key, value in record['message'].items() if key in MESSAGE_KEYS }
+            message['recipients']  = [ tuple(r) for r in message['recipients'] ]
+            message['attachments'] = _decode_attachments(record.get('attachments', {}))
+            # Spooled by the mail queue before smtp_send() returns
+            self.reporter.smtp_send(**message)
+        else:
+            log.log(f"[aggregator] Ignoring record of unknown kind '{record['kind']}' from node '{record['node']}'.", level = log.WARNING)
+            return False
+        AGGREGATOR_RECORDS.inc(1, (record['node'], record['kind']))
+        return True
+
+    def receive(self, records):
+        """Persist and dispatch the records of an agent batch. Returns the
+        numbers of accepted and duplicate records. If a record cannot be
+        persisted, it and the following records are forgotten, so the agent
+        pushes them again."""
+        now = time.time()
+        duplicates, fresh = 0, []
+        with self.__cond:
+            for record in records:
+                if record['id'] in self.__seen:
+                    duplicates += 1
+                    AGGREGATOR_DUPLICATES.inc(1, (record['node'],))
+                    continue
+                self.__seen[record['id']] = now
+                fresh.append(record)
+
+        # One row per identifier, so a batch writes only its own records
+        store    = self.reporter.state
+        accepted = 0
+        try:
+            for n, record in enumerate(fresh):
+                accepted += self.__dispatch(record)
+                store.set(SEEN_SCOPE, record['id'], now)
+        except BaseException:
+            with self.__cond:
+                for failed in fresh[n:]:
+                    self.__seen.pop(failed['id'], None)
+            raise
+        finally:
+            with self.__cond:
+                while self.__seen and (len(self.__seen) > MAX_SEEN or next(iter(self.__seen.values())) < now - SEEN_TTL):
+                    store.set(SEEN_SCOPE, self.__seen.popitem(last = False)[0], None)
+            store.flush()
+        if fresh:
+            log.log(f"[aggregator] Received {accepted} record(s) from node '{fresh[0]['node']}', {duplicates} duplicate(s).")
+        return accepted, duplicates
+
+    def schedule_flush(self):
+        """Send the digest once the aggregation window has passed."""
+        with self.__cond:
+            if self.__deadline is None:
+                self.__deadline = time.monotonic() + self.window
+                self.__cond.notify()
+
+    def __flush(self):
+        """Send the digest, then remove the spooled results it holds. If
+        sending fails, the results are collected again and sent with the
+        next window, and remain spooled meanwhile."""
+        digest = self.reporter.digest
+        with self.__cond:
+            spooled, self.__spooled = self.__spooled, []
+            names, items = digest.take()
+        try:
+            digest.send(names, items)
+        except Exception as e:
+            log.log(f"[aggregator] Cannot send the digest, retrying in {self.window}s: {e!r}", level = log.ERROR)
+            with self.__cond:
+                digest.restore(names, items)
+                self.__spooled = spooled + self.__spooled
+            self.schedule_flush()
+            return
+        for path in spooled:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def run(self):
+        """Overrides Thread.run(). Serves the agents and sends the digest at
+        the end of every aggregation window until shutdown() is called."""
+
+        self.__serving = threading.Thread(target = self.__server.serve_forever, name = 'aggregator-http', daemon = True)
+        self.__serving.start()
+        while True:
+            with self.__cond:
+                while not self.__stopping and (self.__deadline is None or self.__deadline > time.monotonic()):
+                    self.__cond.wait(None if self.__deadline is None else self.__deadline - time.monotonic())
+                if self.__stopping:
+                    return
+                self.__deadline = None
+            self.__flush()
+
+    def shutdown(self):
+        """Stop serving and send what was collected. Can be called multiple
+        times."""
+        with self.__cond:
+            if self.__stopping:
+                return
+            self.__stopping = True
+            self.__cond.notify()
+        if self.__serving:
+            self.__server.shutdown()
+        self.__server.server_close()
+        if self.is_alive():
+            self.join()
+        self.__flush()
@@ -0,0 +1,140 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+####################################################################################################
+
+import socket
+import threading
+
+####################################################################################################
+
+from dodreporter import log
+from dodreporter.runners.DODHostRunner import DODHostResult
+
+####################################################################################################
+
+# Order in which host results are listed, most severe first
+SEVERITY = [ 'FAILED', 'TIMEOUT', 'WARNING', 'OK' ]
+
+class Digest:
+    """Collects host check results and sends one combined report per
+    recipient address instead of one mail per host. The attachments of a
+    host are compressed according to the settings of that host."""
+
+    def __init__(self, reporter):
+        """Construct a new Digest object.
+
+        Parameters:
+        reporter: The managing DODReporter instance"""
+
+        self.reporter = reporter
+        self.__lock   = threading.Lock()
+        self.__names  = {}
+        self.__items  = {}
+        self.__compress = {}
+
+    @staticmethod
+    def normalize(recipient):
+        """Return the key identifying a parsed (name, address) tuple. Local
+        parts are case sensitive in theory, but not in practice."""
+        return recipient[1].strip().lower()
+
+    def add(self, recipients, host, result, compress = None, compress_threshold = None):
+        """Add a host result to the digests of all its recipients.
+
+        Parameters:
+        recipients: List of parsed (name, address) tuples
+        host:       The name of the host section
+        result:     The DODHostResult
+        compress:   Compression of the host's attachments, None for the
+                    global setting
+        compress_threshold: Size in bytes above which the host's attachments
+                    are compressed, None for the global setting"""
+
+        with self.__lock:
+            self.__compress[host] = (compress, compress_threshold)
+            for recipient in recipients:
+                key = self.normalize(recipient)
+                if not self.__names.get(key):
+                    self.__names[key] = recipient[0]
+                self.__items.setdefault(key, {})[host] = result
+
+    def take(self):
+        """Return the collected digests as a tuple (names, items) and start
+        over."""
+        with self.__lock:
+            names, items = self.__names, self.__items
+            self.__names, self.__items = {}, {}
+        return names, items
+
+    def restore(self, names, items):
+        """Collect digests returned by take() again, e.g. because sending
+        them failed. Results collected in the meantime take precedence."""
+        with self.__lock:
+            for key, results in items.items():
+                self.__names.setdefault(key, names[key])
+                self.__items[key] = { **results, **self.__items.get(key, {}) }
+
+    def flush(self, *_):
+        """Send the collected digests and start over. Accepts and ignores the
+        batch time passed by the Scheduler."""
+        self.send(*self.take())
+
+    def send(self, names, items):
+        """Send digests returned by take()."""
+        with self.__lock:
+            compress = dict(self.__compress)
+        for key, results in items.items():
+            attachments, settings = {}, {}
+            for host, result in results.items():
+                for fname, data in result.attachments.items():
+                    attachments[f"{host}-{fname}"] = data
+                    if any(compress.get(host, ())):
+                        settings[f"{host}-{fname}"] = compress[host]
+            self.reporter.smtp_send(
+                    recipients = [ (names[key], key) ],
+                    subject = self.subject(results),
+                    message_text = self.render(results),
+                    attachments = attachments,
+                    attachment_compress = settings)
+        if items:
+            log.log(f"[digest] Sent digest to {len(items)} recipient(s).")
+
+    @staticmethod
+    def subject(results):
+        """Build the subject line of a digest."""
+        worst  = min((r.status for r in results.values()), key = SEVERITY.index)
+        counts = ', '.join(f"{sum(r.status == status for r in results.values())} {status}"
+                for status in SEVERITY if any(r.status == status for r in results.values()))
+        return f"[BACKUP][{socket.gethostname()}] {DODHostResult.ICONS[worst]} Backup report for {len(results)} host(s): {counts}"
+
+    @staticmethod
+    def render(results):
+        """Build the message text of a digest."""
+        hosts = sorted(results, key = lambda host : (SEVERITY.index(results[host].status), host))
+        width = max(len(host) for host in hosts)
+        lines = [ "Dear user,",
+                  "",
+                  f"the backup server '{socket.gethostname()}' reported the following results:",
+                  "" ]
+        lines += [ f"  {DODHostResult.ICONS[results[host].status]} {host:<{width}}  {results[host].summary}" for host in hosts ]
+        for host in hosts:
+            lines += [ "", "", f"=== {host}: {results[host].summary}", "", results[host].details ]
+        return '\n'.join(lines) + '\n'
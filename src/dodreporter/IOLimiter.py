@@ -0,0 +1,140 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+####################################################################################################
+
+import os
+import threading
+import time
+from datetime import datetime
+
+####################################################################################################
+
+from dodreporter import Metrics
+from dodreporter.error import DODCheckCancelled
+
+####################################################################################################
+
+FS_OPERATIONS = Metrics.counter('dod_fs_operations_total', 'Filesystem operations performed by the checks')
+FS_BYTES      = Metrics.counter('dod_fs_read_bytes_total', 'Bytes read by the checks')
+
+####################################################################################################
+
+class TokenBucket:
+    """Thread-safe token bucket. Requests larger than the available tokens
+    put the bucket into debt and the caller sleeps until it is paid off, so
+    requests of any size are admitted at the configured average rate. A
+    cancelled wait returns the tokens."""
+
+    def __init__(self, rate, burst = None):
+        """Construct a new TokenBucket object.
+
+        Parameters:
+        rate:  Tokens added per second
+        burst: Bucket capacity, defaults to one second worth of tokens"""
+
+        self.rate     = rate
+        self.capacity = burst or rate
+        self.__tokens = self.capacity
+        self.__stamp  = time.monotonic()
+        self.__lock   = threading.Lock()
+
+    def consume(self, amount, cancel = None):
+        """Take 'amount' tokens, waiting until the debt is paid off. Raises
+        DODCheckCancelled if the optional threading.Event 'cancel' is set
+        while waiting."""
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__stamp) * self.rate)
+            self.__stamp  = now
+            self.__tokens -= amount
+            delay = -self.__tokens / self.rate if self.__tokens < 0 else 0
+        if not delay:
+            return
+        if cancel is None:
+            time.sleep(delay)
+        elif cancel.wait(delay):
+            with self.__lock:
+                self.__tokens += amount
+            raise DODCheckCancelled("Rate limited wait cancelled")
+
+####################################################################################################
+
+class IOLimiter:
+    """Limits the I/O operations and bytes per second of filesystem access.
+
+    A limiter holds a normal and an optional strict profile, the latter
+    applies within a daily time window such as the nightly backup window.
+    A limiter without any limits never blocks."""
+
+    def __init__(self, iops = None, bps = None, strict_iops = None, strict_bps = None, strict_window = None):
+        """Construct a new IOLimiter object.
+
+        Parameters:
+        iops:          Operations per second, None for no limit
+        bps:           Bytes per second, None for no limit
+        strict_iops:   Operations per second within the strict window
+        strict_bps:    Bytes per second within the strict window
+        strict_window: Tuple of datetime.time (start, end), may wrap midnight"""
+
+        self.strict_window = strict_window
+        self.__normal = ( TokenBucket(iops) if iops else None, TokenBucket(bps) if bps else None )
+        self.__strict = ( TokenBucket(strict_iops) if strict_iops else None, TokenBucket(strict_bps) if strict_bps else None )
+
+    def __profile(self):
+        """Return the buckets that currently apply."""
+        if self.strict_window:
+            start, end = self.strict_window
+            now = datetime.now().time()
+            if (start <= now < end) if start <= end else (now >= start or now < end):
+                return self.__strict
+        return self.__normal
+
+    def acquire(self, ops = 1, nbytes = 0, cancel = None):
+        """Block until 'ops' operations and 'nbytes' bytes may be performed.
+        Raises DODCheckCancelled if the optional threading.Event 'cancel' is
+        set while waiting."""
+        FS_OPERATIONS.inc(ops)
+        if nbytes:
+            FS_BYTES.inc(nbytes)
+        iops, bps = self.__profile()
+        if iops and ops:
+            iops.consume(ops, cancel)
+        if bps and nbytes:
+            bps.consume(nbytes, cancel)
+
+    def scandir(self, path):
+        """Rate limited os.scandir()."""
+        self.acquire()
+        return os.scandir(path)
+
+    def stat(self, path, follow_symlinks = True):
+        """Rate limited os.stat()."""
+        self.acquire()
+        return os.stat(path, follow_symlinks = follow_symlinks)
+
+    def entry_stat(self, entry):
+        """Rate limited os.DirEntry.stat() without following symlinks."""
+        self.acquire()
+        return entry.stat(follow_symlinks = False)
+
+####################################################################################################
+
+UNLIMITED = IOLimiter()
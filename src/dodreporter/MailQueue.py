@@ -0,0 +1,308 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+####################################################################################################
+
+import heapq
+import itertools
+import json
+import os
+import smtplib
+import threading
+import time
+
+####################################################################################################
+
+from dodreporter import log, fsutil
+from dodreporter.error import DODReporterError
+
+####################################################################################################
+
+class MailQueueEntry:
+    """A queued outbound message together with its delivery state.
+    Attachments are always referenced by path; 'owned' lists the attachment
+    files that were created for the entry and are removed with it."""
+
+    def __init__(self, ident, created, kwargs, attempts = 0, owned = None):
+        self.ident    = ident
+        self.created  = created
+        self.kwargs   = kwargs
+        self.attempts = attempts
+        self.owned    = owned or []
+
+    def dumps(self):
+        """Serialize the entry for the spool directory."""
+        return json.dumps({ 'created' : self.created, 'attempts' : self.attempts, 'owned' : self.owned, 'kwargs' : self.kwargs })
+
+    @classmethod
+    def loads(cls, ident, text):
+        """Deserialize an entry read from the spool directory."""
+        data   = json.loads(text)
+        kwargs = data['kwargs']
+        # JSON has no tuples, restore the (name, address) pairs
+        kwargs['sender'] = tuple(kwargs['sender'])
+        if not kwargs['recipients'] or isinstance(kwargs['recipients'][0], list):
+            kwargs['recipients'] = [ tuple(r) for r in kwargs['recipients'] ]
+        else:
+            kwargs['recipients'] = tuple(kwargs['recipients'])
+        return cls(ident, data['created'], kwargs, data['attempts'], data.get('owned'))
+
+    def remove(self, failed_dir = None):
+        """Remove the owned attachment files, or move them to 'failed_dir'."""
+        for path in self.owned:
+            try:
+                if failed_dir:
+                    os.replace(path, os.path.join(failed_dir, os.path.basename(path)))
+                else:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.log(f"[mail_queue] Cannot remove attachment '{path}': {e}", level = log.WARNING)
+
+####################################################################################################
+
+class MailSpool:
+    """Outbound messages ordered by due time, together with the delivery
+    bookkeeping of the MailQueue thread. Messages are written to a spool directory before put()
+    returns, so they survive a restart. Failed deliveries are retried with
+    exponential backoff."""
+
+    def __init__(self, spool_dir = None, retry_min = 30, retry_max = 3600):
+        """Construct a new MailSpool object.
+
+        Parameters:
+        spool_dir:   Directory for the on-disk spool, None to queue in memory only
+        retry_min:   Delay in seconds before the first retry
+        retry_max:   Upper bound for the retry delay in seconds"""
+
+        self.spool_dir   = spool_dir
+        self.retry_min   = retry_min
+        self.retry_max   = retry_max
+        self.delivered   = 0
+        self.failed      = 0
+        self.last_latency = None
+        self.total_latency = 0.0
+        self._cond       = threading.Condition()
+        self._stopping   = False
+        self.__heap      = []
+        self.__seq       = itertools.count()
+
+        if self.spool_dir:
+            try:
+                os.makedirs(os.path.join(self.spool_dir, 'failed'), exist_ok = True)
+            except OSError as e:
+                raise DODReporterError(f"Cannot create mail spool directory '{self.spool_dir}': {e}")
+            self.__recover()
+
+    def __recover(self):
+        """Load messages left in the spool directory by a previous run."""
+        for fname in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, fname)
+            if fname.endswith('.tmp'):
+                # Incomplete write, the producer never returned
+                os.unlink(path)
+                # Attachment files of the incomplete entry are orphaned, too
+                for orphan in os.listdir(self.spool_dir):
+                    if orphan.startswith(fname[:-4] + '.') and orphan.endswith('.att'):
+                        os.unlink(os.path.join(self.spool_dir, orphan))
+            elif fname.endswith('.msg'):
+                ident = fname[:-4]
+                try:
+                    with open(path) as f:
+                        entry = MailQueueEntry.loads(ident, f.read())
+                except (OSError, ValueError, KeyError) as e:
+                    log.log(f"[mail_queue] Cannot read spooled message '{fname}': {e}", level = log.ERROR)
+                    os.replace(path, os.path.join(self.spool_dir, 'failed', fname))
+                    continue
+                heapq.heappush(self.__heap, (0, next(self.__seq), entry))
+        if self.__heap:
+            log.log(f"[mail_queue] Recovered {len(self.__heap)} spooled message(s).")
+
+    def __spool_path(self, entry, suffix = '.msg'):
+        return os.path.join(self.spool_dir, entry.ident + suffix)
+
+    def __write(self, entry):
+        """Atomically write an entry to the spool directory."""
+        fsutil.write_atomic(self.__spool_path(entry), entry.dumps(), self.__spool_path(entry, '.tmp'))
+
+    @property
+    def depth(self):
+        """Number of messages waiting for delivery."""
+        return len(self.__heap)
+
+    def stats(self):
+        """Return a dict with queue depth and delivery statistics."""
+        with self._cond:
+            return {
+                    'depth'        : len(self.__heap),
+                    'delivered'    : self.delivered,
+                    'failed'       : self.failed,
+                    'last_latency' : self.last_latency,
+                    'mean_latency' : self.total_latency / self.delivered if self.delivered else None,
+                    }
+
+    def __store_attachments(self, entry):
+        """Replace attachments given as bytes or file-like objects by files
+        next to the spooled entry, so retries and restarts can read them
+        again. Attachments given as paths are referenced as they are."""
+        attachments, owned = fsutil.spool_attachments(entry.kwargs.get('attachments', {}), self.spool_dir, entry.ident)
+        entry.owned += owned
+        if attachments:
+            entry.kwargs['attachments'] = attachments
+
+    def put(self, **kwargs):
+        """Queue a message for delivery. The keyword arguments are passed to
+        SMTPClient.sendMessage(). Returns as soon as the message is spooled."""
+
+        entry = MailQueueEntry(f"{time.time_ns()}-{os.getpid()}-{next(self.__seq)}", time.time(), kwargs)
+        self.__store_attachments(entry)
+        if self.spool_dir:
+            self.__write(entry)
+        self.__push(time.monotonic(), entry)
+
+    def __push(self, due, entry):
+        with self._cond:
+            heapq.heappush(self.__heap, (due, next(self.__seq), entry))
+            self._cond.notify()
+
+    def _next(self, now):
+        """Pop the next due entry. Returns a tuple (entry, None) or, if no
+        entry is due, (None, seconds until the next one is due), where the
+        delay is None if the queue is empty."""
+        with self._cond:
+            if self.__heap and self.__heap[0][0] <= now:
+                return heapq.heappop(self.__heap)[2], None
+            return None, self.__heap[0][0] - now if self.__heap else None
+
+    def _settle(self, entry, error = None):
+        """Account for a delivery attempt that raised 'error', None if the
+        message was delivered. Messages that failed temporarily are queued
+        for a retry unless the queue is stopping, in which case they remain
+        spooled for the next run."""
+
+        if error is None:
+            latency = time.time() - entry.created
+            with self._cond:
+                self.delivered     += 1
+                self.last_latency   = latency
+                self.total_latency += latency
+            if self.spool_dir:
+                try:
+                    os.unlink(self.__spool_path(entry))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    # Delivered again after a restart, which beats stalling
+                    log.log(f"[mail_queue] Cannot remove delivered message '{entry.ident}' from the spool: {e}", level = log.ERROR)
+            entry.remove()
+            log.log(f"[mail_queue] Delivered '{entry.kwargs.get('subject')}', {len(self.__heap)} message(s) pending.", duration = round(latency, 3))
+            return
+
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            # Greylisting and relays shutting down refuse with 4xx codes
+            permanent = all(code >= 500 for code, _ in error.recipients.values())
+        elif isinstance(error, smtplib.SMTPResponseException):
+            permanent = error.smtp_code >= 500
+        elif isinstance(error, FileNotFoundError):
+            # An attachment referenced by path was rotated or removed, a
+            # retry cannot bring it back
+            permanent = True
+        else:
+            # Anything but a relay or network error is a bug in the message
+            # (e.g. a recipient that cannot be encoded) and fails again
+            permanent = not isinstance(error, (smtplib.SMTPException, OSError, TimeoutError))
+
+        entry.attempts += 1
+        if permanent:
+            with self._cond:
+                self.failed += 1
+            log.log(f"[mail_queue] Giving up on '{entry.kwargs.get('subject')}': {error!r}", level = log.ERROR)
+            if self.spool_dir:
+                try:
+                    os.replace(self.__spool_path(entry), os.path.join(self.spool_dir, 'failed', entry.ident + '.msg'))
+                except OSError as e:
+                    log.log(f"[mail_queue] Cannot move message '{entry.ident}' to the failed messages: {e}", level = log.ERROR)
+                entry.remove(os.path.join(self.spool_dir, 'failed'))
+            else:
+                entry.remove()
+            return
+        log.log(f"[mail_queue] Delivery of '{entry.kwargs.get('subject')}' failed (attempt {entry.attempts}): {error}", level = log.WARNING)
+        if self.spool_dir:
+            try:
+                self.__write(entry)
+            except OSError as e:
+                # The previous attempt count remains spooled
+                log.log(f"[mail_queue] Cannot update message '{entry.ident}' in the spool: {e}", level = log.WARNING)
+        delay = min(self.retry_min * 2 ** (entry.attempts - 1), self.retry_max)
+        with self._cond:
+            if self._stopping:
+                return
+        self.__push(time.monotonic() + delay, entry)
+
+####################################################################################################
+
+class MailQueue(MailSpool, threading.Thread):
+    """Background sender that decouples the runners from the SMTP relay.
+    Messages are delivered one at a time by this thread."""
+
+    def __init__(self, smtp_client, spool_dir = None, retry_min = 30, retry_max = 3600):
+        """Construct a new MailQueue object.
+
+        Parameters:
+        smtp_client: The SMTPClient used for delivery
+        spool_dir:   Directory for the on-disk spool, None to queue in memory only
+        retry_min:   Delay in seconds before the first retry
+        retry_max:   Upper bound for the retry delay in seconds"""
+
+        threading.Thread.__init__(self, name = 'mail_queue')
+        MailSpool.__init__(self, spool_dir, retry_min, retry_max)
+        self.smtp_client = smtp_client
+
+    def run(self):
+        """Overrides Thread.run(). Delivers due messages until shutdown() is
+        called. Messages that are due at shutdown get one last attempt, the
+        rest remains spooled for the next run."""
+
+        while True:
+            with self._cond:
+                while True:
+                    entry, delay = self._next(time.monotonic())
+                    if entry:
+                        break
+                    if self._stopping:
+                        return
+                    self._cond.wait(delay)
+
+            try:
+                self.smtp_client.sendMessage(**entry.kwargs)
+            except Exception as e:
+                self._settle(entry, e)
+            else:
+                self._settle(entry)
+
+    def shutdown(self):
+        """Stop the sender thread and wait for it to finish. Can be called
+        multiple times."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
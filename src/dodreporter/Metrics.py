@@ -0,0 +1,321 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+####################################################################################################
+
+import bisect
+import math
+import os
+import threading
+
+####################################################################################################
+
+from dodreporter import log
+
+####################################################################################################
+
+# Default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape(value):
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    """Format a sample value for the Prometheus text format."""
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+####################################################################################################
+
+class Metric:
+    """Base class of the metrics. Counters and histograms are updated in a
+    shard owned by the updating thread, so updates do not take a lock.
+    Shards are merged when the metrics are collected, the shards of threads
+    that have terminated are folded into a common base.
+
+    Alternatively, a metric can be computed at collection time by a callback
+    that returns a value, or a dict of values keyed by label value tuples."""
+
+    TYPE = None
+
+    def __init__(self, name, help, labels = (), callback = None):
+        """Construct a new metric.
+
+        Parameters:
+        name:     The metric name
+        help:     The help text
+        labels:   Names of the labels
+        callback: Optional function computing the metric at collection time"""
+
+        self.name     = name
+        self.help     = help
+        self.labels   = tuple(labels)
+        self.callback = callback
+        self.__local  = threading.local()
+        self.__lock   = threading.Lock()
+        self.__shards = []
+        self.__base   = {}
+
+    def _shard(self):
+        """Return the calling thread's shard."""
+        try:
+            return self.__local.values
+        except AttributeError:
+            values = self.__local.values = {}
+            with self.__lock:
+                self.__shards.append((threading.current_thread(), values))
+            return values
+
+    def _merge(self, total, values):
+        """Add the values of a shard to 'total'."""
+        raise NotImplementedError
+
+    def values(self):
+        """Return the current values keyed by label value tuples. Histogram
+        values are lists of the per bucket counts followed by the sum."""
+        if self.callback:
+            values = self.callback()
+            return values if isinstance(values, dict) else { () : values }
+        with self.__lock:
+            alive = []
+            for thread, values in self.__shards:
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:
+                    self._merge(self.__base, values)
+            self.__shards = alive
+            total = {}
+            self._merge(total, self.__base)
+            for _, values in alive:
+                # dict() copies atomically, the owner may add keys meanwhile
+                self._merge(total, dict(values))
+        return total
+
+    def _samples(self, labels, value):
+        """Yield (suffix, labels, value) tuples for a value."""
+        yield '', labels, value
+
+    def render(self):
+        """Return the metric in the Prometheus text format."""
+        lines = [ f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}" ]
+        for key, value in sorted(self.values().items()):
+            labels = list(zip(self.labels, key if isinstance(key, tuple) else (key,)))
+            for suffix, sample_labels, sample in self._samples(labels, value):
+                label_str = ','.join(f'{name}="{_escape(v)}"' for name, v in sample_labels)
+                lines.append(f"{self.name}{suffix}{{{label_str}}} {_format_value(sample)}" if label_str
+                        else f"{self.name}{suffix} {_format_value(sample)}")
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """A monotonically increasing counter."""
+
+    TYPE = 'counter'
+
+    def inc(self, amount = 1, labels = ()):
+        """Increase the counter for the given label values."""
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _merge(self, total, values):
+        for key, value in values.items():
+            total[key] = total.get(key, 0) + value
+
+class Gauge(Metric):
+    """A value that is set to its current state. Setting a gauge is a single
+    dict assignment, the last value set wins."""
+
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, labels = (), callback = None):
+        Metric.__init__(self, name, help, labels, callback)
+        self.__values = {}
+
+    def set(self, value, labels = ()):
+        """Set the gauge for the given label values."""
+        self.__values[labels] = value
+
+    def remove(self, labels):
+        """Remove the gauge for the given label values."""
+        self.__values.pop(labels, None)
+
+    def values(self):
+        if self.callback:
+            return Metric.values(self)
+        return dict(self.__values)
+
+class Histogram(Metric):
+    """Counts observations in cumulative buckets."""
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels = (), buckets = DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels = ()):
+        """Record an observation for the given label values."""
+        shard = self._shard()
+        entry = shard.get(labels)
+        if entry is None:
+            # Per bucket counts, observations above all buckets, sum
+            entry = shard[labels] = [ 0 ] * (len(self.buckets) + 1) + [ 0.0 ]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def _merge(self, total, values):
+        for key, entry in values.items():
+            entry = list(entry)
+            if key in total:
+                total[key] = [ a + b for a, b in zip(total[key], entry) ]
+            else:
+                total[key] = entry
+
+    def _samples(self, labels, entry):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), entry):
+            cumulative += count
+            yield '_bucket', labels + [ ('le', _format_value(float(bound)) if bound != math.inf else '+Inf') ], cumulative
+        yield '_sum', labels, entry[-1]
+        yield '_count', labels, cumulative
+
+####################################################################################################
+
+class Registry:
+    """A collection of metrics, rendered together."""
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock    = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, replacing a metric of the same name. Returns the
+        metric."""
+        with self.__lock:
+            self.__metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        parts = []
+        for metric in metrics:
+            try:
+                parts.append(metric.render())
+            except Exception as e:
+                log.log(f"[metrics] Cannot collect '{metric.name}': {e!r}", level = log.ERROR)
+        return '\n'.join(parts) + '\n'
+
+# The registry all metrics of dod_reporter are registered with
+REGISTRY = Registry()
+
+def counter(name, help, labels = (), callback = None):
+    """Create and register a Counter."""
+    return REGISTRY.register(Counter(name, help, labels, callback))
+
+def gauge(name, help, labels = (), callback = None):
+    """Create and register a Gauge."""
+    return REGISTRY.register(Gauge(name, help, labels, callback))
+
+def histogram(name, help, labels = (), buckets = DEFAULT_BUCKETS):
+    """Create and register a Histogram."""
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+####################################################################################################
+
+class MetricsExporter(threading.Thread):
+    """Serves the metrics on a local HTTP listener and/or writes them to a
+    file for the node exporter's textfile collector."""
+
+    def __init__(self, registry = REGISTRY, listen = None, textfile = None, interval = 60):
+        """Construct a new MetricsExporter object.
+
+        Parameters:
+        registry: The registry to export
+        listen:   Tuple (address, port) of the HTTP listener, None to disable
+        textfile: Path of the textfile, None to disable
+        interval: Seconds between textfile updates"""
+
+        threading.Thread.__init__(self, name = 'metrics', daemon = True)
+        self.registry = registry
+        self.textfile = textfile
+        self.interval = interval
+        self.__stop   = threading.Event()
+        self.__server = None
+        self.__serving = None
+        if listen:
+            self.__server = self.__make_server(listen)
+
+    def __make_server(self, listen):
+        """Create the HTTP server, serving the metrics on every path."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self.registry
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(listen, Handler)
+        server.daemon_threads = True
+        return server
+
+    def write_textfile(self):
+        """Atomically write the metrics to the textfile."""
+        tmp_file = f"{self.textfile}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, 'w', encoding = 'utf-8') as outfile:
+                outfile.write(self.registry.render())
+            os.replace(tmp_file, self.textfile)
+        except OSError as e:
+            log.log(f"[metrics] Cannot write '{self.textfile}': {e}", level = log.ERROR)
+
+    def run(self):
+        """Overrides Thread.run(). Serves HTTP requests and updates the
+        textfile until shutdown() is called."""
+        if self.__server:
+            self.__serving = threading.Thread(target = self.__server.serve_forever, name = 'metrics-http', daemon = True)
+            self.__serving.start()
+        while self.textfile and not self.__stop.wait(self.interval):
+            self.write_textfile()
+
+    def shutdown(self):
+        """Stop serving, write the textfile a last time. Can be called
+        multiple times."""
+        if self.__stop.is_set():
+            return
+        self.__stop.set()
+        if self.__serving:
+            self.__server.shutdown()
+        if self.__server:
+            self.__server.server_close()
+        if self.textfile:
+            self.write_textfile()
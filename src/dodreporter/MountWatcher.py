@@ -0,0 +1,163 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+####################################################################################################
+
+import ctypes
+import ctypes.util
+import os
+import select
+import threading
+
+####################################################################################################
+
+IN_ATTRIB      = 0x00000004
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+
+WATCH_MASK = IN_ATTRIB | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+####################################################################################################
+
+class MountWatcher:
+    """Waits for changes that may make a set of paths appear. Two event
+    sources are used where available: the kernel mount table, which signals
+    POLLPRI/POLLERR on /proc/self/mountinfo whenever a filesystem is mounted
+    or unmounted, and inotify watches on the nearest existing ancestor of
+    each path. If neither is available, wait() degrades to a plain timeout,
+    i.e. to polling."""
+
+    def __init__(self, paths, mountinfo = '/proc/self/mountinfo'):
+        """Construct a new MountWatcher object.
+
+        Parameters:
+        paths:     The paths whose appearance is of interest
+        mountinfo: The mount table file to watch"""
+
+        self.paths     = [ os.path.abspath(p) for p in paths ]
+        self.__poll    = select.poll()
+        self.__watches = {}
+        self.__mountinfo = None
+        self.__inotify_fd = None
+        self.__libc    = None
+        self.__lock    = threading.Lock()
+        self.__closed  = False
+
+        # Self-pipe that allows interrupt() to wake up a blocked wait()
+        self.__wake_r, self.__wake_w = os.pipe()
+        os.set_blocking(self.__wake_r, False)
+        self.__poll.register(self.__wake_r, select.POLLIN)
+
+        try:
+            self.__mountinfo = open(mountinfo, 'rb')
+            self.__mountinfo.read()
+            self.__poll.register(self.__mountinfo, select.POLLPRI | select.POLLERR)
+        except OSError:
+            self.__mountinfo = None
+
+        self.__init_inotify()
+
+    def __init_inotify(self):
+        """Set up inotify through libc, if the platform provides it."""
+        try:
+            self.__libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+            fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        self.__inotify_fd = fd
+        self.__poll.register(fd, select.POLLIN)
+        self.__update_watches()
+
+    def __update_watches(self):
+        """Watch the nearest existing ancestor of every path that does not
+        exist yet and drop watches that are no longer needed."""
+        wanted = set()
+        for path in self.paths:
+            if os.path.exists(path):
+                continue
+            ancestor = os.path.dirname(path)
+            while not os.path.isdir(ancestor) and ancestor != os.path.dirname(ancestor):
+                ancestor = os.path.dirname(ancestor)
+            wanted.add(ancestor)
+        for path in set(self.__watches) - wanted:
+            self.__libc.inotify_rm_watch(self.__inotify_fd, self.__watches.pop(path))
+        for path in wanted - set(self.__watches):
+            wd = self.__libc.inotify_add_watch(self.__inotify_fd, os.fsencode(path), WATCH_MASK)
+            if wd >= 0:
+                self.__watches[path] = wd
+
+    @property
+    def event_driven(self):
+        """Whether at least one event source is available."""
+        return self.__mountinfo is not None or self.__inotify_fd is not None
+
+    def wait(self, timeout):
+        """Block until a relevant change may have happened, interrupt() was
+        called or the timeout expired.
+
+        Parameters:
+        timeout: Maximum number of seconds to wait
+
+        Returns True if woken up by an event, False on timeout."""
+
+        events = self.__poll.poll(timeout * 1000)
+        for fd, _ in events:
+            if fd == self.__wake_r:
+                self.__drain(fd)
+            elif fd == self.__inotify_fd:
+                self.__drain(fd)
+                self.__update_watches()
+            elif self.__mountinfo is not None and fd == self.__mountinfo.fileno():
+                # Re-read the table to re-arm the notification
+                self.__mountinfo.seek(0)
+                self.__mountinfo.read()
+        return bool(events)
+
+    @staticmethod
+    def __drain(fd):
+        try:
+            while os.read(fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def interrupt(self):
+        """Wake up a thread blocked in wait(). Does nothing once the watcher
+        was closed."""
+        with self.__lock:
+            if not self.__closed:
+                os.write(self.__wake_w, b'\0')
+
+    def close(self):
+        """Release all file descriptors. Can be called multiple times."""
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            if self.__mountinfo is not None:
+                self.__mountinfo.close()
+            if self.__inotify_fd is not None:
+                os.close(self.__inotify_fd)
+            os.close(self.__wake_r)
+            os.close(self.__wake_w)
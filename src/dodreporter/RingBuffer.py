@@ -0,0 +1,141 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+import mmap
+import os
+import struct
+import threading
+
+####################################################################################################
+
+from dodreporter.error import DODReporterError
+
+####################################################################################################
+
+# File header: magic, capacity in samples, values per sample and the number
+# of samples appended since the file was created
+HEADER = struct.Struct('=8sIIQ')
+MAGIC  = b'DODRING1'
+
+def _columns(data, count, capacity, fields):
+    """Split the samples in 'data' into one list per field, oldest sample
+    first. The columns are cut by strided slices of the buffer, without
+    unpacking the samples one by one."""
+    head = (count % capacity) * fields
+    if count < capacity:
+        return [ data[i:head:fields].tolist() for i in range(fields) ]
+    return [ data[head + i::fields].tolist() + data[i:head:fields].tolist() for i in range(fields) ]
+
+####################################################################################################
+
+class RingBuffer:
+    """Fixed size time series of float samples in a memory mapped file.
+
+    Every sample consists of 'fields' doubles. Once 'capacity' samples were
+    appended, the oldest ones are overwritten, such that the file never
+    grows. A sample is written before the header count is advanced, hence
+    an interrupted append never exposes a partial sample.
+
+    If an existing file was created with a different layout, the most
+    recent samples that fit are carried over."""
+
+    def __init__(self, path, capacity, fields):
+        """Construct a new RingBuffer object.
+
+        Parameters:
+        path:     The backing file, created if missing
+        capacity: Number of samples kept
+        fields:   Number of values per sample"""
+
+        if capacity < 1 or fields < 1:
+            raise ValueError("capacity and fields must be at least 1")
+        self.path     = path
+        self.capacity = capacity
+        self.fields   = fields
+        self.__lock   = threading.Lock()
+        carried       = None
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+            if os.path.exists(path):
+                carried = self.__carry_over()
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                size = HEADER.size + 8 * capacity * fields
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, HEADER.pack(MAGIC, capacity, fields, 0), 0)
+                self.__map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            raise DODReporterError(f"Cannot open time series '{path}': {e}")
+        self.__data = memoryview(self.__map)[HEADER.size:].cast('d')
+        for sample in carried or []:
+            self.append(*sample)
+
+    def __carry_over(self):
+        """Return the samples of an existing file with a different layout,
+        None if the layout matches."""
+        with open(self.path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) == HEADER.size:
+                magic, capacity, fields, count = HEADER.unpack(header)
+                if magic == MAGIC and (capacity, fields) == (self.capacity, self.fields):
+                    return None
+                data = f.read(8 * capacity * fields)
+                if magic == MAGIC and len(data) == 8 * capacity * fields:
+                    samples = list(zip(*_columns(memoryview(data).cast('d'), count, capacity, fields)))[-self.capacity:]
+                    return [ (list(sample) + [ 0.0 ] * self.fields)[:self.fields] for sample in samples ]
+        return []
+
+    @property
+    def count(self):
+        """Number of samples appended since the file was created."""
+        return HEADER.unpack_from(self.__map)[3]
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, *values):
+        """Append a sample, overwriting the oldest one if the buffer is full."""
+        if len(values) != self.fields:
+            raise ValueError(f"Expected {self.fields} values, got {len(values)}")
+        with self.__lock:
+            count = self.count
+            slot  = (count % self.capacity) * self.fields
+            self.__data[slot:slot + self.fields] = memoryview(struct.pack(f'={self.fields}d', *values)).cast('d')
+            HEADER.pack_into(self.__map, 0, MAGIC, self.capacity, self.fields, count + 1)
+
+    def columns(self):
+        """Return the samples as one list per field, oldest first."""
+        with self.__lock:
+            return _columns(self.__data, self.count, self.capacity, self.fields)
+
+    def flush(self):
+        """Write the mapped pages back to the file."""
+        with self.__lock:
+            self.__map.flush()
+
+    def close(self):
+        with self.__lock:
+            self.__data.release()
+            self.__map.close()
@@ -0,0 +1,297 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+####################################################################################################
+
+import hashlib
+import mmap
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+
+####################################################################################################
+
+from dodreporter.error import DODCheckCancelled
+from dodreporter.IOLimiter import UNLIMITED
+
+####################################################################################################
+
+# Lines longer than this are truncated, verbose logs may contain huge paths
+MAX_LINE = 4096
+
+# Error lines kept per run and runs kept per log
+MAX_ERRORS = 20
+MAX_RUNS   = 100
+
+# Bytes before the resume offset of a log that must be unchanged to resume
+FINGERPRINT = 4096
+
+# Bytes of a log attached to the report of a failed run
+EXCERPT = 256 * 1024
+
+# Exit codes that do not indicate a failed run: success and files that
+# vanished during the transfer
+OK_EXIT_CODES = (0, 24)
+
+# Lines of interest, optionally prefixed by the timestamp and pid written by
+# 'rsync --log-file'. The regex runs over the memory map, the lines listing
+# transferred files in verbose logs are skipped without being copied.
+CANDIDATE = re.compile(
+        rb'^(?:(\d{4}/\d\d/\d\d \d\d:\d\d:\d\d) \[\d+\] )?'
+        rb'((?:rsync(?: error| warning)?:|Number of |Total |sent |total size is ).{0,%d})' % MAX_LINE,
+        re.MULTILINE)
+
+NUMBER = rb'([\d,.]+[KMGT]?)'
+FILES_TRANSFERRED = re.compile(rb'Number of (?:regular )?files transferred: ' + NUMBER)
+TOTAL_SIZE        = re.compile(rb'Total file size: ' + NUMBER)
+TRANSFERRED_SIZE  = re.compile(rb'Total transferred file size: ' + NUMBER)
+SENT_RECEIVED     = re.compile(rb'sent ' + NUMBER + rb' bytes\s+received ' + NUMBER + rb' bytes\s+' + NUMBER + rb' bytes/sec')
+RUN_END           = re.compile(rb'total size is ')
+EXIT_CODE         = re.compile(rb'rsync (?:error|warning): .*\(code (\d+)\)')
+EXIT_LINE         = (b'rsync error:', b'rsync warning:')
+
+def _number(value):
+    """Parse a number as printed by rsync, with thousands separators or a
+    --human-readable suffix."""
+    value = value.decode('ascii').replace(',', '')
+    if value[-1] in 'KMGT':
+        return int(float(value[:-1]) * 1000 ** ('KMGT'.index(value[-1]) + 1))
+    return int(float(value))
+
+####################################################################################################
+
+@dataclass
+class RsyncRun:
+    """Transfer statistics of a single rsync run"""
+
+    exit_code         : int = None
+    finished          : float = None
+    files_transferred : int = None
+    total_size        : int = None
+    transferred_size  : int = None
+    bytes_sent        : int = None
+    bytes_received    : int = None
+    elapsed           : float = None
+    errors            : list = field(default_factory=list)
+
+    @property
+    def failed(self):
+        return self.exit_code not in OK_EXIT_CODES and self.exit_code is not None
+
+    @property
+    def throughput(self):
+        """Bytes per second on the wire."""
+        if not self.elapsed:
+            return None
+        return ((self.bytes_sent or 0) + (self.bytes_received or 0)) / self.elapsed
+
+####################################################################################################
+
+def candidate_lines(path, offset = 0):
+    """Generator over the lines of interest of a log file, starting at
+    'offset'. The file is memory mapped and scanned by the regex engine, so
+    memory use does not depend on the file size. Yields tuples (end offset
+    of the line, timestamp or None, line)."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= offset:
+            return
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+            if hasattr(m, 'madvise'):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            for match in CANDIDATE.finditer(m, offset):
+                yield match.end(), match.group(1), match.group(2).rstrip(b'\r')
+
+def fingerprint(path, offset):
+    """Return a digest of the FINGERPRINT bytes before 'offset' of a log. A
+    log that was truncated and written again, e.g. by logrotate's
+    copytruncate, differs there from the content parsed before."""
+    start = max(0, offset - FINGERPRINT)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return hashlib.blake2b(f.read(offset - start), digest_size = 16).hexdigest()
+
+def excerpt(path, offset, size = EXCERPT):
+    """Return up to 'size' bytes of a log that end at 'offset', starting at
+    a line boundary."""
+    start = max(0, offset - size)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(offset - start)
+    if start > 0:
+        data = data[data.find(b'\n') + 1:]
+    return data
+
+def parse_log(path, offset = 0):
+    """Parse the rsync runs of a log file, starting at 'offset'. Runs in the
+    worker processes of the parser. Returns the completed runs as dicts, the
+    offset after the last completed run, where parsing of an appended log
+    can resume, and the fingerprint() of the log at that offset."""
+    # A run ends with its final statistics or with an exit code line. The
+    # exit code of a run with errors follows its final statistics.
+    runs, run, end, ended = [], RsyncRun(), offset, None
+    for line_end, stamp, line in candidate_lines(path, offset):
+        if ended and not (ended is RUN_END and line.startswith(EXIT_LINE)):
+            runs.append(asdict(run))
+            run, ended = RsyncRun(), None
+        if stamp:
+            run.finished = datetime.strptime(stamp.decode('ascii'), '%Y/%m/%d %H:%M:%S').timestamp()
+        if line.startswith(b'rsync'):
+            code = EXIT_CODE.match(line)
+            if code:
+                run.exit_code = int(code.group(1))
+                end, ended = line_end, EXIT_CODE
+            if len(run.errors) < MAX_ERRORS:
+                run.errors.append(line.decode('utf-8', 'replace'))
+        elif (m := FILES_TRANSFERRED.match(line)):
+            run.files_transferred = _number(m.group(1))
+        elif (m := TOTAL_SIZE.match(line)):
+            run.total_size = _number(m.group(1))
+        elif (m := TRANSFERRED_SIZE.match(line)):
+            run.transferred_size = _number(m.group(1))
+        elif (m := SENT_RECEIVED.match(line)):
+            run.bytes_sent, run.bytes_received = _number(m.group(1)), _number(m.group(2))
+            rate = _number(m.group(3))
+            run.elapsed = (run.bytes_sent + run.bytes_received) / rate if rate else 0.0
+        elif RUN_END.match(line):
+            if run.exit_code is None:
+                run.exit_code = 0
+            end, ended = line_end, RUN_END
+    if ended:
+        runs.append(asdict(run))
+    return runs, end, fingerprint(path, end)
+
+####################################################################################################
+
+class RsyncLogParser:
+    """Parses the rsync logs of a host. Results are cached per log by path,
+    inode, size and mtime. Logs that were appended to since the last parse
+    are only parsed from where the last completed run ended, provided the
+    content before that offset is unchanged. Logs that need parsing are
+    distributed over a process pool.
+
+    The logs are stat()ed through the IOLimiter, and the bytes to scan are
+    acquired from it before a log is handed to a parser, like the verifier
+    does for the files it hashes."""
+
+    def __init__(self, store = None, scope = None, workers = 2, limiter = UNLIMITED):
+        """Construct a new RsyncLogParser object.
+
+        Parameters:
+        store:   StateStore to persist the cache in, None to keep it in memory
+        scope:   The scope of the cache in the store
+        workers: Number of parser processes
+        limiter: IOLimiter for the filesystem access"""
+
+        self.store   = store
+        self.scope   = scope
+        self.workers = workers
+        self.limiter = limiter
+        self.parsed  = 0
+        self.latest  = None
+        self.__cache = store.get(scope, 'rsync_logs', {}) if store else {}
+
+    def parse(self, paths, cancel = None):
+        """Return the runs of the given logs as RsyncRun objects, ordered by
+        the modification time of the logs. Logs that vanish in the meantime
+        (e.g. by rotation) are skipped. Afterwards 'latest' holds the path of
+        the log with the latest run and the offset where that run ends, or
+        None if no run was found.
+
+        Parameters:
+        paths:  The log files
+        cancel: Optional threading.Event, parsing raises DODCheckCancelled
+                once it is set"""
+
+        cache, todo, mtimes = {}, {}, {}
+        for path in paths:
+            try:
+                st = self.limiter.stat(path)
+            except FileNotFoundError:
+                continue
+            mtimes[path] = st.st_mtime_ns
+            cached = self.__cache.get(path)
+            key    = [ st.st_ino, st.st_size, st.st_mtime_ns ]
+            if cached and cached['key'] == key:
+                cache[path] = cached
+            elif cached and cached['key'][0] == st.st_ino and cached['key'][1] <= st.st_size:
+                # Appended to, resume after the last completed run, unless the
+                # log was truncated and has grown past its old size since
+                self.limiter.acquire(nbytes = min(cached['offset'], FINGERPRINT), cancel = cancel)
+                try:
+                    unchanged = fingerprint(path, cached['offset']) == cached.get('fingerprint')
+                except FileNotFoundError:
+                    continue
+                todo[path] = (key, cached['offset'], cached['runs']) if unchanged else (key, 0, [])
+            else:
+                todo[path] = (key, 0, [])
+
+        self.parsed = len(todo)
+        if len(todo) == 1 or self.workers < 2:
+            for path, (key, offset, runs) in todo.items():
+                if cancel is not None and cancel.is_set():
+                    raise DODCheckCancelled("Parsing of the rsync logs cancelled")
+                self.limiter.acquire(nbytes = key[1] - offset, cancel = cancel)
+                try:
+                    new_runs, end, digest = parse_log(path, offset)
+                except FileNotFoundError:
+                    # Rotated away since the stat
+                    continue
+                cache[path] = { 'key' : key, 'offset' : end, 'fingerprint' : digest, 'runs' : (runs + new_runs)[-MAX_RUNS:] }
+        elif todo:
+            context = multiprocessing.get_context('forkserver')
+            pool    = ProcessPoolExecutor(max_workers = min(self.workers, len(todo)), mp_context = context)
+            try:
+                pending = {}
+                for path, (key, offset, _) in todo.items():
+                    try:
+                        self.limiter.acquire(nbytes = key[1] - offset, cancel = cancel)
+                    except DODCheckCancelled:
+                        raise DODCheckCancelled("Parsing of the rsync logs cancelled")
+                    pending[pool.submit(parse_log, path, offset)] = path
+                while pending:
+                    if cancel is not None and cancel.is_set():
+                        raise DODCheckCancelled("Parsing of the rsync logs cancelled")
+                    done, _ = wait(pending, timeout = 1, return_when = FIRST_COMPLETED)
+                    for future in done:
+                        path = pending.pop(future)
+                        key, _, runs = todo[path]
+                        try:
+                            new_runs, end, digest = future.result()
+                        except FileNotFoundError:
+                            continue
+                        cache[path] = { 'key' : key, 'offset' : end, 'fingerprint' : digest, 'runs' : (runs + new_runs)[-MAX_RUNS:] }
+            except BaseException:
+                # Unlike leaving a 'with' block, this does not wait for the
+                # logs being parsed
+                pool.shutdown(wait = False, cancel_futures = True)
+                raise
+            pool.shutdown()
+
+        # Entries of logs that vanished are dropped by replacing the cache
+        self.__cache = cache
+        if self.store and todo:
+            self.store.set(self.scope, 'rsync_logs', cache)
+        ordered     = [ path for path in sorted(cache, key = lambda path : (mtimes[path], path)) if cache[path]['runs'] ]
+        self.latest = (ordered[-1], cache[ordered[-1]]['offset']) if ordered else None
+        return [ RsyncRun(**run) for path in ordered for run in cache[path]['runs'] ]
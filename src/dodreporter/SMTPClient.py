@@ -19,13 +19,208 @@
 # SOFTWARE.
 
 import email
+from email.generator import BytesGenerator
+from email.policy import SMTP as SMTP_POLICY
 from email.mime.base import MIMEBase
 from email.header import Header
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import parseaddr, formataddr
+import base64
+import lzma
+import os
+import io
+import queue
+import secrets
 import smtplib
 import ssl
+import tempfile
+import threading
+import time
+import zlib
+
+####################################################################################################
+
+from dodreporter import log, Metrics, tracing
+
+####################################################################################################
+
+CONNECT_SECONDS = Metrics.histogram('dod_smtp_connect_seconds', 'Time to open and authenticate an SMTP session')
+SEND_SECONDS    = Metrics.histogram('dod_smtp_send_seconds', 'Time to render and transmit a message')
+MESSAGES        = Metrics.counter('dod_smtp_messages_total', 'Messages handed to the relay')
+MESSAGE_BYTES   = Metrics.counter('dod_smtp_message_bytes_total', 'Size of the messages handed to the relay')
+
+####################################################################################################
+
+# Attachments are base64 encoded in chunks of this many bytes. A multiple of
+# 57 bytes yields complete 76 character lines.
+ENCODE_CHUNK = 57 * 1024
+
+# Messages up to this size are assembled in memory, larger ones on disk
+SPOOL_MAX_SIZE = 1 << 20
+
+def _open_attachment(data):
+    """Return a binary file object for an attachment given as bytes, path
+    or file-like object, and whether the caller has to close it."""
+    if isinstance(data, (bytes, bytearray)):
+        return io.BytesIO(data), True
+    if isinstance(data, (str, os.PathLike)):
+        return open(data, 'rb'), True
+    return data, False
+
+# Supported attachment compression: file name suffix, MIME type and a
+# factory for a streaming compressor object
+COMPRESSION = {
+        'gzip' : ('.gz', ('application', 'gzip'), lambda : zlib.compressobj(6, zlib.DEFLATED, 31)),
+        'xz'   : ('.xz', ('application', 'x-xz'), lambda : lzma.LZMACompressor(lzma.FORMAT_XZ)),
+        }
+
+def _attachment_size(f):
+    """Return the size of an attachment file object, None if unknown."""
+    try:
+        return os.fstat(f.fileno()).st_size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+    if isinstance(f, io.BytesIO):
+        return f.getbuffer().nbytes
+    return None
+
+class _CountingReader:
+    """Wraps a binary file object, streams it through an optional
+    compressor and counts the bytes consumed and produced."""
+
+    def __init__(self, f, compressor = None):
+        self.f          = f
+        self.compressor = compressor
+        self.raw        = 0
+        self.produced   = 0
+        self.__pending  = b''
+        self.__eof      = False
+
+    def read(self, size):
+        if self.compressor is None:
+            data = self.f.read(size)
+            self.raw += len(data)
+            self.produced += len(data)
+            return data
+        while len(self.__pending) < size and not self.__eof:
+            chunk = self.f.read(ENCODE_CHUNK)
+            self.raw += len(chunk)
+            if chunk:
+                self.__pending += self.compressor.compress(chunk)
+            else:
+                self.__pending += self.compressor.flush()
+                self.__eof = True
+        data, self.__pending = self.__pending[:size], self.__pending[size:]
+        self.produced += len(data)
+        return data
+
+def _read_exactly(f, size):
+    """Read 'size' bytes unless EOF is reached, file-like objects such as
+    pipes may return less per read()."""
+    chunks = []
+    while size:
+        chunk = f.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def data_chunks(message):
+    """Generator over the DATA payload of a rendered message in chunks of
+    about 64 KiB, dot-stuffed and followed by the terminating line."""
+    message.seek(0)
+    buf  = []
+    size = 0
+    for line in message:
+        # Dot-stuffing, see RFC 5321 section 4.5.2
+        if line.startswith(b'.'):
+            line = b'.' + line
+        buf.append(line)
+        size += len(line)
+        if size >= 1 << 16:
+            yield b''.join(buf)
+            buf, size = [], 0
+    yield b''.join(buf) + b'.\r\n'
+
+def render_message(sender, recipients, subject, message_text, attachments, compress, compress_threshold, overrides = {}):
+    """Render a message into a spooled temporary file. Attachments are read,
+    optionally compressed and base64 encoded in chunks, so the memory used
+    does not depend on their size. 'overrides' maps attachment names to the
+    (compress, compress_threshold) to use instead of the message settings.
+    Returns the file and the attachment byte counts before and after
+    compression."""
+
+    boundary = '=' * 15 + secrets.token_hex(16) + '=='
+    message  = MIMEMultipart(boundary = boundary)
+
+    # Header
+    message["From"] = formataddr(sender)
+    message["To"] = ', '.join([formataddr(recipient) for recipient in recipients])
+    message["Subject"] = subject
+
+    out = tempfile.SpooledTemporaryFile(max_size = SPOOL_MAX_SIZE)
+    for name, value in message.items():
+        out.write(SMTP_POLICY.fold_binary(*SMTP_POLICY.header_store_parse(name, value)))
+    out.write(b'\r\n')
+
+    def write_part(part):
+        out.write(f'--{boundary}\r\n'.encode('ascii'))
+        BytesGenerator(out, policy = SMTP_POLICY).flatten(part)
+        out.write(b'\r\n')
+
+    write_part(MIMEText(message_text, 'plain'))
+    raw_bytes, encoded_bytes = 0, 0
+    for fname, data in attachments.items():
+        f, close = _open_attachment(data)
+        method, threshold = overrides.get(fname, (compress, compress_threshold))
+        try:
+            size = _attachment_size(f)
+            if method and method != 'none' and (size is None or size > threshold):
+                suffix, (main_type, sub_type), factory = COMPRESSION[method]
+                reader = _CountingReader(f, factory())
+                fname += suffix
+            else:
+                main_type, sub_type = "application", 'pdf' if fname[-4:].lower() == '.pdf' else 'octet-stream'
+                reader = _CountingReader(f)
+            part = MIMEBase(main_type, sub_type)
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', 'attachment', filename=fname)
+            out.write(f'--{boundary}\r\n'.encode('ascii'))
+            for name, value in part.items():
+                out.write(SMTP_POLICY.fold_binary(name, value))
+            out.write(b'\r\n')
+            while True:
+                chunk = _read_exactly(reader, ENCODE_CHUNK)
+                if not chunk:
+                    break
+                out.write(base64.encodebytes(chunk).replace(b'\n', b'\r\n'))
+            raw_bytes     += reader.raw
+            encoded_bytes += reader.produced
+        finally:
+            if close:
+                f.close()
+    out.write(f'--{boundary}--\r\n'.encode('ascii'))
+    return out, raw_bytes, encoded_bytes
+
+####################################################################################################
+
+class SMTPSession:
+    """An open, possibly authenticated connection to the SMTP relay."""
+
+    def __init__(self, server):
+        self.server    = server
+        self.last_used = time.monotonic()
+
+    def close(self):
+        """Close the session, ignoring errors from an already dead connection."""
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+
+####################################################################################################
 
 class SMTPClient:
 
@@ -34,12 +229,195 @@ class SMTPClient:
             port = '587',
             user = None,
             password = None,
-            tls = False):
-        self.hostname = hostname
-        self.port     = port
-        self.user     = user
-        self.password = password
-        self.tls      = tls
+            tls = False,
+            pool_size = 1,
+            max_idle = 60,
+            timeout = 60,
+            compress = None,
+            compress_threshold = 65536):
+        """Construct a new SMTPClient.
+
+        Parameters:
+        hostname:  SMTP relay host name
+        port:      SMTP relay port
+        user:      User name for authentication, None to skip authentication
+        password:  Password for authentication
+        tls:       Whether to use STARTTLS
+        pool_size: Maximum number of concurrently open sessions
+        max_idle:  Number of seconds after which an idle session is probed
+                   with NOOP before it is reused
+        timeout:   Socket timeout in seconds for relay operations
+        compress:  Default attachment compression, 'gzip', 'xz' or None
+        compress_threshold: Default size in bytes above which attachments
+                   are compressed"""
+        self.hostname  = hostname
+        self.port      = port
+        self.user      = user
+        self.password  = password
+        self.tls       = tls
+        self.max_idle  = max_idle
+        self.timeout   = timeout
+        self.compress  = compress
+        self.compress_threshold = compress_threshold
+        self.__stats_lock = threading.Lock()
+        self.__stats   = {
+                'messages'                 : 0,
+                'message_bytes'            : 0,
+                'send_seconds'             : 0.0,
+                'attachment_bytes'         : 0,
+                'attachment_bytes_encoded' : 0,
+                }
+        self.__idle    = queue.LifoQueue()
+        self.__slots   = threading.BoundedSemaphore(pool_size)
+
+    def __connect(self):
+        """Open and authenticate a new session."""
+        start  = time.monotonic()
+        with tracing.span('smtp.connect', host = self.hostname):
+            server = smtplib.SMTP(self.hostname, self.port, timeout = self.timeout)
+            try:
+                if self.tls:
+                    server.starttls()
+                if self.user:
+                    server.login(self.user, self.password)
+            except:
+                server.close()
+                raise
+        CONNECT_SECONDS.observe(time.monotonic() - start)
+        return SMTPSession(server)
+
+    def __alive(self, session):
+        """Check whether an idle session is still usable. Sessions that were
+        idle for longer than max_idle are probed with NOOP, since the relay
+        may have dropped them in the meantime."""
+        if time.monotonic() - session.last_used < self.max_idle:
+            return True
+        try:
+            return session.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def __acquire(self, fresh = False):
+        """Take a session from the pool or open a new one. Returns a tuple
+        (session, reused).
+
+        Parameters:
+        fresh: Open a new session even if idle ones are pooled"""
+        self.__slots.acquire()
+        try:
+            while not fresh:
+                try:
+                    session = self.__idle.get_nowait()
+                except queue.Empty:
+                    break
+                if self.__alive(session):
+                    return session, True
+                session.close()
+            return self.__connect(), False
+        except:
+            self.__slots.release()
+            raise
+
+    def __release(self, session):
+        """Return a healthy session to the pool."""
+        session.last_used = time.monotonic()
+        self.__idle.put(session)
+        self.__slots.release()
+
+    def __discard(self, session):
+        """Close a broken session and free its pool slot."""
+        session.close()
+        self.__slots.release()
+
+    def stats(self):
+        """Return a dict with send statistics. 'attachment_bytes' counts the
+        attachment data before and 'attachment_bytes_encoded' after
+        compression."""
+        with self.__stats_lock:
+            return dict(self.__stats)
+
+    def close(self):
+        """Close all idle sessions."""
+        while True:
+            try:
+                self.__idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    @staticmethod
+    def __transmit(server, from_addr, to_addrs, message):
+        """Run a mail transaction on 'server', streaming the rendered message
+        from the binary file object 'message' instead of passing it to
+        SMTP.sendmail() as a whole. Raises the same exceptions as
+        SMTP.sendmail()."""
+
+        server.ehlo_or_helo_if_needed()
+        code, resp = server.mail(from_addr)
+        if code != 250:
+            if code == 421:
+                server.close()
+            else:
+                server.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        refused = {}
+        for addr in to_addrs:
+            code, resp = server.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+            if code == 421:
+                # The relay is closing the session, not refusing the
+                # recipient, the message is retried on a fresh one
+                server.close()
+                raise smtplib.SMTPResponseException(code, resp)
+        if len(refused) == len(to_addrs):
+            server.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, resp = server.docmd('data')
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        for chunk in data_chunks(message):
+            server.send(chunk)
+        code, resp = server.getreply()
+        if code != 250:
+            if code == 421:
+                server.close()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def __deliver(self, from_addr, to_addrs, message):
+        """Send a rendered message over a pooled session. If the relay closed
+        the session (idle timeout, 421 reply), the message is retried once on
+        a fresh connection. Other pooled sessions are likely closed as well,
+        hence the retry does not take one of them. Returns the refused
+        recipients like SMTP.sendmail()."""
+        for attempt in range(2):
+            session, reused = self.__acquire(fresh = attempt > 0)
+            try:
+                refused = self.__transmit(session.server, from_addr, to_addrs, message)
+            except smtplib.SMTPServerDisconnected:
+                self.__discard(session)
+                if attempt or not reused:
+                    raise
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code == 421:
+                    self.__discard(session)
+                    if attempt:
+                        raise
+                else:
+                    # The transaction was refused but the session is intact,
+                    # reset it before handing it to the next sender
+                    try:
+                        session.server.rset()
+                        self.__release(session)
+                    except (smtplib.SMTPException, OSError):
+                        self.__discard(session)
+                    raise
+            except:
+                self.__discard(session)
+                raise
+            else:
+                self.__release(session)
+                return refused
 
     def sendMessage(self,
             sender,
@@ -47,40 +425,66 @@ class SMTPClient:
             subject,
             message_text,
             attachments = {},
-            bcc = None):
+            bcc = None,
+            compress = None,
+            compress_threshold = None,
+            attachment_compress = None):
+        """Send a message.
+
+        Parameters:
+        sender:       Parsed (name, address) tuple of the sender
+        recipients:   Parsed (name, address) tuple or list thereof
+        subject:      The subject line
+        message_text: The plain text body
+        attachments:  Dict mapping file names to the attachment data, given
+                      as bytes, as a path or as a binary file-like object
+        bcc:          Address or list of addresses to send blind copies to
+        compress:     Attachment compression, 'gzip', 'xz' or 'none',
+                      defaults to the client setting
+        compress_threshold: Size in bytes above which attachments are
+                      compressed, defaults to the client setting
+        attachment_compress: Dict mapping attachment names to (compress,
+                      compress_threshold) tuples that apply to these
+                      attachments instead, None elements default to the
+                      message settings"""
 
         if not isinstance(recipients, list):
             recipients = [ recipients ]
+        compress = compress or self.compress
+        if compress == 'none':
+            compress = None
+        if compress_threshold is None:
+            compress_threshold = self.compress_threshold
+        overrides = { fname : (method or compress, compress_threshold if threshold is None else threshold)
+                for fname, (method, threshold) in (attachment_compress or {}).items() }
 
-        message = MIMEMultipart()
-
-        # Header
-        message["From"] = formataddr(sender)
-        message["To"] = ', '.join([formataddr(recipient) for recipient in recipients])
-        message["Subject"] = subject
+        start = time.monotonic()
+        with tracing.span('smtp.send', subject = subject) as span:
+            with tracing.span('smtp.render', attachments = len(attachments)):
+                message, raw_bytes, encoded_bytes = render_message(sender, recipients, subject, message_text, attachments, compress, compress_threshold, overrides)
 
-        # Add BCC recipients after building the 'To' header
-        if bcc:
-            if isinstance(bcc, list):
-                recipients += [ (None, elem) for elem in bcc ]
-            else:
-                recipients.append((None, bcc))
-
-        message.attach(MIMEText(message_text, 'plain'))
-        for fname, data in attachments.items():
-            app_type = 'pdf' if fname[-4:].lower() == '.pdf' else 'octet-stream'
-            part = MIMEBase("application", app_type)
-            part.set_payload(data)
-            email.encoders.encode_base64(part)
-            bfname = fname.encode('utf-8')
-            part.add_header('Content-Disposition', 'attachment', filename=fname)
-            message.attach(part)
+            # Add BCC recipients after building the 'To' header
+            if bcc:
+                if isinstance(bcc, list):
+                    recipients = recipients + [ (None, elem) for elem in bcc ]
+                else:
+                    recipients = recipients + [ (None, bcc) ]
 
-        text = message.as_string()
+            with message, tracing.span('smtp.deliver', recipients = len(recipients)):
+                refused = self.__deliver(sender[1], [ r[1] for r in recipients], message)
+                message.seek(0, os.SEEK_END)
+                size = message.tell()
+            span.set(bytes = size)
 
-        with smtplib.SMTP(self.hostname, self.port) as server:
-            if self.tls:
-                server.starttls()
-            if self.user:
-                server.login(self.user, self.password)
-            server.sendmail(sender[1], [ r[1] for r in recipients], text)
+        MESSAGES.inc()
+        MESSAGE_BYTES.inc(size)
+        SEND_SECONDS.observe(time.monotonic() - start)
+        with self.__stats_lock:
+            self.__stats['messages']                 += 1
+            self.__stats['message_bytes']            += size
+            self.__stats['send_seconds']             += time.monotonic() - start
+            self.__stats['attachment_bytes']         += raw_bytes
+            self.__stats['attachment_bytes_encoded'] += encoded_bytes
+        for addr, (code, resp) in refused.items():
+            # Delivered to the others, a retry would duplicate the message
+            log.log(f"[smtp] Relay refused recipient '{addr}' of '{subject}': {code} {resp.decode('utf-8', 'replace')}", level = log.WARNING)
@@ -0,0 +1,169 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+####################################################################################################
+
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+####################################################################################################
+
+from dodreporter import log
+
+####################################################################################################
+
+class Scheduler(threading.Thread):
+    """Central scheduler that keeps the next trigger time of every job in a
+    priority heap and hands due jobs to a bounded worker pool.
+
+    A job is any object providing a 'name' attribute, a 'run()' method that
+    performs the work and a 'next_run(now)' method that returns the datetime
+    of the next trigger after 'now'. A job is only rescheduled once its run
+    has completed, hence a job never runs concurrently with itself.
+
+    Jobs scheduled for the same trigger time form a batch. Once all jobs of
+    a batch have completed, 'on_batch_complete' is called with the trigger
+    time.
+
+    Jobs are identified by their name. A removed job is not run again, a run
+    that is in progress is completed but not rescheduled."""
+
+    def __init__(self, workers = 4, on_batch_complete = None):
+        """Construct a new Scheduler object.
+
+        Parameters:
+        workers:           Maximum number of jobs that are run concurrently
+        on_batch_complete: Optional callback for completed batches"""
+
+        threading.Thread.__init__(self, name = 'scheduler')
+        self.on_batch_complete = on_batch_complete
+        self.__batches  = {}
+        self.__jobs     = {}
+        self.__heap     = []
+        self.__seq      = itertools.count()
+        self.__cond     = threading.Condition()
+        self.__stopping = False
+        self.__running  = 0
+        self.workers    = workers
+        self.__executor = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'worker')
+
+    def add(self, job, when = None):
+        """Schedule a job.
+
+        Parameters:
+        job:  The job to schedule
+        when: The datetime of the first trigger, None to trigger immediately"""
+
+        with self.__cond:
+            self.__jobs[job.name] = job
+            self.__push(job, when or datetime.now())
+
+    def remove(self, name):
+        """Remove the job with the given name. Returns the job or None if
+        no such job is scheduled."""
+
+        with self.__cond:
+            return self.__jobs.pop(name, None)
+
+    @property
+    def running(self):
+        """Number of jobs currently running."""
+        return self.__running
+
+    @property
+    def queued(self):
+        """Number of jobs waiting for their trigger time."""
+        return max(0, len(self.__jobs) - self.__running)
+
+    def __push(self, job, when):
+        """Push a job onto the heap, the caller holds the condition."""
+        heapq.heappush(self.__heap, (when, next(self.__seq), job))
+        self.__batches[when] = self.__batches.get(when, 0) + 1
+        self.__cond.notify()
+
+    def __scheduled(self, job):
+        """Whether 'job' was not removed, the caller holds the condition."""
+        return self.__jobs.get(job.name) is job
+
+    def __finish(self, when):
+        """Account for a job of the batch 'when' that is done, and call the
+        completion handler if it was the last one."""
+        with self.__cond:
+            self.__batches[when] -= 1
+            batch_complete = not self.__batches[when]
+            if batch_complete:
+                del self.__batches[when]
+        if batch_complete and self.on_batch_complete:
+            try:
+                self.on_batch_complete(when)
+            except Exception as e:
+                log.log(f"[scheduler] Completion handler of batch {when} failed: {e!r}", level = log.ERROR)
+
+    def __execute(self, job, when):
+        """Run a job on a worker thread and reschedule it afterwards."""
+        with self.__cond:
+            self.__running += 1
+        try:
+            job.run()
+        except Exception as e:
+            log.log(f"[scheduler] Job '{job.name}' failed: {e!r}", level = log.ERROR)
+        with self.__cond:
+            self.__running -= 1
+        self.__finish(when)
+        when = job.next_run(datetime.now())
+        with self.__cond:
+            if self.__stopping or not self.__scheduled(job):
+                return
+            self.__push(job, when)
+        log.log(f"[scheduler] Job '{job.name}' will be triggered next at {when}")
+
+    def run(self):
+        """Overrides Thread.run(). Dispatches due jobs to the worker pool
+        until shutdown() is called."""
+
+        while True:
+            with self.__cond:
+                while True:
+                    if self.__stopping:
+                        return
+                    now = datetime.now()
+                    if self.__heap and self.__heap[0][0] <= now:
+                        when, _, job = heapq.heappop(self.__heap)
+                        scheduled = self.__scheduled(job)
+                        break
+                    self.__cond.wait((self.__heap[0][0] - now).total_seconds() if self.__heap else None)
+            if scheduled:
+                self.__executor.submit(self.__execute, job, when)
+            else:
+                self.__finish(when)
+
+    def shutdown(self):
+        """Stop dispatching, cancel jobs that are queued but not yet started
+        and wait for running jobs to finish. Can be called multiple times."""
+
+        with self.__cond:
+            self.__stopping = True
+            self.__cond.notify()
+        if self.is_alive():
+            self.join()
+        self.__executor.shutdown(wait = True, cancel_futures = True)
@@ -0,0 +1,177 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+####################################################################################################
+
+import os
+from dataclasses import dataclass
+
+####################################################################################################
+
+from dodreporter.error import DODCheckCancelled
+from dodreporter.IOLimiter import UNLIMITED
+
+####################################################################################################
+
+@dataclass
+class Snapshot:
+    """A snapshot directory found below a host's backup directory"""
+
+    path     : str
+    time     : float
+    complete : bool
+
+####################################################################################################
+
+class SnapshotScanner:
+    """Finds the snapshot directories below a host's backup directory.
+
+    Snapshots are the directories at depth 'depth' below the backup
+    directory, e.g. depth 2 for a '<year>/<date>' layout. A snapshot is
+    complete if it contains the marker file, or unconditionally if no
+    marker is configured.
+
+    The scanner keeps an index of the directories it listed and of the
+    snapshots it inspected, keyed by path and validated by mtime and inode.
+    A directory is only listed again, and a snapshot only inspected again,
+    if its mtime or inode changed, e.g. because a rotating layout renamed
+    another snapshot to its path. A scan thus costs one stat per snapshot
+    rather than O(total files). The index is kept in the StateStore, if one
+    is given."""
+
+    VERSION = 1
+
+    def __init__(self, directory, store = None, scope = None, depth = 1, marker = None, limiter = UNLIMITED):
+        """Construct a new SnapshotScanner object.
+
+        Parameters:
+        directory:  The host's backup directory
+        store:      StateStore to persist the index in, None to keep it in memory
+        scope:      The scope of the index in the store
+        depth:      Depth of the snapshot directories below 'directory'
+        marker:     Name of a file that marks a snapshot as complete
+        limiter:    IOLimiter applied to all filesystem access"""
+
+        self.directory  = directory
+        self.store      = store
+        self.scope      = scope
+        self.depth      = depth
+        self.marker     = marker
+        self.limiter    = limiter
+        self.listed     = 0
+        self.statted    = 0
+        self.__dirs      = {}
+        self.__snapshots = {}
+        self.__load()
+
+    def __load(self):
+        """Load the persisted index if it matches the current settings."""
+        if not self.store:
+            return
+        index = self.store.get(self.scope, 'scan_index')
+        if not index or index.get('version') != self.VERSION or index.get('settings') != self.__settings():
+            return
+        self.__dirs      = index['dirs']
+        self.__snapshots = index['snapshots']
+
+    def __save(self):
+        """Persist the index."""
+        if not self.store:
+            return
+        self.store.set(self.scope, 'scan_index', {
+            'version'   : self.VERSION,
+            'settings'  : self.__settings(),
+            'dirs'      : self.__dirs,
+            'snapshots' : self.__snapshots,
+            })
+
+    def __settings(self):
+        return [ self.directory, self.depth, self.marker ]
+
+    def __list(self, rel, cancel):
+        """Return the subdirectory names of 'rel', from the index if the
+        directory did not change since it was last listed."""
+        if cancel is not None and cancel.is_set():
+            raise DODCheckCancelled(f"Scan of '{self.directory}' cancelled")
+        path = os.path.join(self.directory, rel)
+        st   = self.limiter.stat(path)
+        self.statted += 1
+        cached = self.__dirs.get(rel)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_ino:
+            children = cached[2]
+        else:
+            with self.limiter.scandir(path) as it:
+                children = sorted(entry.name for entry in it if entry.is_dir(follow_symlinks = False))
+            self.listed += 1
+        self.__new_dirs[rel] = [ st.st_mtime_ns, st.st_ino, children ]
+        return children
+
+    def __inspect(self, rel):
+        """Return the index record of a snapshot directory, None if it
+        vanished since its parent was listed."""
+        cached = self.__snapshots.get(rel)
+        path   = os.path.join(self.directory, rel)
+        try:
+            st = self.limiter.stat(path, follow_symlinks = False)
+        except FileNotFoundError:
+            return None
+        self.statted += 1
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_ino:
+            return cached
+        if self.marker:
+            try:
+                mst = self.limiter.stat(os.path.join(path, self.marker))
+                self.statted += 1
+                return [ st.st_mtime_ns, st.st_ino, True, mst.st_mtime ]
+            except FileNotFoundError:
+                return [ st.st_mtime_ns, st.st_ino, False, st.st_mtime ]
+        return [ st.st_mtime_ns, st.st_ino, True, st.st_mtime ]
+
+    def __walk(self, rel, level, cancel):
+        for name in self.__list(rel, cancel):
+            child = os.path.join(rel, name) if rel else name
+            if level + 1 == self.depth:
+                record = self.__inspect(child)
+                if record:
+                    self.__new_snapshots[child] = record
+            else:
+                try:
+                    self.__walk(child, level + 1, cancel)
+                except FileNotFoundError:
+                    # Removed while scanning, e.g. by snapshot rotation
+                    pass
+
+    def scan(self, cancel = None):
+        """Scan the backup directory and return all snapshots, sorted by time.
+
+        Parameters:
+        cancel: Optional threading.Event, the scan raises DODCheckCancelled
+                once it is set"""
+
+        self.listed  = 0
+        self.statted = 0
+        self.__new_dirs      = {}
+        self.__new_snapshots = {}
+        self.__walk('', 0, cancel)
+        # Entries of vanished directories are dropped by replacing the index
+        self.__dirs      = self.__new_dirs
+        self.__snapshots = self.__new_snapshots
+        self.__save()
+        return sorted((Snapshot(path, rec[3], rec[2]) for path, rec in self.__snapshots.items()), key = lambda s : s.time)
@@ -0,0 +1,345 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+####################################################################################################
+
+import heapq
+import os
+import queue
+import struct
+import tempfile
+import threading
+from array import array
+from dataclasses import dataclass, asdict
+
+####################################################################################################
+
+from dodreporter.error import DODCheckCancelled
+from dodreporter.IOLimiter import UNLIMITED
+
+####################################################################################################
+
+# On-disk record of an inode set: inode number and allocated 512 byte blocks
+RECORD = struct.Struct('=QQ')
+
+def read_records(path, bufsize = 1 << 16):
+    """Iterate over the (inode, blocks) records of an inode set file."""
+    bufsize -= bufsize % RECORD.size
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(bufsize)
+            if not data:
+                return
+            yield from RECORD.iter_unpack(data)
+
+def new_blocks(path, previous_path):
+    """Sum up the blocks of all inodes in the inode set file 'path' that are
+    not contained in 'previous_path', by merge-joining the sorted files."""
+    total    = 0
+    previous = read_records(previous_path)
+    prev_ino = -1
+    for ino, blocks in read_records(path):
+        while prev_ino < ino:
+            prev_ino = next(previous, (float('inf'), 0))[0]
+        if prev_ino != ino:
+            total += blocks
+    return total
+
+####################################################################################################
+
+class InodeSet:
+    """Compact set of inodes with their block counts. Records are collected
+    in a flat array and spilled to sorted run files on disk whenever
+    'chunk_size' records are buffered, such that memory use is bounded
+    independently of the number of inodes."""
+
+    def __init__(self, tmp_dir, chunk_size = 1 << 18):
+        """Construct a new InodeSet object.
+
+        Parameters:
+        tmp_dir:    Directory for the spilled run files
+        chunk_size: Maximum number of records kept in memory"""
+
+        self.tmp_dir    = tmp_dir
+        self.chunk_size = chunk_size
+        self.__buffer   = array('Q')
+        self.__runs     = []
+
+    def add(self, ino, blocks):
+        self.__buffer.append(ino)
+        self.__buffer.append(blocks)
+        if len(self.__buffer) >= 2 * self.chunk_size:
+            self.__spill()
+
+    def __spill(self):
+        """Write the buffered records as a sorted run file."""
+        if not self.__buffer:
+            return
+        it = iter(self.__buffer)
+        records = sorted(zip(it, it))
+        self.__buffer = array('Q')
+        with tempfile.NamedTemporaryFile(dir = self.tmp_dir, suffix = '.run', delete = False) as f:
+            for i in range(0, len(records), 4096):
+                f.write(b''.join(RECORD.pack(*rec) for rec in records[i:i+4096]))
+        self.__runs.append(f.name)
+
+    def discard(self):
+        """Remove all spilled run files."""
+        for run in self.__runs:
+            os.unlink(run)
+        self.__runs   = []
+        self.__buffer = array('Q')
+
+    @staticmethod
+    def merge(sets, path):
+        """Merge inode sets into a single sorted, deduplicated inode set file.
+
+        Parameters:
+        sets: The InodeSet objects to merge, their run files are removed
+        path: The output file
+
+        Returns a tuple (number of inodes, number of blocks)."""
+
+        runs = []
+        for s in sets:
+            s.__spill()
+            runs += s.__runs
+        count, blocks, last = 0, 0, None
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                out = []
+                for ino, blk in heapq.merge(*(read_records(run) for run in runs)):
+                    if ino == last:
+                        continue
+                    last    = ino
+                    count  += 1
+                    blocks += blk
+                    out.append(RECORD.pack(ino, blk))
+                    if len(out) >= 4096:
+                        f.write(b''.join(out))
+                        out = []
+                f.write(b''.join(out))
+            os.replace(tmp_path, path)
+        finally:
+            for s in sets:
+                s.discard()
+        return count, blocks
+
+####################################################################################################
+
+@dataclass
+class SnapshotUsage:
+    """Space accounting of a single snapshot. All sizes are in bytes."""
+
+    files          : int
+    inodes         : int
+    apparent_bytes : int
+    disk_bytes     : int
+    new_bytes      : int = None
+
+####################################################################################################
+
+class _WalkState:
+    """Per worker state of a snapshot walk"""
+
+    def __init__(self, tmp_dir):
+        self.inodes     = InodeSet(tmp_dir)
+        self.files      = 0
+        self.apparent   = 0
+        self.dir_blocks = 0
+        self.errors     = []
+
+####################################################################################################
+
+class UsageAccountant:
+    """Determines the disk usage of hardlinked snapshots, e.g. as created by
+    rsync --link-dest.
+
+    Each snapshot is walked once by a pool of worker threads. Inodes are
+    deduplicated by inode number, files on other devices are ignored. The
+    blocks of inodes that are not part of the predecessor snapshot are the
+    snapshot's new bytes. Results are cached per snapshot since a complete
+    snapshot does not change anymore; only the inode set of the newest
+    measured snapshot is kept on disk to measure its successor. Snapshots
+    are identified by the inode and mtime of their directory rather than by
+    path, so results follow snapshots that are renamed by rotation (e.g.
+    'daily.0' to 'daily.1') and a new snapshot under an old name is measured
+    again."""
+
+    def __init__(self, directory, state_dir, store = None, scope = None, workers = 4, limiter = UNLIMITED):
+        """Construct a new UsageAccountant object.
+
+        Parameters:
+        directory: The host's backup directory
+        state_dir: Directory for the inode sets
+        store:     StateStore for the cached results, None to keep them in memory
+        scope:     The scope of the cached results in the store
+        workers:   Number of threads walking a snapshot
+        limiter:   IOLimiter applied to all filesystem access"""
+
+        self.directory = directory
+        self.state_dir = state_dir
+        self.workers   = workers
+        self.limiter   = limiter
+        self.errors    = []
+        self.store     = store
+        self.scope     = scope
+        self.__cache   = self.__load()
+
+    def __load(self):
+        if not self.store:
+            return {}
+        try:
+            return { path : SnapshotUsage(**usage) for path, usage in self.store.get(self.scope, 'usage', {}).items() }
+        except TypeError:
+            return {}
+
+    def __save(self):
+        if self.store:
+            self.store.set(self.scope, 'usage', { path : asdict(usage) for path, usage in self.__cache.items() })
+
+    def __inode_path(self, key):
+        return os.path.join(self.state_dir, 'inodes', key + '.ino')
+
+    def __identify(self, snapshot):
+        """Return the cache key of a snapshot, None if it vanished."""
+        try:
+            st = self.limiter.stat(os.path.join(self.directory, snapshot), follow_symlinks = False)
+        except FileNotFoundError:
+            return None
+        return f"{st.st_ino}-{st.st_mtime_ns}"
+
+    def __worker(self, dirs, state, root_dev, cancel):
+        """Worker thread that processes directories from the shared queue
+        and pushes subdirectories back onto it."""
+        while True:
+            path = dirs.get()
+            try:
+                if path is None:
+                    return
+                if cancel is not None and cancel.is_set():
+                    continue
+                with self.limiter.scandir(path) as it:
+                    for entry in it:
+                        st = self.limiter.entry_stat(entry)
+                        if st.st_dev != root_dev:
+                            continue
+                        if entry.is_dir(follow_symlinks = False):
+                            state.dir_blocks += st.st_blocks
+                            dirs.put(entry.path)
+                        else:
+                            state.files    += 1
+                            state.apparent += st.st_size
+                            state.inodes.add(st.st_ino, st.st_blocks)
+            except Exception as e:
+                # Not only OSError, the walk of the other workers would
+                # wait for the directories of a dead worker forever
+                state.errors.append(e)
+            finally:
+                dirs.task_done()
+
+    def __walk(self, snapshot, key, previous, cancel):
+        """Walk a snapshot and return its SnapshotUsage. 'key' and 'previous'
+        are the cache keys of the snapshot and of its predecessor."""
+        root     = os.path.join(self.directory, snapshot)
+        root_dev = self.limiter.stat(root).st_dev
+        dirs     = queue.Queue()
+        tmp_dir  = os.path.join(self.state_dir, 'inodes')
+        states   = [ _WalkState(tmp_dir) for _ in range(self.workers) ]
+        threads  = [ threading.Thread(target = self.__worker, args = (dirs, state, root_dev, cancel), daemon = True) for state in states ]
+        dirs.put(root)
+        for t in threads:
+            t.start()
+        dirs.join()
+        for t in threads:
+            dirs.put(None)
+        for t in threads:
+            t.join()
+
+        if cancel is not None and cancel.is_set():
+            for state in states:
+                state.inodes.discard()
+            raise DODCheckCancelled(f"Usage accounting of '{root}' cancelled")
+
+        inode_path     = self.__inode_path(key)
+        inodes, blocks = InodeSet.merge([ state.inodes for state in states ], inode_path)
+        dir_blocks     = sum(state.dir_blocks for state in states)
+        usage = SnapshotUsage(
+                files          = sum(state.files for state in states),
+                inodes         = inodes,
+                apparent_bytes = sum(state.apparent for state in states),
+                disk_bytes     = (blocks + dir_blocks) * 512)
+        if previous is not None and os.path.exists(self.__inode_path(previous)):
+            usage.new_bytes = (new_blocks(inode_path, self.__inode_path(previous)) + dir_blocks) * 512
+        elif previous is None:
+            usage.new_bytes = usage.disk_bytes
+        self.errors += [ e for state in states for e in state.errors ]
+        return usage
+
+    def update(self, snapshots, cancel = None):
+        """Measure all complete snapshots that have not been measured yet, in
+        chronological order, and drop results of vanished snapshots.
+
+        Parameters:
+        snapshots: The complete snapshots of the host, sorted by time
+        cancel:    Optional threading.Event, the walk raises
+                   DODCheckCancelled once it is set
+
+        Returns a dict mapping snapshot paths to SnapshotUsage objects."""
+
+        os.makedirs(os.path.join(self.state_dir, 'inodes'), exist_ok = True)
+        self.errors = []
+        keys = {}
+        for s in snapshots:
+            key = self.__identify(s.path)
+            if key is not None:
+                keys[s.path] = key
+        for key in set(self.__cache) - set(keys.values()):
+            del self.__cache[key]
+
+        previous = None
+        for path, key in keys.items():
+            if key not in self.__cache:
+                self.__cache[key] = self.__walk(path, key, previous, cancel)
+                # Persist every result, a cancelled backfill resumes here
+                self.__save()
+                if self.store:
+                    self.store.flush()
+                if previous is not None and os.path.exists(self.__inode_path(previous)):
+                    os.unlink(self.__inode_path(previous))
+            previous = key
+
+        # Only the newest inode set is needed to measure the next snapshot
+        keep = os.path.basename(self.__inode_path(previous)) if previous else None
+        for fname in os.listdir(os.path.join(self.state_dir, 'inodes')):
+            if fname != keep:
+                os.unlink(os.path.join(self.state_dir, 'inodes', fname))
+        self.__save()
+        return { path : self.__cache[key] for path, key in keys.items() }
+
+    def footprint(self, usages):
+        """Estimate the total disk usage of a host's snapshots: the full size
+        of the oldest snapshot plus the new bytes of all later snapshots.
+        Returns None if a required measurement is missing."""
+        usages = list(usages.values())
+        if not usages or any(u.new_bytes is None for u in usages[1:]):
+            return None
+        return usages[0].disk_bytes + sum(u.new_bytes for u in usages[1:])
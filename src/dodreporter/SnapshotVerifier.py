@@ -0,0 +1,278 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+####################################################################################################
+
+import hashlib
+import mmap
+import multiprocessing
+import os
+import random
+import stat
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+
+####################################################################################################
+
+from dodreporter.error import DODCheckCancelled
+from dodreporter.IOLimiter import UNLIMITED
+
+####################################################################################################
+
+CHUNK_SIZE = 1 << 20
+
+def hash_file(path, algorithm):
+    """Hash a file through a read-only memory map. Runs in the worker
+    processes of the verifier. Returns a tuple (hex digest, size)."""
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+                if hasattr(m, 'madvise'):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(m) as view:
+                    for offset in range(0, size, CHUNK_SIZE):
+                        h.update(view[offset:offset+CHUNK_SIZE])
+    return h.hexdigest(), size
+
+####################################################################################################
+
+@dataclass
+class VerificationResult:
+    """Outcome of a sampled snapshot verification"""
+
+    sampled    : int = 0
+    verified   : int = 0
+    unchanged  : int = 0
+    unverified : int = 0
+    bytes      : int = 0
+    seconds    : float = 0.0
+    mismatches : list = field(default_factory=list)
+    errors     : list = field(default_factory=list)
+    missing_manifest : str = None
+
+    def report(self):
+        """Return the report lines."""
+        if self.missing_manifest:
+            return [ f"Verified files:       none, the manifest '{self.missing_manifest}' does not exist" ]
+        mb_s    = self.bytes / 1e6 / self.seconds if self.seconds else 0
+        files_s = self.sampled / self.seconds if self.seconds else 0
+        lines = [ f"Verified files:       {self.verified} of {self.sampled} sampled "
+                  f"({self.unchanged} hardlinked to the previous snapshot, {self.unverified} without reference)",
+                  f"Hash throughput:      {mb_s:.1f} MB/s, {files_s:.1f} files/s" ]
+        if self.mismatches:
+            lines += [ "", "Checksum mismatches:" ] + [ f"  {path}" for path in self.mismatches ]
+        if self.errors:
+            lines += [ "", "Unreadable files:" ] + [ f"  {path}: {error}" for path, error in self.errors ]
+        return lines
+
+####################################################################################################
+
+class SnapshotVerifier:
+    """Verifies a random sample of files of a snapshot.
+
+    Each sampled file is hashed and compared against the source-side
+    manifest, if one is configured, or else against the same file in the
+    previous snapshot if its size and mtime indicate that it is unchanged.
+    Files that are hardlinked to the previous snapshot share their data and
+    are only checked for readability. Hashing runs in a process pool over
+    memory-mapped files."""
+
+    def __init__(self, directory, samples, algorithm = 'sha256', workers = 2, manifest = None, limiter = UNLIMITED):
+        """Construct a new SnapshotVerifier object.
+
+        Parameters:
+        directory: The host's backup directory
+        samples:   Number of files to sample
+        algorithm: A hashlib algorithm name
+        workers:   Number of hashing processes
+        manifest:  Path of a checksum file in 'sha256sum' format, relative
+                   paths are resolved against the snapshot
+        limiter:   IOLimiter applied to all filesystem access, the bytes
+                   of a file are acquired before it is handed to a worker"""
+
+        self.directory = directory
+        self.samples   = samples
+        self.algorithm = algorithm
+        self.workers   = workers
+        self.manifest  = manifest
+        self.limiter   = limiter
+
+    def __files(self, root, cancel):
+        """Yield the paths of all regular files below 'root', relative to it."""
+        stack = [ '' ]
+        while stack:
+            if cancel is not None and cancel.is_set():
+                raise DODCheckCancelled(f"Verification of '{root}' cancelled")
+            rel = stack.pop()
+            with self.limiter.scandir(os.path.join(root, rel)) as it:
+                for entry in it:
+                    path = os.path.join(rel, entry.name)
+                    if entry.is_dir(follow_symlinks = False):
+                        stack.append(path)
+                    elif entry.is_file(follow_symlinks = False):
+                        yield path
+
+    def __manifest(self, manifest, cancel):
+        """Yield (path, hash) tuples from the manifest at 'manifest'. The
+        bytes read are charged to the limiter in chunks as the file is read."""
+        self.limiter.acquire(cancel = cancel)
+        with open(manifest) as f:
+            nbytes = 0
+            for line in f:
+                nbytes += len(line)
+                if nbytes >= CHUNK_SIZE:
+                    self.limiter.acquire(ops = 0, nbytes = nbytes, cancel = cancel)
+                    nbytes = 0
+                digest, _, path = line.rstrip('\n').partition(' ')
+                if path:
+                    # 'sha256sum' separates with two characters, the second
+                    # one flags binary mode
+                    yield path[1:] if path[0] in ' *' else path, digest.lower()
+            self.limiter.acquire(ops = 0, nbytes = nbytes, cancel = cancel)
+
+    def __sample(self, items):
+        """Reservoir sample from an iterable of unknown length."""
+        rng    = random.SystemRandom()
+        sample = []
+        for i, item in enumerate(items):
+            if i < self.samples:
+                sample.append(item)
+            else:
+                j = rng.randrange(i + 1)
+                if j < self.samples:
+                    sample[j] = item
+        return sample
+
+    def verify(self, snapshot, previous = None, cancel = None):
+        """Verify a sample of files of a snapshot.
+
+        Parameters:
+        snapshot: Path of the snapshot relative to the backup directory
+        previous: Path of the previous snapshot, None if there is none
+        cancel:   Optional threading.Event, verification raises
+                  DODCheckCancelled once it is set
+
+        Returns a VerificationResult."""
+
+        root   = os.path.join(self.directory, snapshot)
+        result = VerificationResult()
+        start  = time.monotonic()
+
+        if self.manifest:
+            manifest = os.path.join(root, self.manifest)
+            try:
+                self.limiter.stat(manifest)
+            except FileNotFoundError:
+                result.missing_manifest = manifest
+                return result
+            sample = self.__sample(self.__manifest(manifest, cancel))
+        else:
+            sample = [ (path, None) for path in self.__sample(self.__files(root, cancel)) ]
+        result.sampled = len(sample)
+
+        # Determine what each sampled file is compared against
+        jobs = []
+        for path, expected in sample:
+            try:
+                st = self.limiter.stat(os.path.join(root, path))
+            except OSError as e:
+                result.errors.append((path, e.strerror or e))
+                continue
+            if expected is None and previous is not None:
+                try:
+                    prev_st = self.limiter.stat(os.path.join(self.directory, previous, path))
+                except OSError:
+                    prev_st = None
+                if prev_st is not None and stat.S_ISREG(prev_st.st_mode) \
+                        and (st.st_size, st.st_mtime_ns) == (prev_st.st_size, prev_st.st_mtime_ns):
+                    if (st.st_dev, st.st_ino) == (prev_st.st_dev, prev_st.st_ino):
+                        expected = 'hardlink'
+                    else:
+                        expected = os.path.join(self.directory, previous, path)
+            jobs.append((path, expected, st.st_size))
+
+        tasks = []
+        for path, expected, size in jobs:
+            tasks.append((os.path.join(root, path), (path, 'current'), size))
+            if expected not in (None, 'hardlink') and not self.manifest:
+                tasks.append((expected, (path, 'previous'), size))
+        tasks = iter(tasks)
+
+        context = multiprocessing.get_context('forkserver')
+        pool    = ProcessPoolExecutor(max_workers = self.workers, mp_context = context)
+        try:
+            futures = {}
+            digests = {}
+            pending = set()
+            while True:
+                # Keep the pool busy, but only hand out as many bytes as the
+                # rate limit allows
+                while len(pending) < 2 * self.workers:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    fpath, key, size = task
+                    try:
+                        self.limiter.acquire(nbytes = size, cancel = cancel)
+                    except DODCheckCancelled:
+                        raise DODCheckCancelled(f"Verification of '{root}' cancelled")
+                    future = pool.submit(hash_file, fpath, self.algorithm)
+                    futures[future] = key
+                    pending.add(future)
+                if not pending:
+                    break
+                done, pending = wait(pending, timeout = 1, return_when = FIRST_COMPLETED)
+                if cancel is not None and cancel.is_set():
+                    raise DODCheckCancelled(f"Verification of '{root}' cancelled")
+                for future in done:
+                    try:
+                        digests[futures[future]], size = future.result()
+                        result.bytes += size
+                    except OSError as e:
+                        digests[futures[future]] = e
+        except BaseException:
+            # Unlike leaving a 'with' block, this does not wait for the
+            # hashes in progress
+            pool.shutdown(wait = False, cancel_futures = True)
+            raise
+        pool.shutdown()
+
+        for path, expected, _ in jobs:
+            digest = digests[path, 'current']
+            if isinstance(digest, OSError):
+                result.errors.append((path, digest.strerror or digest))
+            elif expected is None:
+                result.unverified += 1
+            elif expected == 'hardlink':
+                result.unchanged += 1
+            else:
+                reference = expected if self.manifest else digests[path, 'previous']
+                if isinstance(reference, OSError):
+                    result.errors.append((os.path.join('..', previous, path), reference.strerror or reference))
+                    continue
+                result.verified += 1
+                if digest != reference:
+                    result.mismatches.append(path)
+
+        result.seconds = time.monotonic() - start
+        return result
@@ -0,0 +1,177 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+####################################################################################################
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+####################################################################################################
+
+from dodreporter.error import DODReporterError
+
+####################################################################################################
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    scope TEXT NOT NULL,
+    key   TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (scope, key)
+);
+CREATE TABLE IF NOT EXISTS history (
+    ts     REAL NOT NULL,
+    scope  TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value  REAL
+);
+CREATE INDEX IF NOT EXISTS history_lookup ON history (scope, metric, ts);
+CREATE TABLE IF NOT EXISTS alerts (
+    key     TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    payload TEXT NOT NULL
+);
+"""
+
+class StateStore:
+    """Persistent runtime state in an SQLite database in WAL mode.
+
+    The store holds JSON values per scope and key (e.g. the scan index of a
+    host), a history of numeric metrics for trend reports and a table of
+    pending alerts. Writes are buffered in memory, reads see buffered writes,
+    and flush() commits all buffered writes in a single transaction. History
+    samples older than the retention period are pruned hourly."""
+
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, path, retention = None):
+        """Construct a new StateStore object.
+
+        Parameters:
+        path:      The database file, ':memory:' for a volatile store
+        retention: Seconds to keep history samples, None to keep them forever"""
+
+        self.path      = path
+        self.retention = retention
+        try:
+            if path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+            self.__db = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('PRAGMA synchronous=NORMAL')
+            self.__db.executescript(SCHEMA)
+        except (OSError, sqlite3.Error) as e:
+            raise DODReporterError(f"Cannot open state database '{path}': {e}")
+        self.__lock    = threading.RLock()
+        self.__values  = {}
+        self.__history = []
+        self.__alerts  = {}
+        self.__pruned  = None
+
+    def get(self, scope, key, default = None):
+        """Return the value stored for 'key' in 'scope'."""
+        with self.__lock:
+            if (scope, key) in self.__values:
+                value = self.__values[scope, key]
+                return default if value is None else value
+            row = self.__db.execute('SELECT value FROM state WHERE scope = ? AND key = ?', (scope, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def items(self, scope):
+        """Return the keys and values stored in 'scope' as a dict."""
+        with self.__lock:
+            items = { key : json.loads(value) for key, value in self.__db.execute('SELECT key, value FROM state WHERE scope = ?', (scope,)) }
+            for (s, key), value in self.__values.items():
+                if s == scope:
+                    if value is None:
+                        items.pop(key, None)
+                    else:
+                        items[key] = value
+        return items
+
+    def keys(self, scope):
+        """Return the keys stored in 'scope', sorted."""
+        return sorted(self.items(scope))
+
+    def set(self, scope, key, value):
+        """Store a JSON serializable value, None deletes the key."""
+        with self.__lock:
+            self.__values[scope, key] = value
+
+    def record(self, scope, metric, value, ts = None):
+        """Append a sample to the metric history."""
+        with self.__lock:
+            self.__history.append((ts or time.time(), scope, metric, value))
+
+    def history(self, scope, metric, since = 0):
+        """Return the (timestamp, value) samples of a metric since 'since'."""
+        self.flush()
+        with self.__lock:
+            return self.__db.execute('SELECT ts, value FROM history WHERE scope = ? AND metric = ? AND ts >= ? ORDER BY ts',
+                    (scope, metric, since)).fetchall()
+
+    def alert(self, key):
+        """Return the payload of a pending alert, None if there is none."""
+        with self.__lock:
+            if key in self.__alerts:
+                return self.__alerts[key]
+            row = self.__db.execute('SELECT payload FROM alerts WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_alert(self, key, payload):
+        """Mark an alert as pending, None clears it."""
+        with self.__lock:
+            self.__alerts[key] = payload
+
+    def flush(self):
+        """Commit all buffered writes in one transaction."""
+        with self.__lock:
+            if not (self.__values or self.__history or self.__alerts):
+                return
+            try:
+                self.__db.execute('BEGIN')
+                self.__db.executemany('DELETE FROM state WHERE scope = ? AND key = ?',
+                        [ k for k, v in self.__values.items() if v is None ])
+                self.__db.executemany('INSERT OR REPLACE INTO state (scope, key, value) VALUES (?, ?, ?)',
+                        [ (scope, key, json.dumps(v)) for (scope, key), v in self.__values.items() if v is not None ])
+                self.__db.executemany('INSERT INTO history (ts, scope, metric, value) VALUES (?, ?, ?, ?)', self.__history)
+                self.__db.executemany('DELETE FROM alerts WHERE key = ?',
+                        [ (k,) for k, v in self.__alerts.items() if v is None ])
+                self.__db.executemany('INSERT OR REPLACE INTO alerts (key, created, payload) VALUES (?, ?, ?)',
+                        [ (k, time.time(), json.dumps(v)) for k, v in self.__alerts.items() if v is not None ])
+                if self.retention and (self.__pruned is None or time.monotonic() - self.__pruned >= self.PRUNE_INTERVAL):
+                    self.__db.execute('DELETE FROM history WHERE ts < ?', (time.time() - self.retention,))
+                    self.__pruned = time.monotonic()
+                self.__db.execute('COMMIT')
+            except BaseException:
+                # Also on serialization errors, an open transaction would
+                # fail every later flush
+                self.__db.execute('ROLLBACK')
+                raise
+            self.__values, self.__history, self.__alerts = {}, [], {}
+
+    def close(self):
+        """Flush buffered writes and close the database."""
+        with self.__lock:
+            self.flush()
+            self.__db.close()
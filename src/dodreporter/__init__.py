@@ -25,13 +25,27 @@ import time
 import signal
 import os
 import threading
+from datetime import datetime
 
 ####################################################################################################
 
+# Modules that pull in heavy dependencies (email, smtplib, ssl, sqlite3,
+# multiprocessing) are imported where they are first used, so that the
+# startup time is not dominated by imports
 from dodreporter.error import DODReporterConfigError, DODReporterError
-from dodreporter import config, log, SMTPClient
-from dodreporter.runners import DODCryptRunner
-from dodreporter.runners import DODHostRunner
+from dodreporter import config, log, tracing
+
+####################################################################################################
+
+# Exit codes of a single run, the most severe outcome determines the code.
+# The keys are the DODHostResult status values.
+EXIT_CODES = {
+        'OK'      : 0,
+        'WARNING' : 3,
+        'TIMEOUT' : 4,
+        'FAILED'  : 5,
+        }
+EXIT_CRYPT_UNAVAILABLE = 6
 
 ####################################################################################################
 
@@ -39,63 +53,395 @@ class DODReporter:
     """Encapsulates the DOD reporter runtime logic."""
 
     terminate_event = threading.Event()
-    smtp_lock       = threading.Lock()
 
     def terminate(self):
-        """Terminate the runner threads by triggering the terminate event."""
+        """Terminate the runner threads by triggering the terminate event.
+        Host checks that are currently running are allowed to finish."""
 
         self.terminate_event.set()
-        for t in self.threads:
-            t.join()
+        self.crypt_runner.interrupt()
+        if self.scheduler:
+            self.scheduler.shutdown()
+        if self.aggregator:
+            # Stop receiving, then send what was collected
+            self.aggregator.shutdown()
+        elif self.digest:
+            # Send what was collected for a batch that was interrupted
+            self.digest.flush()
+        self.join()
 
     def join(self):
-        """Join all runner threads."""
+        """Join all runner threads, then shut down the mail queue."""
 
         for t in self.threads:
             t.join()
+        if self.agent:
+            self.agent.shutdown()
+        if self.aggregator:
+            self.aggregator.shutdown()
+        if self.mail_queue:
+            self.mail_queue.shutdown()
+            self.smtp_client.close()
+        if self.metrics_exporter:
+            self.metrics_exporter.shutdown()
+        if self.capacity:
+            self.capacity.close()
+        self.state.close()
+        tracing.dump()
+
+    def reload(self):
+        """Re-read the configuration and apply the changes to the host
+        runners: runners of removed hosts are unscheduled, runners of changed
+        hosts are updated in place and new hosts are checked immediately.
+        Runners of unchanged hosts are not touched. If the new configuration
+        is invalid, the current one is kept."""
+
+        from dodreporter.runners import DODHostRunner
+
+        with self.reload_lock:
+            start = time.monotonic()
+            try:
+                with tracing.span('config.load'):
+                    new_config = config.get_config()
+                configure_log(new_config)
+            except (DODReporterError, ValueError) as e:
+                log.log(f"[reload] Keeping the current configuration, reload failed: {e}", level = log.ERROR)
+                return
+
+            old_hosts = { host_setting.name : host_setting for host_setting in self.config.host_settings }
+            new_hosts = { host_setting.name : host_setting for host_setting in new_config.host_settings }
+            added     = [ name for name in new_hosts if name not in old_hosts ]
+            removed   = [ name for name in old_hosts if name not in new_hosts ]
+            changed   = [ name for name in new_hosts if name in old_hosts and new_hosts[name] != old_hosts[name] ]
+            if new_config.global_settings != self.config.global_settings:
+                log.log("[reload] Global settings changed. Changes to the mail, worker and I/O limit settings take effect after a restart.", level = log.WARNING)
+            self.config = new_config
+
+            for name in removed:
+                self.scheduler.remove(name)
+                self.runners.pop(name).retire()
+            for name in changed:
+                self.runners[name].update(new_hosts[name])
+            now = datetime.now()
+            for name in added:
+                self.runners[name] = DODHostRunner(self, name)
+                self.scheduler.add(self.runners[name], now)
+
+            log.log(f"[reload] Configuration reloaded: "
+                    f"{len(added)} added, {len(removed)} removed, {len(changed)} changed, "
+                    f"{len(new_hosts) - len(added) - len(changed)} unchanged.",
+                    duration = round(time.monotonic() - start, 4))
+
+    def fs_semaphore(self, fs_key):
+        """Return the semaphore limiting concurrent host checks on the
+        filesystem identified by 'fs_key'."""
 
-    def smtp_send(self, *args, **kwargs):
-        """Wrapper for SMTPClient.sendMessage() that sets the sender address
-        configured in the global settings."""
+        with self.fs_lock:
+            if fs_key not in self.fs_semaphores:
+                self.fs_semaphores[fs_key] = threading.BoundedSemaphore(self.config.global_settings.fs_workers)
+            return self.fs_semaphores[fs_key]
 
-        with self.smtp_lock:
-            self.smtp_client.sendMessage(
-                    sender = self.config.global_settings.smtp_from,
-                    *args,
-                    **kwargs)
+    def smtp_send(self, **kwargs):
+        """Queue a message for SMTPClient.sendMessage() with the sender
+        address configured in the global settings. Returns immediately, the
+        message is delivered by the mail queue thread. In dry run mode, the
+        message is printed instead, in the agent role it is pushed to the
+        aggregator."""
 
-    def __init__(self, config):
+        if self.dry_run:
+            self.__print_message(**kwargs)
+            return
+        if self.agent:
+            self.agent.add_message(**kwargs)
+            return
+        self.mail_queue.put(
+                sender = self.config.global_settings.smtp_from,
+                **kwargs)
+
+    def __print_message(self, recipients, subject, message_text, attachments = {}, **_):
+        """Print a message to stdout instead of sending it."""
+
+        with self.print_lock:
+            print(f"To: {', '.join(address for _, address in recipients)}")
+            print(f"Subject: {subject}")
+            for fname in attachments:
+                print(f"Attachment: {fname}")
+            print(f"\n{message_text}", flush = True)
+
+    def run_once(self, hosts = None):
+        """Run the crypt check and the checks of the selected hosts once, in
+        parallel, and wait for the reports to be handed to the relay. Returns
+        the exit code for the most severe outcome.
+
+        Parameters:
+        hosts: Names of the hosts to check, all hosts if None"""
+
+        from concurrent.futures import ThreadPoolExecutor
+        from dodreporter.runners import DODHostRunner
+
+        names   = hosts or [ host_setting.name for host_setting in self.config.host_settings ]
+        runners = [ DODHostRunner(self, name) for name in names ]
+        if self.capacity:
+            # Sampled first, the host reports include the forecasts
+            self.capacity.run()
+        with ThreadPoolExecutor(max_workers = self.config.global_settings.host_workers + 1) as executor:
+            crypt   = executor.submit(self.crypt_runner.check_once)
+            results = list(executor.map(lambda runner : runner.run(), runners))
+        if self.digest:
+            self.digest.flush()
+        self.join()
+
+        codes = [ EXIT_CODES[result.status] for result in results ]
+        if not crypt.result():
+            codes.append(EXIT_CRYPT_UNAVAILABLE)
+        return max(codes, default = 0)
+
+    def __init__(self, config, once = False, dry_run = False):
         """Construct a new DODReporter instance.
 
         Parameters:
-        config: The global runtime configuration"""
+        config:  The global runtime configuration
+        once:    Do not start the runner threads, checks are run by run_once()
+        dry_run: Print the reports instead of sending them"""
 
-        self.config = config
+        from dodreporter import StateStore
+        from dodreporter.IOLimiter import IOLimiter
+        from dodreporter.runners import DODCryptRunner, DODCapacityRunner
+
+        self.config     = config
+        self.once       = once
+        self.dry_run    = dry_run
+        self.print_lock = threading.Lock()
+        self.reload_lock = threading.Lock()
         gs = config.global_settings
 
-        # Set up smtp client
-        self.smtp_client = SMTPClient.SMTPClient(
-                hostname = gs.smtp_host,
-                port     = gs.smtp_port,
-                user     = gs.smtp_user,
-                password = gs.smtp_pass,
-                tls      = not gs.smtp_no_tls)
+        # Persistent state shared by all runners
+        self.state = StateStore.StateStore(os.path.join(gs.state_dir, 'state.db'),
+                retention = gs.history_days * 86400 or None)
 
-        # Set up runner threads
-        self.threads = [ DODCryptRunner(self) ] + [ DODHostRunner(self, host_setting.name) for host_setting in config.host_settings ]
+        self.fs_lock       = threading.Lock()
+        self.fs_semaphores = {}
+
+        # Shared I/O limiter for all hosts without own limits
+        self.io_limiter = IOLimiter(
+                iops          = gs.io_iops,
+                bps           = gs.io_bps,
+                strict_iops   = gs.strict_iops,
+                strict_bps    = gs.strict_bps,
+                strict_window = gs.strict_window)
+
+        # Set up smtp client and the outbound mail queue. Agents push their
+        # results and messages to the aggregator, which mails them.
+        self.smtp_client = None
+        self.mail_queue  = None
+        self.agent       = None
+        if dry_run:
+            pass
+        elif gs.role == 'agent':
+            from dodreporter.Cluster import Agent
+            self.agent = Agent(
+                    node      = gs.node_name,
+                    endpoint  = gs.aggregator,
+                    store     = self.state,
+                    spool_dir = os.path.join(gs.state_dir, 'agent'),
+                    token     = gs.aggregator_token,
+                    timeout   = gs.smtp_timeout,
+                    retry_min = gs.mail_retry_min,
+                    retry_max = gs.mail_retry_max,
+                    max_body  = gs.aggregator_max_body)
+            self.agent.start()
+        else:
+            self.__setup_mail(gs)
+
+        # The aggregator always sends digests, combining the results of all
+        # nodes
+        if (gs.digest or gs.role == 'aggregator') and not self.agent:
+            from dodreporter import Digest
+            self.digest = Digest.Digest(self)
+        else:
+            self.digest = None
+        self.aggregator = None
+        self.crypt_runner = DODCryptRunner(self)
+        self.capacity     = DODCapacityRunner(self) if gs.capacity_interval else None
+        self.scheduler    = None
+        self.runners      = {}
+        self.threads      = []
+        self.metrics_exporter = None
+        if gs.metrics_listen or gs.metrics_textfile:
+            self.__setup_metrics(gs)
+        if once:
+            return
+
+        if gs.role == 'aggregator':
+            from dodreporter.Cluster import Aggregator
+            self.aggregator = Aggregator(
+                    self,
+                    endpoint  = gs.aggregator,
+                    spool_dir = os.path.join(gs.state_dir, 'aggregator'),
+                    token     = gs.aggregator_token,
+                    window    = gs.aggregator_window,
+                    max_body  = gs.aggregator_max_body)
+            self.aggregator.start()
+
+        # Set up the scheduler for the host runners, all hosts are checked
+        # once initially
+        from dodreporter import Scheduler
+        from dodreporter.runners import DODHostRunner
+        self.scheduler = Scheduler.Scheduler(
+                workers           = gs.host_workers,
+                on_batch_complete = self.__batch_complete)
+        now = datetime.now()
+        if self.capacity:
+            # Sampled before the hosts are checked, the host reports include
+            # the forecasts. Later samples do not join the host batches.
+            try:
+                self.capacity.run()
+            except Exception as e:
+                log.log(f"[capacity] Initial sample failed: {e!r}", level = log.ERROR)
+            self.scheduler.add(self.capacity, self.capacity.next_run(now))
+        for host_setting in config.host_settings:
+            self.runners[host_setting.name] = DODHostRunner(self, host_setting.name)
+            self.scheduler.add(self.runners[host_setting.name], now)
 
         # Start runner threads
+        self.threads = [ self.crypt_runner, self.scheduler ]
         for t in self.threads:
             t.start()
 
+    def __batch_complete(self, when):
+        """Called by the scheduler once all host checks triggered at 'when'
+        have completed."""
+
+        if self.aggregator:
+            # Results of other nodes may still arrive
+            self.aggregator.schedule_flush()
+        elif self.digest:
+            self.digest.flush(when)
+        if self.agent:
+            self.agent.flush(when)
+        tracing.dump()
+
+    def __setup_metrics(self, gs):
+        """Register the metrics that are computed at collection time and
+        start the metrics exporter."""
+
+        from dodreporter import Metrics
+
+        Metrics.gauge('dod_threads', 'Number of live threads', callback = threading.active_count)
+        Metrics.gauge('dod_scheduler_workers', 'Size of the host check worker pool',
+                callback = lambda : self.scheduler.workers if self.scheduler else 0)
+        Metrics.gauge('dod_scheduler_running_jobs', 'Host checks currently running',
+                callback = lambda : self.scheduler.running if self.scheduler else 0)
+        Metrics.gauge('dod_scheduler_queued_jobs', 'Host checks waiting for their trigger time',
+                callback = lambda : self.scheduler.queued if self.scheduler else 0)
+        Metrics.gauge('dod_crypt_path_available', 'Whether an encrypted volume path exists', ('path',),
+                callback = lambda : dict(zip(self.crypt_runner.paths, map(int, self.crypt_runner.last_status or []))))
+        if self.agent:
+            Metrics.gauge('dod_agent_pending_records', 'Records waiting to be pushed to the aggregator',
+                    callback = lambda : self.agent.pending)
+        if self.mail_queue:
+            Metrics.gauge('dod_mail_queue_depth', 'Messages waiting for delivery',
+                    callback = lambda : self.mail_queue.depth)
+            Metrics.counter('dod_mail_delivered_total', 'Messages delivered by the mail queue',
+                    callback = lambda : self.mail_queue.stats()['delivered'])
+            Metrics.counter('dod_mail_failed_total', 'Messages permanently refused by the relay',
+                    callback = lambda : self.mail_queue.stats()['failed'])
+
+        try:
+            self.metrics_exporter = Metrics.MetricsExporter(
+                    listen   = gs.metrics_listen,
+                    textfile = gs.metrics_textfile,
+                    interval = gs.metrics_interval)
+        except OSError as e:
+            raise DODReporterConfigError(f"Cannot listen on {gs.metrics_listen}: {e}")
+        self.metrics_exporter.start()
+
+    def __setup_mail(self, gs):
+        """Set up the SMTP client and start the mail queue."""
+
+        from dodreporter import SMTPClient, MailQueue
+
+        self.smtp_client = SMTPClient.SMTPClient(
+                hostname  = gs.smtp_host,
+                port      = gs.smtp_port,
+                user      = gs.smtp_user,
+                password  = gs.smtp_pass,
+                tls       = not gs.smtp_no_tls,
+                pool_size = gs.smtp_pool_size,
+                max_idle  = gs.smtp_max_idle,
+                timeout   = gs.smtp_timeout,
+                compress  = gs.compress,
+                compress_threshold = gs.compress_threshold)
+
+        # Set up the outbound mail queue
+        self.mail_queue = MailQueue.MailQueue(
+                self.smtp_client,
+                spool_dir = gs.spool_dir,
+                retry_min = gs.mail_retry_min,
+                retry_max = gs.mail_retry_max)
+        self.mail_queue.start()
+
 ####################################################################################################
 
+def configure_log(cfg):
+    """Configure the log backend from the global settings."""
+
+    gs = cfg.global_settings
+    try:
+        log.configure(
+                level         = gs.log_level,
+                sinks         = gs.log_sinks,
+                rate_burst    = gs.log_rate_burst,
+                rate_interval = gs.log_rate_interval)
+    except OSError as e:
+        raise DODReporterConfigError(f"Cannot open log sink: {e}")
+
+def parse_args(argv):
+    """Parse the command line arguments."""
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog = 'dod_reporter', description = 'DOD Reporter')
+    parser.add_argument('--once', action = 'store_true',
+            help = 'run the crypt check and the host checks once, then exit with a status code for the outcome')
+    parser.add_argument('--host', action = 'append', metavar = 'NAME',
+            help = 'only check the given host, can be given multiple times (requires --once)')
+    parser.add_argument('--dry-run', action = 'store_true',
+            help = 'print the reports instead of sending them')
+    parser.add_argument('--profile', metavar = 'DIR',
+            help = 'trace the checks, mail delivery and configuration loading and write the span trees to DIR')
+    parser.add_argument('--cprofile', action = 'store_true',
+            help = 'additionally write cProfile statistics of every traced run to DIR (requires --profile)')
+    args = parser.parse_args(argv[1:])
+    if args.host and not args.once:
+        parser.error('--host requires --once')
+    if args.cprofile and not args.profile:
+        parser.error('--cprofile requires --profile')
+    return args
+
 def main(argv=sys.argv):
     """Main function for the dod_reporter entry point."""
+    args = parse_args(argv)
     try:
-        cfg = config.get_config()
-        dod = DODReporter(cfg)
+        if args.profile:
+            try:
+                tracing.enable(args.profile, cprofile = args.cprofile)
+            except OSError as e:
+                raise DODReporterConfigError(f"Cannot create profile directory: {e}")
+        with tracing.span('config.load'):
+            cfg = config.get_config()
+        configure_log(cfg)
+        known = [ host_setting.name for host_setting in cfg.host_settings ]
+        for host in args.host or []:
+            if host not in known:
+                raise DODReporterConfigError(f"Unknown host '{host}', no such section in the config file.")
+        dod = DODReporter(cfg, once = args.once, dry_run = args.dry_run)
+        if args.once:
+            sys.exit(dod.run_once(args.host))
         signal.signal(signal.SIGTERM, lambda _, __ : dod.terminate())
+        # Reload on a separate thread, signals arriving during a reload must
+        # not re-enter it on the main thread
+        signal.signal(signal.SIGHUP, lambda _, __ : threading.Thread(target = dod.reload, name = 'reload').start())
         dod.join()
     except DODReporterConfigError as e:
         print(f'\nERROR: {e}')
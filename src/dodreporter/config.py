@@ -18,15 +18,101 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import configparser
+import os
+import pickle
 import re
 from dataclasses import dataclass, field
-from email.utils import parseaddr
+from datetime import time
 
 from dodreporter.error import DODReporterError, DODReporterConfigError
 
 ####################################################################################################
 
+# Main configuration file and directory of additional '*.conf' files, which
+# are read in lexical order after the main file
+CONFIG_FILE = '/etc/dod_reporter.conf'
+CONFIG_DIR  = '/etc/dod_reporter.conf.d'
+
+# Validated settings are cached here, keyed by the mtimes and sizes of the
+# configuration files
+CACHE_FILE  = '/var/cache/dod_reporter/config.cache'
+
+####################################################################################################
+
+def _parseaddr(addr):
+    """Parse an email address into a (name, address) tuple. The email
+    package is only imported if the configuration is actually parsed."""
+    from email.utils import parseaddr
+    return parseaddr(addr)
+
+def _parse_size(value, key):
+    """Parse a number with an optional K, M or G suffix (powers of 1024)."""
+    if value is None or value.strip() == '':
+        return None
+    m = re.fullmatch(r'\s*(\d+)\s*([KMG]?)\s*', value, re.IGNORECASE)
+    if not m:
+        raise DODReporterConfigError(f"Cannot parse value '{value}' of '{key}'")
+    return int(m.group(1)) * 1024 ** ' KMG'.index(m.group(2).upper() or ' ')
+
+def _parse_window(value, key):
+    """Parse a daily time window of the form 'HH:MM-HH:MM'."""
+    if value is None or value.strip() == '':
+        return None
+    m = re.fullmatch(r'\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*', value)
+    try:
+        return time(int(m.group(1)), int(m.group(2))), time(int(m.group(3)), int(m.group(4)))
+    except (AttributeError, ValueError):
+        raise DODReporterConfigError(f"Cannot parse time window '{value}' of '{key}'")
+
+def _parse_compression(value, key):
+    """Parse an attachment compression setting."""
+    value = value.strip().lower()
+    if value not in ('none', 'gzip', 'xz'):
+        raise DODReporterConfigError(f"Invalid value '{value}' of '{key}', expected 'none', 'gzip' or 'xz'")
+    return value
+
+def _parse_listen(value, key):
+    """Parse a listen address of the form '[address:]port'."""
+    if value is None or value.strip() == '':
+        return None
+    address, _, port = value.strip().rpartition(':')
+    if not port.isdigit():
+        raise DODReporterConfigError(f"Cannot parse listen address '{value}' of '{key}', expected '[address:]port'")
+    return address.strip('[]') or '127.0.0.1', int(port)
+
+def _parse_endpoint(value, key):
+    """Parse an endpoint of the form 'unix:<path>' or '[address:]port'.
+    Returns a tuple ('unix', path) or ('tcp', (address, port))."""
+    if value is None or value.strip() == '':
+        return None
+    if value.strip().startswith('unix:'):
+        return 'unix', value.strip()[5:]
+    return 'tcp', _parse_listen(value, key)
+
+def _hostname():
+    import socket
+    return socket.gethostname()
+
+def assigned_node(host_setting, nodes):
+    """Return the node a host is checked by. Hosts without a 'Node' key are
+    spread by rendezvous hashing, so adding or removing a node only moves
+    the hosts of that node."""
+    import hashlib
+    if host_setting.node:
+        return host_setting.node
+    return max(nodes, key = lambda node : hashlib.blake2b(f"{node}\0{host_setting.name}".encode('utf-8'), digest_size = 8).digest())
+
+def _parse_log_sinks(value, key):
+    """Parse a comma separated list of log sinks."""
+    sinks = [ sink.strip() for sink in value.split(',') if sink.strip() ]
+    for sink in sinks:
+        kind, _, arg = sink.partition(':')
+        if not (kind == 'stderr' and not arg or kind == 'file' and arg or kind == 'syslog'):
+            raise DODReporterConfigError(f"Invalid log sink '{sink}' in '{key}', expected 'stderr', 'file:<path>' or 'syslog[:<socket>]'")
+    return sinks
+
+####################################################################################################
+
 @dataclass
 class DODGlobalSettings:
     """Global settings"""
@@ -38,14 +124,52 @@ class DODGlobalSettings:
     smtp_user : str = None
     smtp_pass : str = None
     smtp_no_tls : bool = False
+    smtp_pool_size : int = 1
+    smtp_max_idle : int = 60
+    smtp_timeout : int = 60
+    compress : str = None
+    compress_threshold : int = 65536
+    spool_dir : str = '/var/spool/dod_reporter'
+    mail_retry_min : int = 30
+    mail_retry_max : int = 3600
+    host_workers : int = 4
+    fs_workers : int = 2
+    check_timeout : int = 3600
+    state_dir : str = '/var/lib/dod_reporter'
+    history_days : int = 400
+    digest : bool = False
+    io_iops : int = None
+    io_bps : int = None
+    strict_window : tuple = None
+    strict_iops : int = None
+    strict_bps : int = None
     crypt_dirs : list  = field(default_factory=list)
+    crypt_poll_interval : int = 3
+    log_level : str = 'info'
+    log_sinks : list = field(default_factory=lambda: ['stderr'])
+    log_rate_burst : int = 5
+    log_rate_interval : int = 60
+    metrics_listen : tuple = None
+    metrics_textfile : str = None
+    metrics_interval : int = 60
+    capacity_interval : int = 21600
+    capacity_samples : int = 4096
+    capacity_window : int = 30
+    capacity_alert_days : int = 14
+    role : str = 'standalone'
+    node_name : str = None
+    nodes : list = field(default_factory=list)
+    aggregator : tuple = None
+    aggregator_token : str = None
+    aggregator_window : int = 300
+    aggregator_max_body : int = 64 << 20
 
-    def __init__(self, config : configparser.ConfigParser):
+    def __init__(self, config : 'configparser.ConfigParser'):
         """Construct a DODGlobalSettings from a ConfigParser object"""
         general = config['General']
         # Mandatory
-        self.recipients = [ parseaddr(addr) for addr in str(general['recipients']).split(',') ]
-        self.smtp_from  = parseaddr(str(general['smtpfrom']))
+        self.recipients = [ _parseaddr(addr) for addr in str(general['recipients']).split(',') ]
+        self.smtp_from  = _parseaddr(str(general['smtpfrom']))
         # Optional
         self.initial_wait = general.getint('initialwait', 0)
         self.smtp_host    = general.get('smtphost', 'localhost')
@@ -53,7 +177,45 @@ class DODGlobalSettings:
         self.smtp_user    = general.get('smtpuser', None)
         self.smtp_pass    = general.get('smtppass', None)
         self.smtp_no_tls  = general.getboolean('smtpno_tls', False)
+        self.smtp_pool_size = general.getint('smtppoolsize', 1)
+        self.smtp_max_idle  = general.getint('smtpmaxidle', 60)
+        self.smtp_timeout   = general.getint('smtptimeout', 60)
+        self.compress       = _parse_compression(general.get('compressattachments', 'none'), 'compressattachments')
+        self.compress_threshold = _parse_size(general.get('compressthreshold', '64K'), 'compressthreshold')
+        self.spool_dir      = general.get('spooldir', '/var/spool/dod_reporter') or None
+        self.mail_retry_min = general.getint('mailretrymin', 30)
+        self.mail_retry_max = general.getint('mailretrymax', 3600)
+        self.host_workers   = general.getint('hostworkers', 4)
+        self.fs_workers     = general.getint('fsworkers', 2)
+        self.check_timeout  = general.getint('checktimeout', 3600)
+        self.state_dir      = general.get('statedir', '/var/lib/dod_reporter')
+        self.history_days   = general.getint('historydays', 400)
+        self.digest         = general.getboolean('digest', False)
+        self.io_iops        = _parse_size(general.get('iopslimit', None), 'iopslimit')
+        self.io_bps         = _parse_size(general.get('bytelimit', None), 'bytelimit')
+        self.strict_window  = _parse_window(general.get('strictwindow', None), 'strictwindow')
+        self.strict_iops    = _parse_size(general.get('strictiopslimit', None), 'strictiopslimit')
+        self.strict_bps     = _parse_size(general.get('strictbytelimit', None), 'strictbytelimit')
         self.crypt_dirs   = general.get('cryptdirs', None).split(',') if general.get('cryptdirs', None) else []
+        self.crypt_poll_interval = general.getint('cryptpollinterval', 3)
+        self.log_level      = general.get('loglevel', 'info').strip().lower()
+        self.log_sinks      = _parse_log_sinks(general.get('logsinks', 'stderr'), 'logsinks')
+        self.log_rate_burst = general.getint('lograteburst', 5)
+        self.log_rate_interval = general.getint('lograteinterval', 60)
+        self.metrics_listen    = _parse_listen(general.get('metricslisten', None), 'metricslisten')
+        self.metrics_textfile  = general.get('metricstextfile', None) or None
+        self.metrics_interval  = general.getint('metricsinterval', 60)
+        self.capacity_interval = general.getint('capacityinterval', 21600)
+        self.capacity_samples  = general.getint('capacitysamples', 4096)
+        self.capacity_window   = general.getint('capacitywindow', 30)
+        self.capacity_alert_days = general.getint('capacityalertdays', 14)
+        self.role              = general.get('role', 'standalone').strip().lower()
+        self.node_name         = general.get('nodename', None) or _hostname()
+        self.nodes             = [ node.strip() for node in general.get('nodes', '').split(',') if node.strip() ]
+        self.aggregator        = _parse_endpoint(general.get('aggregator', None), 'aggregator')
+        self.aggregator_token  = general.get('aggregatortoken', None) or None
+        self.aggregator_window = general.getint('aggregatorwindow', 300)
+        self.aggregator_max_body = _parse_size(general.get('aggregatormaxbody', '64M'), 'aggregatormaxbody')
 
         if self.smtp_from == ('',''):
             s = general['smtpfrom']
@@ -63,22 +225,98 @@ class DODGlobalSettings:
             if email == ('',''):
                 raise DODReporterConfigError(f"Cannot parse email address in global recipients: '{email}'")
 
+        if self.smtp_pool_size < 1:
+            raise DODReporterConfigError("'smtppoolsize' must be at least 1")
+        if self.host_workers < 1:
+            raise DODReporterConfigError("'hostworkers' must be at least 1")
+        if self.fs_workers < 1:
+            raise DODReporterConfigError("'fsworkers' must be at least 1")
+        if self.capacity_interval < 0:
+            raise DODReporterConfigError("'capacityinterval' must not be negative")
+        if self.capacity_samples < 1:
+            raise DODReporterConfigError("'capacitysamples' must be at least 1")
+        if self.history_days < 0:
+            raise DODReporterConfigError("'historydays' must not be negative")
+        if self.capacity_window < 1:
+            raise DODReporterConfigError("'capacitywindow' must be at least 1")
+        if self.role not in ('standalone', 'agent', 'aggregator'):
+            raise DODReporterConfigError(f"Invalid role '{self.role}', expected 'standalone', 'agent' or 'aggregator'")
+        if self.role != 'standalone' and not self.aggregator:
+            raise DODReporterConfigError(f"Role '{self.role}' requires the 'aggregator' endpoint")
+        if self.role != 'standalone' and self.aggregator[0] == 'tcp' and not self.aggregator_token:
+            # Otherwise anyone who reaches the port could relay mail
+            raise DODReporterConfigError(f"Role '{self.role}' requires 'aggregatortoken' for a TCP 'aggregator' endpoint")
+        if not self.aggregator_max_body:
+            raise DODReporterConfigError("'aggregatormaxbody' must be at least 1")
+        if self.nodes and self.node_name not in self.nodes:
+            raise DODReporterConfigError(f"Node name '{self.node_name}' is not listed in 'nodes'")
+        if self.log_level not in ('debug', 'info', 'warning', 'error'):
+            raise DODReporterConfigError(f"Invalid log level '{self.log_level}', expected 'debug', 'info', 'warning' or 'error'")
+
 ####################################################################################################
 
 @dataclass
 class DODHostSettings:
     """Per host settings"""
 
-    name       : str
-    directory  : str
-    recipients : list
+    name          : str
+    directory     : str
+    recipients    : list
+    check_timeout : int = 3600
+    filesystem    : str = None
+    snapshot_depth  : int = 1
+    snapshot_marker : str = None
+    max_age         : int = 7
+    usage           : bool = False
+    usage_workers   : int = 4
+    verify_samples  : int = 0
+    verify_hash     : str = 'sha256'
+    verify_workers  : int = 2
+    verify_manifest : str = None
+    io_iops         : int = None
+    io_bps          : int = None
+    strict_iops     : int = None
+    strict_bps      : int = None
+    compress        : str = None
+    compress_threshold : int = None
+    rsync_logs      : list = field(default_factory=list)
+    rsync_log_workers : int = 2
+    node            : str = None
 
-    def __init__(self, config : configparser.ConfigParser, section_name : str):
+    def __init__(self, config : 'configparser.ConfigParser', section_name : str):
         self.name = section_name
         host = config[self.name]
+        general = config['General']
         # Mandatory
         self.directory = host['Directory']
-        self.recipients = [ parseaddr(addr) for addr in host['Recipients'].split(',') ]
+        self.recipients = [ _parseaddr(addr) for addr in host['Recipients'].split(',') ]
+        # Optional
+        self.check_timeout = host.getint('CheckTimeout', general.getint('checktimeout', 3600))
+        self.filesystem    = host.get('Filesystem', None)
+        self.snapshot_depth  = host.getint('SnapshotDepth', 1)
+        self.snapshot_marker = host.get('SnapshotMarker', None)
+        self.max_age         = host.getint('MaxAge', 7)
+        self.usage           = host.getboolean('Usage', False)
+        self.usage_workers   = host.getint('UsageWorkers', 4)
+        self.verify_samples  = host.getint('VerifySamples', 0)
+        self.verify_hash     = host.get('VerifyHash', 'sha256').lower()
+        self.verify_workers  = host.getint('VerifyWorkers', 2)
+        self.verify_manifest = host.get('VerifyManifest', None)
+        self.io_iops         = _parse_size(host.get('IOPSLimit', None), 'IOPSLimit')
+        self.io_bps          = _parse_size(host.get('ByteLimit', None), 'ByteLimit')
+        self.strict_iops     = _parse_size(host.get('StrictIOPSLimit', None), 'StrictIOPSLimit')
+        self.strict_bps      = _parse_size(host.get('StrictByteLimit', None), 'StrictByteLimit')
+        self.compress        = _parse_compression(host['CompressAttachments'], 'CompressAttachments') if 'CompressAttachments' in host else None
+        self.compress_threshold = _parse_size(host.get('CompressThreshold', None), 'CompressThreshold')
+        self.rsync_logs      = [ pattern.strip() for pattern in host.get('RsyncLogs', '').split(',') if pattern.strip() ]
+        self.rsync_log_workers = host.getint('RsyncLogWorkers', 2)
+        self.node            = host.get('Node', None) or None
+
+        if self.snapshot_depth < 1:
+            raise DODReporterConfigError(f"'SnapshotDepth' must be at least 1 in section '{self.name}'")
+        import hashlib
+        if self.verify_hash not in hashlib.algorithms_available:
+            raise DODReporterConfigError(f"Unknown hash algorithm '{self.verify_hash}' in section '{self.name}'")
 
         for email in self.recipients:
             if email == ('',''):
@@ -91,12 +329,91 @@ class DODSettings:
     """DOD runtime settings"""
     global_settings : DODGlobalSettings
     host_settings   : list
+    host_index      : dict = field(default_factory=dict, init=False, repr=False, compare=False)
+
+    def host(self, name):
+        """Return the DODHostSettings for the host section 'name'."""
+        if name not in self.host_index:
+            # Host settings were added after the last lookup
+            self.host_index = { host_setting.name : host_setting for host_setting in self.host_settings }
+        return self.host_index[name]
 
 ####################################################################################################
 
-def get_config():
+def _config_files(config_file, config_dir):
+    """Return the configuration files to read, in order."""
+    try:
+        extra = sorted(entry.path for entry in os.scandir(config_dir) if entry.name.endswith('.conf') and entry.is_file())
+    except FileNotFoundError:
+        extra = []
+    return [ config_file ] + extra
+
+def _cache_key(files):
+    """Return the cache key for a list of configuration files. The key also
+    covers this module, so a changed settings layout invalidates the cache,
+    and the host name, which is the default node name."""
+    key = [ _hostname() ]
+    for path in [ __file__ ] + files:
+        try:
+            st = os.stat(path)
+            key.append((path, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            key.append((path, None, None))
+    return key
+
+def _load_cache(cache_file, key):
+    """Return the cached settings if they were stored under 'key'."""
+    try:
+        with open(cache_file, 'rb') as infile:
+            cached_key, settings = pickle.load(infile)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, AttributeError, ImportError):
+        return None
+    return settings if cached_key == key else None
+
+def _store_cache(cache_file, key, settings):
+    """Atomically write the settings to the cache. The cache contains the
+    SMTP credentials and is only readable by the owner. Failures are ignored,
+    the configuration is parsed again on the next start."""
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+        with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as outfile:
+            pickle.dump((key, settings), outfile, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
+
+def get_config(config_file = CONFIG_FILE, config_dir = CONFIG_DIR, cache_file = CACHE_FILE):
+    """Read and validate the configuration. The main configuration file is
+    read first, followed by the '*.conf' files in the configuration directory.
+    Validated settings are served from the cache file as long as none of the
+    files changed.
+
+    Parameters:
+    config_file: Path of the main configuration file
+    config_dir:  Directory with additional configuration files
+    cache_file:  Path of the settings cache, None to disable caching"""
+
+    files = _config_files(config_file, config_dir)
+    key   = _cache_key(files)
+    if cache_file:
+        settings = _load_cache(cache_file, key)
+        if settings is not None:
+            return settings
+
+    settings = _parse_config(files)
+    if cache_file:
+        _store_cache(cache_file, key, settings)
+    return settings
+
+def _parse_config(files):
+    """Parse and validate the given configuration files."""
+    import configparser
     configfile = configparser.ConfigParser()
-    configfile.read(['/etc/dod_reporter.conf'])
+    configfile.read(files)
 
     # Validate 'General' section
     if "General" not in configfile:
@@ -117,4 +434,12 @@ def get_config():
             except KeyError as e:
                 raise DODReporterConfigError(f"Missing configuration key {e} in section '{section}'")
 
+    # Keep the hosts assigned to this node
+    gs = settings.global_settings
+    if gs.nodes:
+        for host_setting in settings.host_settings:
+            if host_setting.node and host_setting.node not in gs.nodes:
+                raise DODReporterConfigError(f"Node '{host_setting.node}' of section '{host_setting.name}' is not listed in 'nodes'")
+        settings.host_settings = [ host_setting for host_setting in settings.host_settings if assigned_node(host_setting, gs.nodes) == gs.node_name ]
+
     return settings
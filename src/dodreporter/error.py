@@ -23,3 +23,6 @@ class DODReporterError(RuntimeError):
 
 class DODReporterConfigError(RuntimeError):
     pass
+
+class DODCheckCancelled(DODReporterError):
+    pass
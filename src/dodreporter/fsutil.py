@@ -0,0 +1,104 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import shutil
+import tempfile
+
+####################################################################################################
+
+def _unescape(field):
+    """Decode the octal escapes used for whitespace in /proc/self/mounts."""
+    return field.replace('\\040', ' ').replace('\\011', '\t').replace('\\012', '\n').replace('\\134', '\\')
+
+def mount_point(path, mounts_file = '/proc/self/mounts'):
+    """Determine the mount point a path resides on without accessing the
+    path itself, such that a stale network mount cannot block the caller.
+    Symbolic links in the path are not resolved.
+
+    Parameters:
+    path:        The path to look up
+    mounts_file: The mount table to consult"""
+
+    path = os.path.normpath(os.path.abspath(path))
+    try:
+        with open(mounts_file) as f:
+            mount_points = [ _unescape(line.split()[1]) for line in f if line.strip() ]
+    except OSError:
+        return '/'
+    best = '/'
+    for mp in mount_points:
+        if (path == mp or path.startswith(mp.rstrip('/') + '/')) and len(mp) > len(best):
+            best = mp
+    return best
+
+def write_atomic(path, data, tmp_path = None):
+    """Write 'data' (str or bytes) to 'path' such that the file either has
+    the new content or does not change, also across a crash: the data is
+    written to 'tmp_path' (default 'path' + '.tmp'), synced and renamed,
+    then the directory is synced."""
+    tmp_path = tmp_path or path + '.tmp'
+    with open(tmp_path, 'wb' if isinstance(data, (bytes, bytearray)) else 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def spool_attachments(attachments, directory, ident):
+    """Write attachments given as bytes or file-like objects to files
+    '<ident>.<n>.att' in 'directory', or to temporary files if 'directory'
+    is None, so they can be read again after a restart. Attachments given
+    as paths are referenced as they are. Returns the attachments by path
+    and the list of files that were created."""
+    paths, owned = {}, []
+    for i, (fname, data) in enumerate(attachments.items()):
+        if isinstance(data, (str, os.PathLike)):
+            paths[fname] = os.fspath(data)
+            continue
+        if directory:
+            path = os.path.join(directory, f"{ident}.{i}.att")
+            f    = open(path, 'wb')
+        else:
+            fd, path = tempfile.mkstemp(prefix = 'dod_reporter-', suffix = '.att')
+            f        = os.fdopen(fd, 'wb')
+        with f:
+            if isinstance(data, (bytes, bytearray)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        paths[fname] = path
+        owned.append(path)
+    return paths, owned
+
+def format_bytes(n):
+    """Format a byte count for humans, e.g. '1.5 GiB'."""
+    if n is None:
+        return 'n/a'
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(n) < 1024 or unit == 'TiB':
+            return f"{n:.0f} {unit}" if unit == 'B' else f"{n:.1f} {unit}"
+        n /= 1024
@@ -18,11 +18,261 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+"""Logging backend. Callers hand records to a queue and return immediately,
+a single writer thread formats them as JSON lines and writes them to the
+configured sinks. Repeated messages are rate limited per runner and message.
+
+A record carries the time, level, runner and message. The runner is taken
+from a leading '[runner]' tag of the message. Further fields, such as 'host'
+or 'duration', are passed as keyword arguments."""
+
+import atexit
+import json
+import os
+import queue
+import re
 import sys
-from threading import Lock
+import threading
+import time
+
+####################################################################################################
+
+DEBUG   = 10
+INFO    = 20
+WARNING = 30
+ERROR   = 40
+
+LEVELS      = { 'debug' : DEBUG, 'info' : INFO, 'warning' : WARNING, 'error' : ERROR }
+LEVEL_NAMES = { value : name for name, value in LEVELS.items() }
+
+# Syslog severities of the levels, facility 'daemon'
+SYSLOG_FACILITY = 3
+SYSLOG_SEVERITY = { DEBUG : 7, INFO : 6, WARNING : 4, ERROR : 3 }
+SYSLOG_SOCKET   = '/dev/log'
+
+# Records that are queued beyond this limit are dropped and counted
+QUEUE_SIZE = 10000
+
+RUNNER_TAG = re.compile(r'\[(\w+)\]\s*')
+
+####################################################################################################
+
+class _Sink:
+    """Base class of the log sinks. A sink receives batches of formatted
+    records and must not raise."""
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class _StreamSink(_Sink):
+    """Writes JSON lines to a stream, by default stderr."""
+
+    def __init__(self, stream = None):
+        self.stream = stream
+
+    def write(self, batch):
+        stream = self.stream or sys.stderr
+        try:
+            stream.write(''.join(line + '\n' for _, line in batch))
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+class _FileSink(_StreamSink):
+    """Appends JSON lines to a file. The file is reopened on reconfiguration,
+    e.g. after log rotation."""
+
+    def __init__(self, path):
+        _StreamSink.__init__(self, open(path, 'a', encoding = 'utf-8'))
+
+    def close(self):
+        self.stream.close()
+
+class _SyslogSink(_Sink):
+    """Sends the JSON records as datagrams to the local syslog socket.
+    Records are dropped if the socket is unavailable or congested."""
+
+    def __init__(self, path = SYSLOG_SOCKET):
+        import socket
+        self.path   = path
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def write(self, batch):
+        for level, line in batch:
+            priority = SYSLOG_FACILITY * 8 + SYSLOG_SEVERITY[level]
+            try:
+                self.socket.sendto(f"<{priority}>dod_reporter[{os.getpid()}]: {line}".encode('utf-8'), self.path)
+            except OSError:
+                pass
+
+    def close(self):
+        self.socket.close()
+
+def _open_sink(spec):
+    """Open a sink from its configuration: 'stderr', 'file:<path>', 'syslog'
+    or 'syslog:<socket path>'."""
+    kind, _, arg = spec.partition(':')
+    if kind == 'stderr' and not arg:
+        return _StreamSink()
+    if kind == 'file' and arg:
+        return _FileSink(arg)
+    if kind == 'syslog':
+        return _SyslogSink(arg or SYSLOG_SOCKET)
+    raise ValueError(f"Invalid log sink '{spec}'")
+
+####################################################################################################
+
+_queue      = queue.Queue(maxsize = QUEUE_SIZE)
+_level      = INFO
+_sinks      = [ _StreamSink() ]
+_rate_burst = 5
+_rate_interval = 60
+_rate_lock  = threading.Lock()
+_rates      = {}
+_dropped    = 0
+_dropped_lock = threading.Lock()
+_sinks_lock = threading.Lock()
+_writer     = None
+_writer_lock = threading.Lock()
+
+def configure(level = 'info', sinks = ('stderr',), rate_burst = 5, rate_interval = 60):
+    """Configure the log level, the sinks and the rate limit. Can be called
+    again to change the configuration, file sinks are reopened.
+
+    Parameters:
+    level:         Minimum level name of the records that are written
+    sinks:         Sink specifications, see _open_sink()
+    rate_burst:    Number of identical messages written per interval, 0 disables the limit
+    rate_interval: Length of the rate limit interval in seconds"""
+
+    global _level, _rate_burst, _rate_interval, _sinks
+    new_sinks = [ _open_sink(spec) for spec in sinks ]
+    _level         = LEVELS[level]
+    _rate_burst    = rate_burst
+    _rate_interval = rate_interval
+    # Swapped directly rather than through the queue, which may be full.
+    # Records queued before are written to the new sinks.
+    with _sinks_lock:
+        old_sinks, _sinks = _sinks, new_sinks
+    for sink in old_sinks:
+        sink.close()
+    _start()
+
+def _start():
+    """Start the writer thread unless it is running."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target = _write_loop, name = 'log', daemon = True)
+            _writer.start()
+
+def _rate_limit(key, now):
+    """Return None if a record with 'key' is to be dropped, otherwise the
+    number of records with that key dropped since the last one written."""
+    if not _rate_burst:
+        return 0
+    with _rate_lock:
+        window = _rates.get(key)
+        if window is None or now - window[0] >= _rate_interval:
+            suppressed = window[2] if window else 0
+            if len(_rates) > QUEUE_SIZE:
+                # Forget expired keys of messages that are not repeated
+                for stale in [ k for k, w in _rates.items() if now - w[0] >= _rate_interval ]:
+                    del _rates[stale]
+            _rates[key] = [ now, 1, 0 ]
+            return suppressed
+        if window[1] < _rate_burst:
+            window[1] += 1
+            return 0
+        window[2] += 1
+        return None
+
+def log(*args, level = INFO, **fields):
+    """Log a message. Never blocks, the record is written asynchronously.
+
+    Parameters:
+    args:   Message parts, joined by spaces
+    level:  Level of the record
+    fields: Additional fields of the record, e.g. 'host' or 'duration'"""
+
+    global _dropped
+    if level < _level:
+        return
+    message = ' '.join(str(arg) for arg in args).strip()
+    runner  = None
+    match   = RUNNER_TAG.match(message)
+    if match:
+        runner  = match.group(1)
+        message = message[match.end():]
+    now        = time.time()
+    suppressed = _rate_limit((runner, message), now)
+    if suppressed is None:
+        return
+    if suppressed:
+        fields['suppressed'] = suppressed
+    if _writer is None:
+        _start()
+    try:
+        _queue.put_nowait(('record', (now, level, runner, message, fields)))
+    except queue.Full:
+        with _dropped_lock:
+            _dropped += 1
+
+def _format(record):
+    """Format a record as a JSON line."""
+    ts, level, runner, message, fields = record
+    entry = { 'ts' : time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(ts)) + f'.{int(ts % 1 * 1000):03d}',
+              'level' : LEVEL_NAMES[level] }
+    if runner:
+        entry['runner'] = runner
+    entry['msg'] = message
+    entry.update(fields)
+    return json.dumps(entry, default = str, ensure_ascii = False)
+
+def _write_loop():
+    """Target of the writer thread. Writes the queued records in batches."""
+    global _dropped
+    while True:
+        items = [ _queue.get() ]
+        while len(items) < 1000:
+            try:
+                items.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        batch = []
+        for kind, payload in items + [ (None, None) ]:
+            if kind == 'record':
+                batch.append((payload[1], _format(payload)))
+                continue
+            if batch:
+                with _sinks_lock:
+                    for sink in _sinks:
+                        sink.write(batch)
+                batch = []
+            if kind == 'flush':
+                payload.set()
+        with _dropped_lock:
+            dropped, _dropped = _dropped, 0
+        if dropped:
+            line = _format((time.time(), WARNING, 'log', f"Dropped {dropped} record(s), the log queue was full.", {}))
+            with _sinks_lock:
+                for sink in _sinks:
+                    sink.write([ (WARNING, line) ])
 
-stderr_lock = Lock()
+def flush(timeout = 5):
+    """Wait until the records queued so far are written, at most 'timeout'
+    seconds. Called at exit."""
+    if _writer is None:
+        return
+    done = threading.Event()
+    try:
+        _queue.put(('flush', done), timeout = timeout)
+    except queue.Full:
+        return
+    done.wait(timeout)
 
-def log(*args):
-    with stderr_lock:
-        print(*args, file = sys.stderr, flush = True)
+atexit.register(flush)
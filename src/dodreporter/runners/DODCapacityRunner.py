@@ -0,0 +1,244 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+import math
+import operator
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from dataclasses import dataclass
+from datetime import timedelta
+from urllib.parse import quote
+
+####################################################################################################
+
+from dodreporter import log, fsutil, Metrics, tracing
+from dodreporter.RingBuffer import RingBuffer
+
+####################################################################################################
+
+FS_AVAIL_BYTES   = Metrics.gauge('dod_filesystem_avail_bytes', 'Bytes available to unprivileged users', ('mount_point',))
+FS_SIZE_BYTES    = Metrics.gauge('dod_filesystem_size_bytes', 'Size of the filesystem', ('mount_point',))
+FS_DAYS_TO_FULL  = Metrics.gauge('dod_filesystem_days_to_full', 'Forecast days until the filesystem is full', ('mount_point',))
+
+# Minimum number of samples and time span in seconds required for a forecast
+MIN_SAMPLES = 3
+MIN_SPAN    = 3600
+
+####################################################################################################
+
+@dataclass
+class CapacityForecast:
+    """Fill forecast of a filesystem"""
+
+    mount_point  : str
+    size         : float
+    avail        : float
+    samples      : int
+    slope        : float = None
+    days_to_full : float = None
+
+    @property
+    def used_percent(self):
+        if self.avail is None:
+            return None
+        return 100 * (1 - self.avail / self.size) if self.size else 0.0
+
+    def report(self):
+        """Return a report line for the forecast."""
+        if self.avail is None:
+            return f"{self.mount_point} (not sampled yet)"
+        line = (f"{self.mount_point} ({self.used_percent:.0f}% used, "
+                f"{fsutil.format_bytes(self.avail)} of {fsutil.format_bytes(self.size)} available")
+        if self.slope is None:
+            return line + ", not enough samples for a forecast)"
+        if self.days_to_full is None:
+            return line + ", not filling up)"
+        return line + f", {fsutil.format_bytes(-self.slope)}/day, full in ~{self.days_to_full:.0f} day(s))"
+
+def forecast(mount_point, timestamps, avail, size, window, now = None):
+    """Fit a least squares line to the available bytes over time and
+    extrapolate when they reach zero. Without numpy there is no vectorised
+    arithmetic; the sums run over the ring buffer columns as C level
+    reductions (math.fsum over map(operator.mul, ...)), without a Python
+    level loop per sample. If no sample falls into the window, the latest
+    sample is reported without a forecast.
+
+    Parameters:
+    mount_point: The mount point the samples belong to
+    timestamps:  Sample times in seconds, ascending
+    avail:       Available bytes per sample
+    size:        Size of the filesystem
+    window:      Only samples from the last 'window' seconds are fitted
+    now:         The current time, defaults to time.time()"""
+
+    now   = now or time.time()
+    cut   = bisect_left(timestamps, now - window)
+    xs    = timestamps[cut:]
+    ys    = avail[cut:]
+    n     = len(xs)
+    if not n:
+        return CapacityForecast(mount_point, size, avail[-1] if len(avail) else None, 0)
+    result = CapacityForecast(mount_point, size, ys[-1], n)
+    if n < MIN_SAMPLES or xs[-1] - xs[0] < MIN_SPAN:
+        return result
+    # Centered sums from raw moments. fsum rounds the sums exactly, so the
+    # cancellation costs no more than the rounding of the products, which
+    # is far below the variance of timestamps spread over an hour or more.
+    mean_x = math.fsum(xs) / n
+    mean_y = math.fsum(ys) / n
+    sxx    = math.fsum(map(operator.mul, xs, xs)) - n * mean_x * mean_x
+    sxy    = math.fsum(map(operator.mul, xs, ys)) - n * mean_x * mean_y
+    result.slope = sxy / sxx * 86400
+    if result.slope < 0:
+        result.days_to_full = max(0.0, result.avail / -result.slope)
+    return result
+
+####################################################################################################
+
+class DODCapacityRunner:
+    """Job that periodically samples the capacity of the filesystems holding
+    the backup directories and the encrypted volumes, and alerts the global
+    recipients once a filesystem is forecast to be full within
+    'capacityalertdays'. Instances are triggered by the central Scheduler.
+
+    The samples of every filesystem are kept in a RingBuffer below the state
+    directory, at 24 bytes per sample."""
+
+    # An alert is cleared once the forecast exceeds the threshold by this
+    # factor, such that a forecast oscillating around it does not flood the
+    # recipients
+    CLEAR_FACTOR = 1.5
+
+    # Scheduler job name, host section names cannot contain brackets
+    name = '[capacity]'
+
+    def __init__(self, reporter):
+        """Construct a new DODCapacityRunner object.
+
+        Parameters:
+        reporter: The managing DODReporter instance"""
+
+        self.reporter = reporter
+        self.__lock   = threading.Lock()
+        self.__series = {}
+
+    def __series_for(self, mount_point):
+        """Return the ring buffer of a mount point, opened on first use."""
+        gs = self.reporter.config.global_settings
+        with self.__lock:
+            if mount_point not in self.__series:
+                path = os.path.join(gs.state_dir, 'capacity', quote(mount_point, safe = '') + '.ring')
+                self.__series[mount_point] = RingBuffer(path, gs.capacity_samples, 3)
+            return self.__series[mount_point]
+
+    def paths(self):
+        """Return the monitored paths by mount point."""
+        cfg   = self.reporter.config
+        paths = {}
+        for path in cfg.global_settings.crypt_dirs + [ host_setting.directory for host_setting in cfg.host_settings ]:
+            paths.setdefault(fsutil.mount_point(path), path)
+        return paths
+
+    def forecast(self, path):
+        """Return the CapacityForecast for the filesystem holding 'path', None
+        if it has not been sampled yet."""
+        mount_point = fsutil.mount_point(path)
+        with self.__lock:
+            if mount_point not in self.__series:
+                return None
+        timestamps, avail, size = self.__series_for(mount_point).columns()
+        if not timestamps:
+            return None
+        return forecast(mount_point, timestamps, avail, size[-1], self.reporter.config.global_settings.capacity_window * 86400)
+
+    def sample(self):
+        """Sample all monitored filesystems once. Returns the forecasts."""
+        now       = time.time()
+        forecasts = []
+        for mount_point, path in self.paths().items():
+            try:
+                st = os.statvfs(path)
+            except OSError as e:
+                log.log(f"[capacity] Cannot sample '{path}': {e}", level = log.DEBUG)
+                continue
+            series = self.__series_for(mount_point)
+            series.append(now, st.f_bavail * st.f_frsize, st.f_blocks * st.f_frsize)
+            series.flush()
+            result = self.forecast(path)
+            if result.avail is not None:
+                FS_AVAIL_BYTES.set(result.avail, (mount_point,))
+            FS_SIZE_BYTES.set(result.size, (mount_point,))
+            if result.days_to_full is not None:
+                FS_DAYS_TO_FULL.set(result.days_to_full, (mount_point,))
+            forecasts.append(result)
+        return forecasts
+
+    def __alert(self, result):
+        """Send or clear the time-to-full alert of a filesystem."""
+        state     = self.reporter.state
+        threshold = self.reporter.config.global_settings.capacity_alert_days
+        key       = f"capacity:{result.mount_point}"
+        pending   = state.alert(key)
+        if result.days_to_full is not None and result.days_to_full < threshold:
+            if pending:
+                return
+            log.log(f"[capacity] Filesystem '{result.mount_point}' is forecast to be full in {result.days_to_full:.0f} day(s).", level = log.WARNING)
+            self.reporter.smtp_send(
+                    recipients = self.reporter.config.global_settings.recipients,
+                    subject = f"[BACKUP][{socket.gethostname()}] ⚠️ Filesystem {result.mount_point} full in ~{result.days_to_full:.0f} day(s)",
+                    message_text = f"""Dear user,
+
+at the current rate, the filesystem '{result.mount_point}' on the backup server
+'{socket.gethostname()}' will be full in about {result.days_to_full:.0f} day(s).
+
+{result.report()}
+""")
+            if not self.reporter.dry_run:
+                state.set_alert(key, { 'days_to_full' : result.days_to_full, 'avail' : result.avail })
+        elif pending and (result.days_to_full is None or result.days_to_full > threshold * self.CLEAR_FACTOR):
+            log.log(f"[capacity] Filesystem '{result.mount_point}' is no longer forecast to be full within {threshold} day(s).")
+            if not self.reporter.dry_run:
+                state.set_alert(key, None)
+
+    def run(self):
+        """Sample the filesystems and send the alerts that are due. Called by
+        the Scheduler or by DODReporter.run_once()."""
+
+        with tracing.span('capacity.sample') as span:
+            forecasts = self.sample()
+            span.set(filesystems = len(forecasts))
+        for result in forecasts:
+            self.__alert(result)
+        self.reporter.state.flush()
+
+    def next_run(self, now):
+        """Return the time of the next sample after 'now'."""
+        return now + timedelta(seconds = self.reporter.config.global_settings.capacity_interval)
+
+    def close(self):
+        """Close the ring buffers."""
+        with self.__lock:
+            for series in self.__series.values():
+                series.close()
+            self.__series = {}
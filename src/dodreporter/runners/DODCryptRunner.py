@@ -22,13 +22,24 @@ import threading
 import os
 import socket
 
-from dodreporter import config, log
+from dodreporter import config, log, tracing
+from dodreporter.MountWatcher import MountWatcher
 
 class DODCryptRunner(threading.Thread):
     """Runner that is launched once initially to check whether encrypted
     volumes are available and that terminates once they are. The runner
     notifies the configured recipients initially if the encrypted volumes are
-    unavailable and when they become available."""
+    unavailable and when they become available.
+
+    The runner reacts to mount table and directory change events. The
+    periodical check is only a safety net, or the primary mechanism if no
+    event source is available on the platform."""
+
+    # Seconds between safety checks when change events are available
+    RECHECK_INTERVAL = 300
+
+    # Identifies the current boot, notifications are only sent once per boot
+    BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
 
     def notify_crypt_unavailable(self, paths):
         """Send out a notification that encrypted volumes are unavailable.
@@ -68,11 +79,42 @@ available and ready to use.
         self.failmail          = False
         self.last_status       = None
         self.reporter          = reporter
+        self.poll_interval     = reporter.config.global_settings.crypt_poll_interval
+        self.watcher           = None
+        self.boot_id           = self.__boot_id()
+        self.available         = False
+
+        # Restore the notification state if the service was restarted within
+        # the same boot
+        saved = reporter.state.get('crypt', 'notifications')
+        if saved and self.boot_id and saved.get('boot_id') == self.boot_id:
+            self.failmail  = saved.get('failmail', False)
+            self.available = saved.get('available', False)
+
+    def __boot_id(self):
+        """Return the identifier of the current boot or None if unknown."""
+        try:
+            with open(self.BOOT_ID_PATH) as infile:
+                return infile.read().strip()
+        except OSError:
+            return None
+
+    def __save(self):
+        """Persist the notification state. Nothing is persisted in dry run
+        mode, as no notifications were actually sent."""
+        if self.reporter.dry_run:
+            return
+        self.reporter.state.set('crypt', 'notifications', {
+            'boot_id'   : self.boot_id,
+            'failmail'  : self.failmail,
+            'available' : self.available })
+        self.reporter.state.flush()
 
     def check(self):
         """Run the periodical check for encrypted volumes."""
 
-        status = [ os.path.exists(p) for p in self.paths ]
+        with tracing.span('crypt.check', paths = len(self.paths)):
+            status = [ os.path.exists(p) for p in self.paths ]
 
         # Log current state if it has changed from the previous observed state
         if status != self.last_status:
@@ -80,7 +122,7 @@ available and ready to use.
                 if exists:
                     log.log(f"[crypt_run] Crypt path '{path}' exists.")
                 else:
-                    log.log(f"[crypt_run] Crypt path '{path}' does not exist.")
+                    log.log(f"[crypt_run] Crypt path '{path}' does not exist.", level = log.WARNING)
 
         # Keep in mind last state for future checks
         self.last_status = status
@@ -88,24 +130,75 @@ available and ready to use.
         # Return all missing paths
         return [ path for path, exists in zip(self.paths, status) if not exists ]
 
-    def run(self):
-        """Overrides Thread.run(). Runs check() and evaluates result every 3
-        seconds until all volumes became available or the DODRepoter terminate
-        event occurs."""
+    def check_once(self):
+        """Run a single check and send the notifications that are due.
+        Returns True if all volumes are available."""
+
+        if not self.paths:
+            return True
+        failed_paths = self.check()
+        if failed_paths and not self.failmail:
+            self.notify_crypt_unavailable(failed_paths)
+            self.failmail = True
+            self.__save()
+        elif not failed_paths and self.failmail and not self.available:
+            self.notify_crypt_available()
+            self.available = True
+            self.__save()
+        return not failed_paths
+
+    def interrupt(self):
+        """Wake up the runner, e.g. after the terminate event was set."""
+        if self.watcher:
+            self.watcher.interrupt()
+
+    def __start(self):
+        """Set up the change event source. Returns the interval between
+        checks, None if there is nothing to watch."""
 
         if not self.paths:
             log.log("[crypt_run] Crypt runner not starting up, no crypt dir paths configured.")
-            return
-        log.log("[crypt_run] Crypt runner started.")
-        while not self.reporter.terminate_event.is_set():
-            failed_paths = self.check()
-            if not failed_paths:
-                log.log("[crypt_run] All crypt paths are available. Crypt runner terminating.")
+            return None
+        self.watcher = MountWatcher(self.paths)
+        if self.watcher.event_driven:
+            log.log("[crypt_run] Crypt runner started.")
+            return max(self.poll_interval, self.RECHECK_INTERVAL)
+        log.log(f"[crypt_run] Crypt runner started, no change events available, polling every {self.poll_interval}s.")
+        return self.poll_interval
+
+    def __step(self):
+        """Run check() and send the notifications that are due. Returns
+        True once all volumes are available."""
+
+        failed_paths = self.check()
+        if not failed_paths:
+            log.log("[crypt_run] All crypt paths are available. Crypt runner terminating.")
+            if not self.available:
                 self.notify_crypt_available()
-                return
-            else:
-                if not self.failmail:
-                    log.log("[crypt_run] Missing crypt paths. Sending out email notification.")
-                    self.notify_crypt_unavailable(failed_paths)
-                    self.failmail = True
-            self.reporter.terminate_event.wait(3)
+                self.available = True
+                self.__save()
+            return True
+        if not self.failmail:
+            log.log("[crypt_run] Missing crypt paths. Sending out email notification.")
+            self.notify_crypt_unavailable(failed_paths)
+            self.failmail = True
+            self.__save()
+        return False
+
+    def run(self):
+        """Overrides Thread.run(). Runs check() and evaluates the result
+        whenever the mount table or the watched directories change, until all
+        volumes became available or the DODRepoter terminate event occurs.
+        Without change events, the check is run every 'cryptpollinterval'
+        seconds."""
+
+        interval = self.__start()
+        if interval is None:
+            return
+        try:
+            while not self.reporter.terminate_event.is_set():
+                if self.__step():
+                    return
+                self.watcher.wait(interval)
+        finally:
+            self.watcher.close()
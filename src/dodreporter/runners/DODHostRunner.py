@@ -20,58 +20,431 @@
 
 ####################################################################################################
 
+import glob
+import os
+import socket
 import threading
-import calendar
+import time
+from concurrent.futures import Future, TimeoutError
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 
 ####################################################################################################
 
-from dodreporter import config, log
+from dodreporter import log, fsutil, Metrics, tracing
+from dodreporter.error import DODCheckCancelled
+from dodreporter.SnapshotScanner import SnapshotScanner
+from dodreporter.IOLimiter import IOLimiter
 
 ####################################################################################################
 
-class DODHostRunner(threading.Thread):
-    """Runner that periodically checks recent backups.
+@dataclass
+class DODHostResult:
+    """Outcome of a single host check"""
 
-    TO BE IMPLEMENTED"""
+    status      : str
+    summary     : str
+    details     : str = ''
+    attachments : dict = field(default_factory=dict)
+    metrics     : dict = field(default_factory=dict)
 
-    def __check(self):
-        """Run the periodical check for previously successful backups."""
-        print(f"Performing check. Initial check: {self.__initial}")
-        self.__initial = False
-        pass
+    OK      = 'OK'
+    WARNING = 'WARNING'
+    FAILED  = 'FAILED'
+    TIMEOUT = 'TIMEOUT'
+
+    ICONS = { OK : '👌', WARNING : '⚠️', FAILED : '❌', TIMEOUT : '⌛' }
+
+####################################################################################################
+
+CHECK_SECONDS    = Metrics.histogram('dod_check_duration_seconds', 'Duration of the host checks', ('host',),
+                        buckets = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200))
+CHECK_RESULTS    = Metrics.counter('dod_check_results_total', 'Results of the host checks', ('host', 'status'))
+SCAN_DIRECTORIES = Metrics.counter('dod_scan_directories_total', 'Directories listed by the snapshot scans', ('host',))
+SCAN_INODES      = Metrics.counter('dod_scan_inodes_total', 'Inodes statted by the snapshot scans', ('host',))
+VERIFY_FILES     = Metrics.counter('dod_verify_files_total', 'Files verified against a reference', ('host',))
+VERIFY_BYTES     = Metrics.counter('dod_verify_bytes_total', 'Bytes hashed by the verification', ('host',))
+
+# Gauges for the DODHostResult metrics of the latest check
+HOST_GAUGES = {
+        'snapshot_age_seconds' : Metrics.gauge('dod_snapshot_age_seconds', 'Age of the latest complete snapshot', ('host',)),
+        'snapshots'            : Metrics.gauge('dod_snapshots', 'Number of complete snapshots', ('host',)),
+        'footprint_bytes'      : Metrics.gauge('dod_footprint_bytes', 'Disk space used by all snapshots', ('host',)),
+        'new_bytes'            : Metrics.gauge('dod_snapshot_new_bytes', 'Disk space first used by the latest snapshot', ('host',)),
+        'verify_mismatches'    : Metrics.gauge('dod_verify_mismatches', 'Checksum mismatches found by the latest verification', ('host',)),
+        'backup_exit_code'     : Metrics.gauge('dod_backup_exit_code', 'Exit code of the latest rsync run', ('host',)),
+        'backup_bytes_sent'    : Metrics.gauge('dod_backup_bytes_sent', 'Bytes sent by the latest rsync run', ('host',)),
+        'backup_throughput'    : Metrics.gauge('dod_backup_throughput_bytes', 'Bytes per second of the latest rsync run', ('host',)),
+        }
+
+####################################################################################################
+
+class DODHostRunner:
+    """Job that periodically checks recent backups of a host and reports the
+    most recent complete snapshot below the host's backup directory.
+    Instances are triggered by the central Scheduler.
+
+    Every check runs on its own daemon thread and is bounded by the host's
+    CheckTimeout. Checks of hosts that share a filesystem are limited to
+    'fsworkers' concurrent checks. A check that exceeds its deadline is
+    reported as timed out and abandoned, such that a hung mount cannot block
+    the reports of other hosts."""
+
+    def __check(self, cancel):
+        """Run the periodical check for previously successful backups.
+
+        Parameters:
+        cancel: Event that is set when the check exceeded its deadline"""
+
+        settings = self.settings
+        scanner  = self.__scanner()
+        try:
+            with tracing.span('scan', directory = settings.directory) as span:
+                snapshots = scanner.scan(cancel)
+                span.set(listed = scanner.listed, statted = scanner.statted)
+        except OSError as e:
+            return DODHostResult(DODHostResult.FAILED, "backup directory not accessible",
+                    f"The backup directory '{settings.directory}' could not be scanned: {e}")
+        finally:
+            SCAN_DIRECTORIES.inc(scanner.listed, (self.__host,))
+            SCAN_INODES.inc(scanner.statted, (self.__host,))
+
+        complete   = [ s for s in snapshots if s.complete ]
+        incomplete = [ s for s in snapshots if not s.complete ]
+
+        details = [ f"Backup directory:     {settings.directory}",
+                    f"Complete snapshots:   {len(complete)}",
+                    f"Incomplete snapshots: {len(incomplete)}" ]
+        capacity = self.__reporter.capacity.forecast(settings.directory) if self.__reporter.capacity else None
+        if capacity:
+            details.append(f"Filesystem:           {capacity.report()}")
+        if incomplete:
+            details += [ "" , "Incomplete snapshots:" ] + [ f"  {s.path} ({datetime.fromtimestamp(s.time):%Y-%m-%d %H:%M})" for s in incomplete ]
+
+        if not complete:
+            return DODHostResult(DODHostResult.FAILED, "no successful backup found", '\n'.join(details))
+
+        latest  = complete[-1]
+        age     = datetime.now() - datetime.fromtimestamp(latest.time)
+        metrics = { 'snapshot_age_seconds' : age.total_seconds(), 'snapshots' : len(complete) }
+        details.insert(0, f"Latest snapshot:      {latest.path} ({datetime.fromtimestamp(latest.time):%Y-%m-%d %H:%M})")
+        if not self.__reporter.dry_run:
+            self.__reporter.state.set(self.__scope, 'last_snapshot', latest.path)
+        if settings.usage:
+            with tracing.span('usage'):
+                details += [ "" ] + self.__usage_report(complete, cancel, metrics)
+        summary = f"latest backup is {age.days} day(s) old"
+        failed_run  = None
+        attachments = {}
+        if settings.rsync_logs:
+            with tracing.span('rsync_logs') as span:
+                lines, failed_run = self.__rsync_report(cancel, metrics, attachments)
+                span.set(parsed = self.__rsync_parser.parsed)
+            details += [ "" ] + lines
+        if settings.verify_samples > 0:
+            # Imported on first use, pulls in multiprocessing
+            from dodreporter.SnapshotVerifier import SnapshotVerifier
+            with tracing.span('verify', algorithm = settings.verify_hash) as span:
+                verification = SnapshotVerifier(
+                        settings.directory,
+                        samples   = settings.verify_samples,
+                        algorithm = settings.verify_hash,
+                        workers   = settings.verify_workers,
+                        manifest  = settings.verify_manifest,
+                        limiter   = self.__limiter()).verify(latest.path, complete[-2].path if len(complete) > 1 else None, cancel)
+                span.set(sampled = verification.sampled, verified = verification.verified, bytes = verification.bytes)
+            details += [ "" ] + verification.report()
+            if not verification.missing_manifest:
+                metrics['verify_mismatches'] = len(verification.mismatches)
+            VERIFY_FILES.inc(verification.verified, (self.__host,))
+            VERIFY_BYTES.inc(verification.bytes, (self.__host,))
+            if verification.mismatches:
+                return DODHostResult(DODHostResult.FAILED, f"{len(verification.mismatches)} file(s) failed verification", '\n'.join(details),
+                        attachments = attachments, metrics = metrics)
+            if verification.missing_manifest:
+                return DODHostResult(DODHostResult.WARNING, "no checksum manifest in the latest snapshot", '\n'.join(details),
+                        attachments = attachments, metrics = metrics)
+        if failed_run:
+            return DODHostResult(DODHostResult.WARNING, f"latest backup run failed with exit code {failed_run.exit_code}", '\n'.join(details),
+                    attachments = attachments, metrics = metrics)
+        if age > timedelta(days = settings.max_age):
+            return DODHostResult(DODHostResult.WARNING, summary, '\n'.join(details), attachments = attachments, metrics = metrics)
+        return DODHostResult(DODHostResult.OK, summary, '\n'.join(details), attachments = attachments, metrics = metrics)
+
+    def __usage_report(self, complete, cancel, metrics):
+        """Update the space accounting and return the report lines. The
+        footprint is added to 'metrics' and compared with its history."""
+        settings = self.settings
+        state    = self.__reporter.state
+        if self.__accountant is None or self.__accountant.directory != settings.directory:
+            from dodreporter.SnapshotUsage import UsageAccountant
+            self.__accountant = UsageAccountant(settings.directory, self.__state_path('usage'), store = state, scope = self.__scope)
+        self.__accountant.workers = settings.usage_workers
+        self.__accountant.limiter = self.__limiter()
+        usages    = self.__accountant.update(complete, cancel)
+        footprint = self.__accountant.footprint(usages)
+        lines     = [ f"Total footprint:      {fsutil.format_bytes(footprint)}" ]
+        if footprint is not None:
+            metrics['footprint_bytes'] = footprint
+            history = state.history(self.__scope, 'footprint_bytes', time.time() - 28 * 86400)
+            if history:
+                ts, value = history[0]
+                lines.append(f"Footprint trend:      {'+' if footprint >= value else '-'}{fsutil.format_bytes(abs(footprint - value))} "
+                        f"since {datetime.fromtimestamp(ts):%Y-%m-%d}")
+        if usages and list(usages.values())[-1].new_bytes is not None:
+            metrics['new_bytes'] = list(usages.values())[-1].new_bytes
+        lines += [ "",
+                   f"{'Snapshot':<30} {'Apparent':>12} {'On disk':>12} {'New':>12}" ]
+        for path, usage in list(usages.items())[-8:]:
+            lines.append(f"{path:<30} {fsutil.format_bytes(usage.apparent_bytes):>12} {fsutil.format_bytes(usage.disk_bytes):>12} {fsutil.format_bytes(usage.new_bytes):>12}")
+        if self.__accountant.errors:
+            lines += [ "", f"{len(self.__accountant.errors)} directories could not be read, e.g.: {self.__accountant.errors[0]}" ]
+        return lines
+
+    def __rsync_report(self, cancel, metrics, attachments):
+        """Parse the host's rsync logs and return the report lines and the
+        latest run if it failed. The statistics of the latest run are added
+        to 'metrics', the end of its log is added to 'attachments' if it
+        failed."""
+        settings = self.settings
+        if self.__rsync_parser is None:
+            from dodreporter.RsyncLog import RsyncLogParser
+            self.__rsync_parser = RsyncLogParser(self.__reporter.state, self.__scope)
+        self.__rsync_parser.workers = settings.rsync_log_workers
+        self.__rsync_parser.limiter = limiter = self.__limiter()
+        # Each pattern is charged as one directory listing
+        limiter.acquire(ops = len(settings.rsync_logs), cancel = cancel)
+        paths = { path for pattern in settings.rsync_logs for path in glob.glob(pattern) }
+        runs  = self.__rsync_parser.parse(paths, cancel)
+        if not runs:
+            return [ f"Backup runs:          no rsync statistics found in {', '.join(settings.rsync_logs)}" ], None
+
+        latest = runs[-1]
+        metrics.update({ 'backup_exit_code' : latest.exit_code, 'backup_files_transferred' : latest.files_transferred,
+                         'backup_bytes_sent' : latest.bytes_sent, 'backup_elapsed_seconds' : latest.elapsed,
+                         'backup_throughput' : latest.throughput })
+        for key in [ key for key, value in metrics.items() if value is None ]:
+            del metrics[key]
+
+        lines = [ f"{'Backup run':<17} {'Exit':>4} {'Files':>9} {'Sent':>12} {'Elapsed':>9} {'Throughput':>12}" ]
+        for run in runs[-7:]:
+            finished   = f"{datetime.fromtimestamp(run.finished):%Y-%m-%d %H:%M}" if run.finished else '-'
+            elapsed    = str(timedelta(seconds = int(run.elapsed))) if run.elapsed is not None else 'n/a'
+            throughput = f"{fsutil.format_bytes(int(run.throughput))}/s" if run.throughput is not None else 'n/a'
+            exit_code  = run.exit_code if run.exit_code is not None else '?'
+            files      = run.files_transferred if run.files_transferred is not None else 'n/a'
+            lines.append(f"{finished:<17} {exit_code:>4} {files:>9} {fsutil.format_bytes(run.bytes_sent):>12} {elapsed:>9} {throughput:>12}")
+        if latest.errors:
+            lines += [ "", "Errors of the latest backup run:" ] + [ f"  {error}" for error in latest.errors ]
+        if latest.failed:
+            from dodreporter.RsyncLog import excerpt, EXCERPT
+            path, offset = self.__rsync_parser.latest
+            limiter.acquire(nbytes = min(offset, EXCERPT), cancel = cancel)
+            try:
+                attachments[f"{os.path.basename(path)}.txt"] = excerpt(path, offset)
+                lines += [ "", f"The end of the log '{path}' is attached." ]
+            except FileNotFoundError:
+                # Rotated away since it was parsed
+                pass
+        return lines, latest if latest.failed else None
+
+    def __scanner(self):
+        """Return the snapshot scanner for the current settings."""
+        settings = self.settings
+        if self.__snapshot_scanner is None \
+                or self.__snapshot_scanner.directory != settings.directory \
+                or self.__snapshot_scanner.depth != settings.snapshot_depth \
+                or self.__snapshot_scanner.marker != settings.snapshot_marker:
+            self.__snapshot_scanner = SnapshotScanner(
+                    settings.directory,
+                    store      = self.__reporter.state,
+                    scope      = self.__scope,
+                    depth      = settings.snapshot_depth,
+                    marker     = settings.snapshot_marker)
+        self.__snapshot_scanner.limiter = self.__limiter()
+        return self.__snapshot_scanner
+
+    def __limiter(self):
+        """Return the IOLimiter for this host: the reporter's shared limiter,
+        or a limiter of its own if the host overrides any limit."""
+        settings = self.settings
+        limits   = (settings.io_iops, settings.io_bps, settings.strict_iops, settings.strict_bps)
+        if not any(limits):
+            return self.__reporter.io_limiter
+        if self.__own_limiter is None or self.__own_limiter[0] != limits:
+            gs = self.__reporter.config.global_settings
+            self.__own_limiter = (limits, IOLimiter(
+                    iops          = settings.io_iops or gs.io_iops,
+                    bps           = settings.io_bps or gs.io_bps,
+                    strict_iops   = settings.strict_iops or gs.strict_iops,
+                    strict_bps    = settings.strict_bps or gs.strict_bps,
+                    strict_window = gs.strict_window))
+        return self.__own_limiter[1]
+
+    def __state_path(self, fname):
+        """Return the path of a per host state file."""
+        return os.path.join(self.__reporter.config.global_settings.state_dir, 'hosts', self.__host, fname)
 
     def __init__(self, reporter, host):
         """Construct a new DODHostRunner object.
         
         Parameters:
-        reporter: The managing DODReporter instance"""
+        reporter: The managing DODReporter instance
+        host:     The name of the host section in the configuration"""
 
-        threading.Thread.__init__(self)
         self.__reporter = reporter
         self.__host     = host
-        self.__initial  = True
+        self.__settings = reporter.config.host(host)
+        self.__scope    = f"host:{host}"
+        self.__initial  = not reporter.once
+        self.__pending  = None
+        self.__snapshot_scanner = None
+        self.__accountant       = None
+        self.__rsync_parser     = None
+        self.__own_limiter      = None
 
-    def run(self):
-        """Overrides Thread.run()."""
+    @property
+    def name(self):
+        return self.__host
+
+    @property
+    def settings(self):
+        return self.__settings
+
+    def update(self, settings):
+        """Apply changed settings after a configuration reload. The scan
+        index, usage accounting and I/O limiter are kept unless the settings
+        they depend on changed, a check in progress completes with the
+        settings it started with.
+
+        Parameters:
+        settings: The new DODHostSettings of this host"""
+
+        self.__settings = settings
+
+    def retire(self):
+        """Remove the gauges of this host after it was removed from the
+        configuration."""
+
+        for gauge in HOST_GAUGES.values():
+            gauge.remove((self.__host,))
 
-        log.log("[host_run] Host runner started.")
+    def next_run(self, now):
+        """Calculate the next reporting timepoint after 'now'."""
 
-        while not self.__reporter.terminate_event.is_set():
-            self.__check()
+        # TODO replace hard coded Saturday 12:00 with runtime configuration
+        next_alert = now + timedelta( (5-now.weekday()) % 7 )
+        next_alert = next_alert.replace(hour=12, minute=0, second=0, microsecond=0)
 
-            # Calculate next reporting timepoint
-            # TODO replace hard coded Saturday 12:00 with runtime configuration
-            now = datetime.now()
-            next_alert = now + timedelta( (5-now.weekday()) % 7 )
-            next_alert = next_alert.replace(hour=12, minute=0, second=0, microsecond=0)
+        if next_alert <= now:
+            next_alert += timedelta(days = 7)
 
-            if next_alert - datetime.now() < timedelta(0):
-                next_alert += timedelta(days = 7)
+        return next_alert
 
-            delta = next_alert - datetime.now()
+    def __guarded_check(self, future, cancel, deadline):
+        """Thread target that runs __check() within the filesystem's
+        concurrency limit and publishes the result via 'future'."""
 
-            # Sleep until next reporting timepoint
-            log.log(f"DODHostRunner for host '{self.__host}' will be triggered next at {next_alert}")
-            self.__reporter.terminate_event.wait(delta.total_seconds())
+        settings  = self.settings
+        fs_key    = settings.filesystem or fsutil.mount_point(settings.directory)
+        semaphore = self.__reporter.fs_semaphore(fs_key)
+        with tracing.span('host.check', host = self.__host, filesystem = fs_key):
+            try:
+                with tracing.span('fs.wait'):
+                    acquired = semaphore.acquire(timeout = max(0, deadline - time.monotonic()))
+                if not acquired:
+                    future.set_result(DODHostResult(DODHostResult.TIMEOUT, "check timed out",
+                        f"No check slot for filesystem '{fs_key}' became available within the deadline."))
+                    return
+                try:
+                    future.set_result(self.__check(cancel))
+                finally:
+                    semaphore.release()
+            except DODCheckCancelled:
+                future.set_result(DODHostResult(DODHostResult.TIMEOUT, "check timed out"))
+            except Exception as e:
+                future.set_result(DODHostResult(DODHostResult.FAILED, "check failed", f"The check raised an error: {e!r}"))
+
+    def __report(self, result):
+        """Send the result of a check to the host's recipients, add it to
+        the digest if digest mode is enabled, or push it to the aggregator in
+        the agent role."""
+
+        if self.__reporter.agent:
+            self.__reporter.agent.add_result(self.settings.recipients, self.__host, result,
+                    self.settings.compress, self.settings.compress_threshold)
+            return
+        if self.__reporter.digest:
+            self.__reporter.digest.add(self.settings.recipients, self.__host, result,
+                    self.settings.compress, self.settings.compress_threshold)
+            return
+
+        self.__reporter.smtp_send(
+                recipients = self.settings.recipients,
+                subject = f"[BACKUP][{socket.gethostname()}][{self.__host}] {DODHostResult.ICONS[result.status]} {result.summary}",
+                message_text = f"""Dear user,
+
+the backup check for host '{self.__host}' on the backup server
+'{socket.gethostname()}' reported: {result.summary}
+
+{result.details}
+""",
+                attachments = result.attachments,
+                compress = self.settings.compress,
+                compress_threshold = self.settings.compress_threshold)
+
+    def run(self):
+        """Run a single check and report its result. Called by the Scheduler
+        or by DODReporter.run_once(). Returns the DODHostResult."""
+
+        settings = self.settings
+        start    = time.monotonic()
+        if self.__pending is not None and not self.__pending.done():
+            # The check of the previous cycle is still stuck, do not pile up
+            # further threads on the same path
+            result = DODHostResult(DODHostResult.TIMEOUT, "check timed out",
+                    "The previous check of this host has not finished yet.")
+        else:
+            deadline = time.monotonic() + settings.check_timeout
+            cancel   = threading.Event()
+            self.__pending = Future()
+            threading.Thread(
+                    target = self.__guarded_check,
+                    args   = (self.__pending, cancel, deadline),
+                    name   = f"check-{self.__host}",
+                    daemon = True).start()
+            try:
+                result = self.__pending.result(timeout = settings.check_timeout)
+            except TimeoutError:
+                cancel.set()
+                result = DODHostResult(DODHostResult.TIMEOUT, "check timed out",
+                        f"The check did not complete within {settings.check_timeout} seconds.")
+
+        duration = time.monotonic() - start
+        log.log(f"[host_run] Check of host '{self.__host}' finished: {result.status} - {result.summary}",
+                level    = log.INFO if result.status == DODHostResult.OK else log.WARNING,
+                host     = self.__host,
+                status   = result.status,
+                duration = round(duration, 3))
+        CHECK_SECONDS.observe(duration, (self.__host,))
+        CHECK_RESULTS.inc(1, (self.__host, result.status))
+        for metric, value in result.metrics.items():
+            if metric in HOST_GAUGES:
+                HOST_GAUGES[metric].set(value, (self.__host,))
+
+        # The initial check after startup only reports problems, and only
+        # if they were not reported before the restart
+        state   = self.__reporter.state
+        dry_run = self.__reporter.dry_run
+        if not self.__initial or result.status not in (DODHostResult.OK, state.get(self.__scope, 'last_status')):
+            self.__report(result)
+            if not dry_run:
+                state.set(self.__scope, 'last_report', time.time())
+        self.__initial = False
 
+        if not dry_run:
+            state.set(self.__scope, 'last_status', result.status)
+            for metric, value in result.metrics.items():
+                state.record(self.__scope, metric, value)
+        state.flush()
+        return result
@@ -20,3 +20,4 @@
 
 from dodreporter.runners.DODHostRunner import *
 from dodreporter.runners.DODCryptRunner import *
+from dodreporter.runners.DODCapacityRunner import *
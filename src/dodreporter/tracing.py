@@ -0,0 +1,169 @@
+# Copyright (c) 2020 Leon Kuchenbecker
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Lightweight tracing of where the time of a run goes. Code sections are
+wrapped in spans:
+
+    with tracing.span('scan', host = name) as s:
+        ...
+        s.set(files = n)
+
+Spans opened while another span is active on the same thread become its
+children. Finished root spans are kept in memory and written to the profile
+directory by dump(). If tracing is disabled, span() returns a shared no-op
+object and costs a function call and a flag check.
+
+Optionally, every root span is profiled with cProfile and its statistics are
+written to a pstats file next to the span trees."""
+
+import json
+import os
+import threading
+import time
+
+####################################################################################################
+
+_directory = None
+_run_id    = None
+_cprofile  = False
+_local     = threading.local()
+_lock      = threading.Lock()
+_finished  = []
+
+class _NoopSpan:
+    """Span returned while tracing is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NOOP = _NoopSpan()
+
+class Span:
+    """A timed section of code with attributes and child spans."""
+
+    def __init__(self, name, attrs):
+        self.name     = name
+        self.attrs    = attrs
+        self.children = []
+        self.start    = None
+        self.duration = None
+        self.error    = None
+        self.__parent = None
+        self.__t0     = None
+        self.__profile = None
+
+    def set(self, **attrs):
+        """Add attributes to the span."""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.__parent = stack[-1] if stack else None
+        stack.append(self)
+        if self.__parent is None and _cprofile:
+            import cProfile
+            self.__profile = cProfile.Profile()
+            self.__profile.enable()
+        self.start  = time.time()
+        self.__t0   = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.__t0
+        if exc_type is not None:
+            self.error = repr(exc)
+        _local.stack.pop()
+        if self.__parent is not None:
+            self.__parent.children.append(self)
+            return False
+        if self.__profile:
+            self.__profile.disable()
+            self.__dump_profile()
+        with _lock:
+            _finished.append(self)
+        return False
+
+    def __dump_profile(self):
+        """Write the cProfile statistics of a root span."""
+        fname = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.start))}-{self.name}-{threading.get_ident()}.pstats"
+        try:
+            self.__profile.dump_stats(os.path.join(_directory, fname.replace(os.sep, '_')))
+        except OSError:
+            pass
+
+    def to_dict(self):
+        """Return the span tree as a dict."""
+        entry = { 'name' : self.name, 'start' : self.start, 'duration' : self.duration }
+        if self.attrs:
+            entry['attrs'] = self.attrs
+        if self.error:
+            entry['error'] = self.error
+        if self.children:
+            entry['children'] = [ child.to_dict() for child in self.children ]
+        return entry
+
+####################################################################################################
+
+def enable(directory, cprofile = False):
+    """Enable tracing, span trees and profiles are written to 'directory'.
+
+    Parameters:
+    directory: The profile output directory, created if missing
+    cprofile:  Whether to profile root spans with cProfile"""
+
+    global _directory, _run_id, _cprofile
+    os.makedirs(directory, exist_ok = True)
+    _directory = directory
+    _run_id    = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+    _cprofile  = cprofile
+
+def enabled():
+    """Whether tracing is enabled."""
+    return _directory is not None
+
+def span(name, **attrs):
+    """Return a context manager that traces a span with the given name and
+    attributes."""
+    if _directory is None:
+        return _NOOP
+    return Span(name, attrs)
+
+def dump():
+    """Append the root spans finished since the last call to the span file
+    of this run, one JSON document per line."""
+    global _finished
+    if _directory is None:
+        return
+    with _lock:
+        finished, _finished = _finished, []
+    if not finished:
+        return
+    path = os.path.join(_directory, f"spans-{_run_id}.jsonl")
+    with open(path, 'a', encoding = 'utf-8') as outfile:
+        for root in finished:
+            outfile.write(json.dumps(root.to_dict(), default = str) + '\n')